@@ -0,0 +1,207 @@
+import asyncio
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, List
+
+from logger import Logger
+from poe_client import PoeError, poe_backend
+
+
+class ClientPool:
+    # A poe.Client only serves one message at a time, so every concurrent
+    # stream gets its own authenticated client. Idle clients are kept per bot
+    # and reused, new ones are created round-robin over the tokens.
+    def __init__(self, tokens, client_factory=None, max_clients=8) -> None:
+        if not tokens:
+            raise PoeError("At least one token is required")
+        self.__tokens = itertools.cycle(tokens)
+        self.__factory = client_factory or poe_backend
+        self.__idle: Dict[str, List] = {}
+        self.__clients: List = []
+        self.__slots = asyncio.Semaphore(max_clients)
+        # every blocking call runs while holding a slot, so max_clients
+        # threads are enough and a busy default executor never stalls us
+        self.executor = ThreadPoolExecutor(max_clients, "poe-client")
+
+    @property
+    def size(self) -> int:
+        return len(self.__clients)
+
+    async def acquire(self, bot):
+        await self.__slots.acquire()
+        idle = self.__idle.get(bot)
+        if idle:
+            return idle.pop()
+        for other in self.__idle.values():
+            if other:
+                return other.pop()
+        try:
+            client = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.__factory, next(self.__tokens))
+        except Exception as e:
+            self.__slots.release()
+            raise PoeError(f"Unable to connect to poe.com: {e}")
+        Logger("New pooled client for %s (%d clients)", bot, len(self.__clients) + 1)
+        self.__clients.append(client)
+        return client
+
+    def release(self, bot, client) -> None:
+        self.__idle.setdefault(bot, []).append(client)
+        self.__slots.release()
+
+    def discard(self, client) -> None:
+        if client in self.__clients:
+            self.__clients.remove(client)
+        self.__slots.release()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def any(self):
+        if self.__clients:
+            return self.__clients[0]
+        client = await self.acquire(None)
+        self.release(None, client)
+        return client
+
+
+class AsyncPoe:
+    def __init__(self, tokens, client_factory=None, max_clients=8) -> None:
+        if isinstance(tokens, str):
+            tokens = [tokens]
+        self.__pool = ClientPool(tokens, client_factory, max_clients)
+        # only fresh conversations (with_chat_break) are cached, the context
+        # of concurrent streams sharing a bot can not be tracked
+        self.cache = None
+
+    @property
+    def pool(self) -> ClientPool:
+        return self.__pool
+
+    def close(self) -> None:
+        self.__pool.close()
+
+    async def bots(self) -> Dict[str, str]:
+        client = await self.__pool.any()
+        return client.bot_names
+
+    async def send_chat_break(self, bot) -> None:
+        client = await self.__pool.acquire(bot)
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.__pool.executor, client.send_chat_break, bot)
+        finally:
+            self.__pool.release(bot, client)
+
+    async def send_message_generator(
+        self, bot, message, with_chat_break=False
+    ) -> AsyncIterator[str]:
+        key = None
+        if self.cache is not None and with_chat_break:
+            key = self.cache.key(bot, message, "")
+            cached = self.cache.get(key)
+            if cached is not None:
+                Logger("Cache hit for message to %s: %s", bot, message)
+                for chunk in cached:
+                    yield chunk
+                return
+        loop = asyncio.get_running_loop()
+        client = await self.__pool.acquire(bot)
+        received: List[str] = []
+        chunks: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+        end = object()
+
+        def produce():
+            failure = None
+            try:
+                for chunk in client.send_message(
+                        bot, message, with_chat_break=with_chat_break):
+                    # poe.Client only cleans up a message once its generator
+                    # is exhausted, so an abandoned reply is drained anyway
+                    if not cancelled.is_set():
+                        loop.call_soon_threadsafe(chunks.put_nowait, chunk["text_new"])
+            except Exception as e:
+                failure = e
+            if loop.is_closed():
+                return
+            if failure is None:
+                loop.call_soon_threadsafe(self.__pool.release, bot, client)
+            else:
+                loop.call_soon_threadsafe(self.__pool.discard, client)
+            loop.call_soon_threadsafe(chunks.put_nowait, failure or end)
+
+        Logger("Sent message to %s: %s", bot, message)
+        loop.run_in_executor(self.__pool.executor, produce)
+        try:
+            while True:
+                chunk = await chunks.get()
+                if chunk is end:
+                    if key is not None:
+                        self.cache.put(key, bot, received)
+                    return
+                if isinstance(chunk, Exception):
+                    raise PoeError(f"{bot}: {chunk}")
+                received.append(chunk)
+                yield chunk
+        finally:
+            cancelled.set()
+
+    async def send_message(self, bot, message, with_chat_break=False) -> str:
+        text = []
+        async for chunk in self.send_message_generator(
+                bot, message, with_chat_break):
+            text.append(chunk)
+        return "".join(text)
+
+    async def gather(self, bots, message) -> Dict[str, str]:
+        replies = await asyncio.gather(
+            *(self.send_message(bot, message) for bot in bots),
+            return_exceptions=True,
+        )
+        return dict(zip(bots, replies))
+
+
+def run_test():
+    import time
+
+    from fake_poe import FakeClient
+
+    async def test():
+        client = AsyncPoe(["token-a", "token-b"],
+                          lambda token: FakeClient(token, delay=0.05))
+        bots = list(await client.bots())
+        message = "one two three four"
+        start = time.perf_counter()
+        replies = await client.gather(bots * 2, message)
+        elapsed = time.perf_counter() - start
+        assert all(reply == message for reply in replies.values()), replies
+        # each reply takes 4 * 50ms, run one after the other it would be 1.2s
+        assert elapsed < 0.6, elapsed
+        assert client.pool.size <= len(bots) * 2
+
+        chunks = []
+        async for chunk in client.send_message_generator(bots[0], message):
+            chunks.append(chunk)
+            break
+        assert chunks == ["one"], chunks
+
+        try:
+            await client.send_message("unknown", message)
+        except PoeError as e:
+            assert "unknown" in str(e)
+        else:
+            raise AssertionError("PoeError not raised")
+        client.close()
+        return elapsed
+
+    elapsed = asyncio.run(test())
+    print(f"All tests passed in {elapsed:.2f}s, well done!")
+
+
+if __name__ == "__main__":
+    try:
+        run_test()
+    except Exception as e:
+        print(e)
@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+from async_poe import AsyncPoe
+from chunking import MapReduce
+from command import CommandError  # type: ignore
+from logger import Logger
+from poe_client import PoeError, add_backend_arguments, backend_from_spec
+from prompt_limit import PromptLimits, default_limits_path
+from response_cache import add_cache_arguments, cache_from_args
+from tokens import Tokens
+
+
+def read_prompts(file, bots):
+    # One prompt per line, or json objects {"prompt": ..., "id": ..., "bot": ...}
+    bots = itertools.cycle(bots)
+    for line_number, line in enumerate(file, 1):
+        line = line.rstrip("\n")
+        if not line.strip():
+            continue
+        job = None
+        if line.lstrip().startswith("{"):
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError:
+                pass
+        if not isinstance(job, dict):
+            job = {"prompt": line}
+        job.setdefault("id", line_number)
+        job["bot"] = job.get("bot") or next(bots)
+        yield job
+
+
+def read_checkpoint(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            # a line without an id (or cut short) is not a result of ours
+            if not isinstance(result, dict) or result.get("id") is None:
+                continue
+            if result.get("error") is None:
+                done.add(result["id"])
+    return done
+
+
+class Batch:
+    def __init__(self, client, output, concurrency=4, retries=3, backoff=1.0,
+                 with_chat_break=True, cwd=None) -> None:
+        self.client = client
+        self.output = output
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.with_chat_break = with_chat_break
+        self.tokens = Tokens(cwd)
+        self.limits = PromptLimits()
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.__paused_until = 0.0
+
+    async def __wait_backoff(self):
+        delay = self.__paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def __pause(self, attempt):
+        # every worker waits after a failure, so that a rate limited account
+        # is not hammered by the other requests in flight
+        delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+        self.__paused_until = max(self.__paused_until, time.monotonic() + delay)
+        return delay
+
+    async def run_job(self, job):
+        # a job that can not be sent fails on its own, the others go on
+        result = {"id": job.get("id"), "bot": job.get("bot"), "prompt": job.get("prompt")}
+        if not isinstance(result["prompt"], str):
+            result.update(reply=None, error="The job has no prompt", attempts=0)
+            return result
+        try:
+            return await self.__run_job(job, result)
+        except Exception as e:
+            Logger("Job %s failed: %r", job.get("id"), e)
+            result.update(reply=None, error=f"<!> {e}", attempts=result.get("attempts", 0))
+            return result
+
+    async def __run_job(self, job, result):
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        try:
+            message = await loop.run_in_executor(None, self.tokens, job["prompt"])
+        except CommandError as e:
+            result.update(reply=None, error=str(e), attempts=0)
+            return result
+        limit = self.limits.get(job["bot"])
+        if limit is not None and len(message) > limit:
+            try:
+                message = await loop.run_in_executor(
+                    None, self.__map_reduce(job["bot"], limit).run, message, job["prompt"])
+            except PoeError as e:
+                result.update(reply=None, error=str(e), attempts=0)
+                return result
+        for attempt in range(self.retries + 1):
+            await self.__wait_backoff()
+            try:
+                reply = await self.client.send_message(
+                    job["bot"], message, self.with_chat_break)
+                result.update(reply=reply, error=None)
+                break
+            except PoeError as e:
+                result.update(reply=None, error=str(e))
+                if attempt < self.retries:
+                    delay = self.__pause(attempt)
+                    Logger("Job %s failed (%s), retry in %.1fs", job["id"], e, delay)
+        result["attempts"] = attempt + 1
+        result["elapsed"] = round(time.monotonic() - start, 3)
+        return result
+
+    def __map_reduce(self, bot, limit) -> MapReduce:
+        # the parts are sent from an executor thread, on the client's loop
+        loop = asyncio.get_running_loop()
+
+        def send(message):
+            return asyncio.run_coroutine_threadsafe(
+                self.client.send_message(bot, message, True), loop).result()
+
+        return MapReduce(send, limit, self.concurrency)
+
+    async def __worker(self, jobs, done):
+        for job in jobs:
+            if job["id"] in done:
+                self.skipped += 1
+                continue
+            result = await self.run_job(job)
+            if result["error"] is None:
+                self.done += 1
+            else:
+                self.failed += 1
+            self.output.write(json.dumps(result) + "\n")
+            self.output.flush()
+
+    async def run(self, jobs, done=()):
+        # the workers share a single iterator, so prompts are read lazily
+        jobs = iter(jobs)
+        await asyncio.gather(
+            *(self.__worker(jobs, done) for _ in range(self.concurrency)))
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Send a batch of prompts to poe.com")
+    parser.add_argument(
+        "-t", "--token", action="append", required=True,
+        help="POE Token fetch from poe.com cookies, can be repeated")
+    parser.add_argument(
+        "-i", "--input", help="Prompt file, one prompt or json object per line (default: stdin)")
+    parser.add_argument(
+        "-o", "--output", help="JSONL result file (default: stdout)")
+    parser.add_argument(
+        "-b", "--bot", default="capybara",
+        help="Comma separated bots, prompts are dispatched round-robin")
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("-r", "--retries", type=int, default=3)
+    parser.add_argument(
+        "--backoff", type=float, default=1.0, help="First retry delay in seconds")
+    parser.add_argument(
+        "--keep-context", action="store_true",
+        help="Do not send a chat break before every prompt")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="Skip the prompts already answered in the output file")
+    parser.add_argument("-l", "--log", type=str, help="Log file")
+    add_cache_arguments(parser)
+    add_backend_arguments(parser)
+    return parser.parse_args()
+
+
+async def main(args):
+    done = set()
+    if args.resume and args.output:
+        done = read_checkpoint(args.output)
+    client = AsyncPoe(args.token, backend_from_spec(args.backend), args.concurrency)
+    client.cache = cache_from_args(args)
+    source = open(args.input) if args.input else sys.stdin
+    output = open(args.output, "a" if args.resume else "w") if args.output else sys.stdout
+    batch = Batch(client, output, args.concurrency, args.retries, args.backoff,
+                  not args.keep_context)
+    batch.limits = PromptLimits(default_limits_path())
+    start = time.monotonic()
+    try:
+        await batch.run(read_prompts(source, args.bot.split(",")), done)
+    finally:
+        client.close()
+        if args.output:
+            output.close()
+        if args.input:
+            source.close()
+    print(
+        f"{batch.done} done, {batch.failed} failed, {batch.skipped} skipped "
+        f"in {time.monotonic() - start:.1f}s",
+        file=sys.stderr,
+    )
+    return int(batch.failed > 0)
+
+
+if __name__ == "__main__":
+    args = arg_parser()
+    if args.log:
+        Logger.is_active = True
+        Logger.set_file(args.log)
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,530 @@
+import argparse
+import asyncio
+import contextlib
+import inspect
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+
+from async_poe import AsyncPoe
+from command import Command, CommandHandler, compile_template  # type: ignore
+from file_cache import FileCache
+from logger import Logger
+from poe_client import Poe, PoeError, fake_backend
+from tokens import Tokens
+
+
+def report(name, count, elapsed):
+    print(f"{name:<36} {count:>8} calls {elapsed * 1000:>10.2f}ms "
+          f"{elapsed / count * 1e6:>10.2f}us/call")
+
+
+class LegacyLogger:
+    # Logger as it was before the background writer, kept as a baseline
+    def __init__(self, file) -> None:
+        self.__file = open(file, "w")
+
+    def close(self):
+        self.__file.close()
+
+    def __call__(self, message):
+        python_inspect = inspect.stack()[1]
+        python_filename = python_inspect.filename.split("/")[-1]
+        python_line = python_inspect.lineno
+        python_function = python_inspect.function
+        if type(message) == list:
+            message = "\n".join(message)
+        self.__file.write(
+            f"[{date.today().strftime('%Y-%m-%d %H:%M:%S')}] \
+        <{python_filename}|{python_function}|{python_line}>\n{message}\n"
+        )
+        self.__file.flush()
+
+
+def bench_logger(count):
+    chunk = {"text": "x" * 200, "text_new": "x", "state": "incomplete"}
+    with tempfile.TemporaryDirectory() as directory:
+        legacy = LegacyLogger(os.path.join(directory, "legacy.log"))
+        start = time.perf_counter()
+        for _ in range(count):
+            legacy(f"Received chunks: {chunk}")
+        report("legacy logger", count, time.perf_counter() - start)
+        legacy.close()
+
+        Logger.is_active = False
+        start = time.perf_counter()
+        for _ in range(count):
+            Logger("Received chunks: %s", chunk)
+        report("logger (inactive)", count, time.perf_counter() - start)
+
+        Logger.is_active = True
+        Logger.set_file(os.path.join(directory, "logger.log"))
+        for overflow in ("drop", "block"):
+            Logger.set_overflow(overflow)
+            start = time.perf_counter()
+            for _ in range(count):
+                Logger("Received chunks: %s", chunk)
+            report(f"logger ({overflow}, enqueue)", count, time.perf_counter() - start)
+            Logger.flush()
+            report(f"logger ({overflow}, written)", count, time.perf_counter() - start)
+        Logger.close()
+        Logger.is_active = False
+
+
+def legacy_parse_token(handler, prompt, separators=("{{", "}}")):
+    # CommandHandler.parse_token before the template compiler
+    sub_prompt = []
+    new_prompt = []
+    is_in_token = False
+    token_count = 0
+    separator_begin, separator_end = separators
+    for token in prompt.split():
+        if token.startswith(separator_begin) and token.endswith(separator_end):
+            new_prompt.append(handler.match_token(
+                token[len(separator_begin): -len(separator_end)]))
+        elif token.startswith(separator_begin):
+            trailing = token[len(separator_begin):]
+            if trailing:
+                sub_prompt.append(trailing)
+            token_count += 1
+            is_in_token = True
+        elif token.endswith(separator_end):
+            leading = token[: -len(separator_end)]
+            if leading:
+                sub_prompt.append(leading)
+            token_count -= 1
+            if token_count == 0:
+                is_in_token = False
+                new_prompt.append(handler.match_token(" ".join(sub_prompt)))
+                sub_prompt = []
+        elif is_in_token:
+            sub_prompt.append(token)
+        else:
+            new_prompt.append(token)
+    return " ".join(new_prompt)
+
+
+def bench_template(count):
+    handler = CommandHandler(
+        {
+            "slow": Command(lambda _: time.sleep(0.005) or "slow", "simulated file read"),
+            "fast": Command(lambda _: "fast", "constant"),
+        },
+        separators=("{{", "}}"),
+    )
+    line = "    def f(x):  return x * 2  # some pasted code\n"
+    megabyte = line * (1024 * 1024 // len(line))
+    prompts = {
+        "1 MB, no token": megabyte,
+        "1 MB, 10 tokens": megabyte + " {{fast}}" * 10,
+        "1 MB, 4 slow tokens": megabyte + " {{slow}}" * 4,
+    }
+    count = max(1, count // 1000)
+    for name, prompt in prompts.items():
+        start = time.perf_counter()
+        for _ in range(count):
+            legacy_parse_token(handler, prompt)
+        report(f"legacy, {name}", count, time.perf_counter() - start)
+        compile_template.cache_clear()
+        start = time.perf_counter()
+        for _ in range(count):
+            compile_template.cache_clear()
+            handler(prompt)
+        report(f"template, {name}", count, time.perf_counter() - start)
+        start = time.perf_counter()
+        for _ in range(count):
+            handler(prompt)
+        report(f"template cached, {name}", count, time.perf_counter() - start)
+
+
+STARTUP_SCRIPT = """
+import sys, time
+import poe
+from fake_poe import FakeClient
+poe.Client = lambda token: (time.sleep(%(connect)f), FakeClient(token))[1]
+sys.argv = ["prompt.py", "--token", "fake"]
+import prompt
+terminal = prompt.Terminal()
+print("ready", flush=True)
+terminal.client.wait()
+print("connected", flush=True)
+"""
+
+
+def bench_startup(count):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import prompt"],
+        cwd=directory, capture_output=True, text=True, check=True)
+    imports = []
+    total = 0
+    for line in result.stderr.splitlines()[1:]:
+        self_time, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            total += int(cumulative)
+        if depth <= 1:  # the interpreter start up and what prompt imports
+            imports.append((int(cumulative), int(self_time.split(":")[1]), name.strip()))
+    imports.sort(reverse=True)
+    print(f"{'module':<36} {'cumulative':>12} {'self':>10}")
+    for cumulative, self_time, name in imports[:16]:
+        print(f"{name:<36} {cumulative / 1000:>10.2f}ms {self_time / 1000:>8.2f}ms")
+    print(f"{'total':<36} {total / 1000:>10.2f}ms")
+
+    # time to first prompt with a poe.com connection taking one second
+    connect = 1.0
+    runs = max(1, count // 2000)
+    ready = connected = 0.0
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-c", STARTUP_SCRIPT % {"connect": connect}],
+            cwd=directory, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, text=True)
+        for line in process.stdout:
+            if line.startswith("ready"):
+                ready += time.perf_counter() - start
+            elif line.startswith("connected"):
+                connected += time.perf_counter() - start
+        process.wait()
+    report("time to first prompt", runs, ready)
+    report(f"time to connection ({connect:.0f}s)", runs, connected)
+
+
+def bench_ttft(count):
+    # time to first token through the clients, the fake server answering
+    # at once or after first_delay
+    runs = max(10, count // 100)
+    for first_delay in (0.0, 0.01):
+        client = Poe("fake", client_factory=fake_backend(first_delay=first_delay))
+        elapsed = 0.0
+        for _ in range(runs):
+            start = time.perf_counter()
+            chunks = client.send_message_generator("hello world")
+            next(chunks)
+            elapsed += time.perf_counter() - start
+            chunks.close()
+        report(f"Poe, first_delay={first_delay * 1000:.0f}ms", runs, elapsed)
+
+        async def async_ttft():
+            client = AsyncPoe("fake", fake_backend(first_delay=first_delay))
+            elapsed = 0.0
+            for _ in range(runs):
+                start = time.perf_counter()
+                async for _ in client.send_message_generator("capybara", "hello world"):
+                    elapsed += time.perf_counter() - start
+                    break
+            client.close()
+            return elapsed
+
+        report(f"AsyncPoe, first_delay={first_delay * 1000:.0f}ms",
+               runs, asyncio.run(async_ttft()))
+
+        # up to the first byte read at the other end of a pipe, --raw
+        read, write = os.pipe()
+        with tempfile.TemporaryDirectory() as directory:
+            os.environ["XDG_CACHE_HOME"] = directory
+            terminal = raw_terminal(f"fake:first_delay={first_delay}", os.fdopen(write, "wb"))
+            terminal.client.wait()
+            elapsed = 0.0
+            for _ in range(runs):
+                start = time.perf_counter()
+                thread = threading.Thread(target=terminal.answer, args=("hello world",))
+                thread.start()
+                os.read(read, 1)
+                elapsed += time.perf_counter() - start
+                thread.join()
+                os.read(read, 65536)
+        report(f"--raw to a pipe, first_delay={first_delay * 1000:.0f}ms", runs, elapsed)
+        terminal.output.close()
+        os.close(read)
+
+
+def raw_terminal(backend, output):
+    import prompt
+    from raw import RawTerminal
+
+    argv = sys.argv
+    sys.argv = ["prompt.py", "--token", "fake", "--history", "",
+                "--backend", backend]
+    try:
+        return RawTerminal(prompt.Terminal.arg_parser(), output)
+    finally:
+        sys.argv = argv
+
+
+class FakeTTY(io.StringIO):
+    def isatty(self):
+        return True
+
+
+def bench_render(count):
+    # chunks per second through Terminal.answer, rendered as in a terminal
+    import prompt
+
+    reply_size = max(2000, count * 2)
+    argv = sys.argv
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["XDG_CACHE_HOME"] = directory
+        for mode, chunk_size, fps in [
+            ("interactive", 8, 30), ("interactive", 64, 30),
+            ("interactive", 8, 1000), ("batch", 8, 30),
+        ]:
+            sys.argv = ["prompt.py", "--token", "fake", "--mode", mode,
+                        "--fps", str(fps), "--backend",
+                        f"fake:reply_size={reply_size},chunk_size={chunk_size}"]
+            terminal = prompt.Terminal()
+            terminal.client.wait()
+            chunks = -(-reply_size // chunk_size)
+            with contextlib.redirect_stdout(FakeTTY()):
+                terminal.answer("warm up")
+                start = time.perf_counter()
+                terminal.answer("hello")
+                elapsed = time.perf_counter() - start
+            report(f"{mode}, {chunk_size} chars/chunk, {fps} fps", chunks, elapsed)
+        sys.argv = argv
+        terminal = raw_terminal(f"fake:reply_size={reply_size},chunk_size=8", io.BytesIO())
+        terminal.client.wait()
+        terminal.answer("warm up")
+        start = time.perf_counter()
+        terminal.answer("hello")
+        report("--raw, 8 chars/chunk", -(-reply_size // 8), time.perf_counter() - start)
+
+
+def bench_expansion(count):
+    with tempfile.TemporaryDirectory() as directory:
+        line = "    def f(x):  return x * 2  # some pasted code\n"
+        with open(os.path.join(directory, "big.py"), "w") as f:
+            f.write(line * (1024 * 1024 // len(line)))
+        for index in range(100):
+            with open(os.path.join(directory, f"small_{index}.py"), "w") as f:
+                f.write(line * 20)
+        prompts = {
+            "file, 1 MB": "Explain {{file big.py}}",
+            "file, 100 lines range": "Explain {{file big.py 5000:5100}}",
+            "file, 100 files glob": "Explain {{file small_*.py}}",
+            "code, 1 MB": "Explain {{code python big.py}}",
+        }
+        count = max(1, count // 1000)
+        for cache, files in [("uncached", FileCache(max_size=0)),
+                             ("cached", FileCache()),
+                             ("cached, stat", FileCache(watch=False))]:
+            tokens = Tokens(directory, files=files)
+            for name, prompt in prompts.items():
+                start = time.perf_counter()
+                for _ in range(count):
+                    tokens(prompt)
+                report(f"{name}, {cache}", count, time.perf_counter() - start)
+
+
+def bench_faults(count):
+    # batch throughput when the fake server fails or rate limits messages
+    from batch import Batch
+
+    jobs = max(20, count // 100)
+    for name, options in [
+        ("no fault", {}),
+        ("10% errors", {"error_rate": 0.1}),
+        ("rate limited", {"rate_limit": 5, "rate_window": 0.05}),
+    ]:
+        async def run():
+            client = AsyncPoe("fake", fake_backend(delay=0.001, **options), 4)
+            batch = Batch(client, io.StringIO(), 4, retries=5, backoff=0.01)
+            await batch.run(
+                {"id": i, "bot": "capybara", "prompt": "one two three"}
+                for i in range(jobs))
+            client.close()
+            return batch
+
+        start = time.perf_counter()
+        batch = asyncio.run(run())
+        report(f"{name}, {batch.failed} failed", jobs, time.perf_counter() - start)
+
+
+def bench_tail(count):
+    # tail latency when 5% of the replies stall before their first chunk,
+    # with and without hedging or a first chunk deadline
+    from metrics import percentile
+    from resilience import Resilience
+
+    runs = max(100, count // 20)
+    backend = fake_backend(first_delay=0.005, delay=0.001, slow_rate=0.05, slow_delay=0.2)
+    for name, resilience in [
+        ("no resilience", None),
+        ("hedge after 20ms", Resilience(hedge_after=0.02)),
+        ("deadline 30ms, 2 retries", Resilience(ttfc_deadline=0.03, retries=2, backoff=0.001)),
+    ]:
+        client = Poe("fake", client_factory=backend)
+        client.resilience = resilience
+        failed = 0
+        start = time.perf_counter()
+        for _ in range(runs):
+            try:
+                for _ in client.send_message_generator("one two three four five"):
+                    pass
+            except PoeError:
+                failed += 1
+        elapsed = time.perf_counter() - start
+        values = client.metrics.values(client.metrics.finished())
+        print(f"{name:<36} {runs:>8} calls {elapsed * 1000:>10.2f}ms "
+              f"ttfc p50 {percentile(values['ttfc'], 0.5) * 1000:.1f}ms "
+              f"p99 {percentile(values['ttfc'], 0.99) * 1000:.1f}ms, {failed} failed")
+
+
+def bench_docgen(count):
+    # a 2000 functions codebase documented, then again with every docstring
+    # cached
+    from docgen import DocCache, DocGen, pooled_send
+
+    with tempfile.TemporaryDirectory() as directory:
+        for module in range(40):
+            with open(os.path.join(directory, f"module_{module}.py"), "w") as f:
+                for index in range(50):
+                    callee = f"f_{module}_{index - 1}(x) + " if index else ""
+                    f.write(f"def f_{module}_{index}(x):\n"
+                            f"    return {callee}x * {index}\n\n\n")
+        cache = DocCache(os.path.join(directory, "docstrings.json"))
+        for name in ("first run", "second run, cached"):
+            client = Poe("fake", connect=False,
+                         client_factory=fake_backend(reply_size=200, first_delay=0.001))
+            generator = DocGen(pooled_send(client, "capybara"), "capybara",
+                               DocCache(cache.path), 4)
+            start = time.perf_counter()
+            definitions = generator.run(directory)
+            report(f"{name}, {generator.sent} sent", len(definitions),
+                   time.perf_counter() - start)
+
+
+def bench_history(count):
+    from history import History
+
+    words = ["python", "markdown", "terminal", "socket", "stream", "cache",
+             "index", "thread", "render", "prompt", "token", "server"]
+    exchanges = max(1000, count * 10)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "history.log")
+        history = History(path, compact_min_size=float("inf"))
+        start = time.perf_counter()
+        for index in range(exchanges):
+            id = history.begin("capybara", f"question {index} about {words[index % 12]}")
+            reply = f"answer {index} on {words[index % 7]} and {words[index % 5]} "
+            for chunk in reply.split(" "):
+                history.chunk(id, chunk + " ")
+            history.end(id, reply)
+        report("append (prompt, 5 chunks, reply)", exchanges, time.perf_counter() - start)
+        for query in ["python", "python stream cache", f"question {exchanges - 1}", "absent"]:
+            start = time.perf_counter()
+            for _ in range(100):
+                history.search(query)
+            report(f"search '{query}'", 100, time.perf_counter() - start)
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        history.compact()
+        report(f"compact {size >> 20} MB to {os.path.getsize(path) >> 20} MB",
+               1, time.perf_counter() - start)
+        history.close()
+        start = time.perf_counter()
+        history = History(path)
+        history.end(history.begin("capybara", "first prompt"), "reply")
+        report("reopen, first exchange appended", 1, time.perf_counter() - start)
+        len(history)
+        report(f"load and index {exchanges} exchanges", 1, time.perf_counter() - start)
+        history.close()
+
+
+def bench_replay(count, trace=None):
+    # the cost of --record, then a trace played back at its recorded speed
+    # and as fast as possible through the terminal, rendered and --raw; a
+    # trace recorded from the fake server when none is given (--trace)
+    import prompt
+    from chunk_trace import ReplayClient, TraceWriter, read_trace
+
+    reply_size = max(2000, count * 2)
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["XDG_CACHE_HOME"] = directory
+        for name, record in [("not recorded", False), ("--record", True)]:
+            client = Poe("fake", client_factory=fake_backend(
+                reply_size=reply_size, chunk_size=8))
+            if record:
+                client.trace = TraceWriter(os.path.join(directory, "overhead.jsonl"))
+            start = time.perf_counter()
+            for _ in client.send_message_generator("hello"):
+                pass
+            report(f"{name}, 8 chars/chunk", -(-reply_size // 8), time.perf_counter() - start)
+        if trace is None:
+            trace = os.path.join(directory, "trace.jsonl")
+            client = Poe("fake", client_factory=fake_backend(
+                reply_size=2000, chunk_size=8, first_delay=0.02, delay=0.0005))
+            client.trace = TraceWriter(trace)
+            for index in range(5):
+                for _ in client.send_message_generator(f"question {index}"):
+                    pass
+            client.trace.close()
+        replies = read_trace(trace)
+        chunks = sum(len(reply.chunks) for reply in replies)
+        recorded = sum(reply.chunks[-1][0] for reply in replies if reply.chunks)
+        print(f"{trace}: {len(replies)} replies, {chunks} chunks, {recorded:.2f}s")
+        for speed in (1, 4):
+            client = Poe("fake", client_factory=lambda token: ReplayClient(token, trace, speed))
+            start = time.perf_counter()
+            for index in range(len(replies)):
+                for _ in client.send_message_generator(f"replay {index}"):
+                    pass
+            elapsed = time.perf_counter() - start
+            print(f"{f'replay, speed={speed}':<36} {chunks:>8} chunks {elapsed:>9.2f}s "
+                  f"({elapsed * speed / recorded * 100 - 100:+.1f}% off the trace)")
+        argv = sys.argv
+        sys.argv = ["prompt.py", "--token", "fake", "--backend", f"replay:{trace},speed=0"]
+        terminal = prompt.Terminal()
+        sys.argv = argv
+        terminal.client.wait()
+        with contextlib.redirect_stdout(FakeTTY()):
+            start = time.perf_counter()
+            for index in range(len(replies)):
+                terminal.answer(f"replay {index}")
+            elapsed = time.perf_counter() - start
+        report("rendered, speed=0", chunks, elapsed)
+        terminal = raw_terminal(f"replay:{trace},speed=0", io.BytesIO())
+        terminal.client.wait()
+        start = time.perf_counter()
+        for index in range(len(replies)):
+            terminal.answer(f"replay {index}")
+        report("--raw, speed=0", chunks, time.perf_counter() - start)
+
+
+benchmarks = {
+    "logger": bench_logger,
+    "template": bench_template,
+    "startup": bench_startup,
+    "ttft": bench_ttft,
+    "render": bench_render,
+    "expansion": bench_expansion,
+    "faults": bench_faults,
+    "tail": bench_tail,
+    "docgen": bench_docgen,
+    "history": bench_history,
+    "replay": bench_replay,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="poe_terminal benchmarks")
+    parser.add_argument(
+        "benchmark", nargs="*", help=f"One of {', '.join(benchmarks)} (default: all)")
+    parser.add_argument("-n", "--count", type=int, default=10000)
+    parser.add_argument("--trace", help="Trace of --record for the replay benchmark")
+    args = parser.parse_args()
+    for name in args.benchmark:
+        if name not in benchmarks:
+            parser.error(f"unknown benchmark '{name}'")
+    for name in args.benchmark or benchmarks:
+        print(f"--- {name}")
+        if name == "replay":
+            bench_replay(args.count, args.trace)
+        else:
+            benchmarks[name](args.count)
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import weakref
+from typing import Dict
+
+from logger import Logger
+
+
+def default_catalogue_path(token) -> str:
+    directory = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    # one file per account, without writing the token itself on disk
+    account = hashlib.sha256(token.encode()).hexdigest()[:16]
+    return os.path.join(directory, "poe_terminal", f"bots-{account}.json")
+
+
+class BotCatalogue:
+    # The bots known for an account, read from a cache file at startup so the
+    # commands do not wait for poe.com. Subscribers are called after every
+    # update, bound methods are only weakly referenced so that short lived
+    # sessions do not have to unsubscribe.
+    def __init__(self, path=None, ttl=24 * 3600) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.bots: Dict[str, str] = {}
+        self.updated = 0.0
+        self.__lock = threading.Lock()
+        self.__subscribers = []
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.updated
+
+    @property
+    def stale(self) -> bool:
+        return self.age > self.ttl
+
+    def load(self) -> bool:
+        if self.path is None:
+            return False
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.updated = data["updated"]
+            self.bots = data["bots"]
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            Logger("Unable to read the bot catalogue %s: %r", self.path, e)
+            return False
+        Logger("Loaded %d bots from %s", len(self.bots), self.path)
+        return True
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temporary = f"{self.path}.{os.getpid()}"
+            with open(temporary, "w") as f:
+                json.dump({"updated": self.updated, "bots": self.bots}, f)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            Logger("Unable to write the bot catalogue %s: %r", self.path, e)
+
+    def update(self, bots) -> None:
+        # replaced, never mutated, readers iterate without locking
+        self.bots = dict(bots)
+        self.updated = time.time()
+        self.save()
+        for callback in self.__callbacks():
+            callback()
+
+    def subscribe(self, callback) -> None:
+        if hasattr(callback, "__self__"):
+            reference = weakref.WeakMethod(callback)
+        else:
+            reference = lambda: callback  # noqa: E731
+        with self.__lock:
+            self.__subscribers.append(reference)
+
+    def __callbacks(self):
+        with self.__lock:
+            callbacks = [reference() for reference in self.__subscribers]
+            self.__subscribers = [
+                reference for reference, callback
+                in zip(self.__subscribers, callbacks) if callback is not None
+            ]
+        return [callback for callback in callbacks if callback is not None]
+
+
+def add_catalogue_arguments(parser) -> None:
+    parser.add_argument(
+        "--bots-ttl", type=float, default=24,
+        help="Hours before the cached list of bots is refreshed")
+
+
+def catalogue_from_args(args) -> BotCatalogue:
+    catalogue = BotCatalogue(default_catalogue_path(args.token), args.bots_ttl * 3600)
+    catalogue.load()
+    return catalogue
@@ -0,0 +1,235 @@
+import atexit
+import json
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from response_cache import digest
+
+VERSION = 1
+# json.dumps builds an encoder per call when given separators
+_encode = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+
+
+class _Reply:
+    # The events of one reply, with the interface of metrics.Request
+    __slots__ = ("__trace", "__id")
+
+    def __init__(self, trace, reply_id) -> None:
+        self.__trace = trace
+        self.__id = reply_id
+
+    def chunk(self, text) -> None:
+        self.__trace.write(self.__id, "chunk", text)
+
+    def finish(self, error=None) -> None:
+        if error is None:
+            self.__trace.write(self.__id, "end", flush=True)
+        elif error == "cancelled":
+            self.__trace.write(self.__id, "cancelled", flush=True)
+        else:
+            self.__trace.write(self.__id, "error", str(error), flush=True)
+
+
+class TraceWriter:
+    # The replies streamed by Poe.send_message_generator, one JSON array per
+    # line after a header: [seconds, reply, event, ...], the seconds on the
+    # monotonic clock since the trace started, the replies numbered as they
+    # can be interleaved (fan out, server sessions). The messages themselves
+    # are not written, only their digest and length:
+    #   [t, n, "send", bot, digest, length, cached]
+    #   [t, n, "chunk", text]
+    #   [t, n, "end"], [t, n, "cancelled"] or [t, n, "error", message]
+    def __init__(self, path) -> None:
+        self.path = path
+        self.replies = 0
+        self.__lock = threading.Lock()
+        self.__file = open(path, "w", encoding="utf-8")
+        self.__start = time.monotonic()
+        self.__file.write(json.dumps(
+            {"trace": VERSION, "clock": "monotonic", "time": time.time()}) + "\n")
+        atexit.register(self.close)
+
+    def reply(self, bot, message, cached=False) -> _Reply:
+        with self.__lock:
+            self.replies += 1
+            reply_id = self.replies
+        self.write(reply_id, "send", bot, digest(bot, message), len(message), cached)
+        return _Reply(self, reply_id)
+
+    def write(self, reply_id, event, *values, flush=False) -> None:
+        line = _encode(
+            [round(time.monotonic() - self.__start, 6), reply_id, event, *values])
+        with self.__lock:
+            if self.__file.closed:
+                return
+            self.__file.write(line + "\n")
+            if flush:
+                self.__file.flush()
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__file.close()
+
+
+class TracedReply:
+    __slots__ = ("bot", "digest", "length", "cached", "chunks", "error")
+
+    def __init__(self, bot, message_digest, length, cached) -> None:
+        self.bot = bot
+        self.digest = message_digest
+        self.length = length
+        self.cached = cached
+        # (seconds since the message was sent, text)
+        self.chunks: List[tuple] = []
+        self.error: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        return "".join(text for _, text in self.chunks)
+
+
+def read_trace(path) -> List[TracedReply]:
+    # the replies in the order they were sent, the unfinished ones included
+    replies: List[TracedReply] = []
+    started: Dict[int, tuple] = {}
+    with open(path, encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("trace") != VERSION:
+            raise ValueError(f"{path} is not a trace (version {VERSION})")
+        for line in f:
+            if not line.strip():
+                continue
+            seconds, reply_id, event, *values = json.loads(line)
+            if event == "send":
+                reply = TracedReply(*values)
+                started[reply_id] = (seconds, reply)
+                replies.append(reply)
+                continue
+            if reply_id not in started:
+                continue
+            sent, reply = started[reply_id]
+            if event == "chunk":
+                reply.chunks.append((seconds - sent, values[0]))
+            elif event == "error":
+                reply.error = values[0]
+    return replies
+
+
+class ReplayClient:
+    # Stand-in for poe.Client playing the replies of a trace back with their
+    # recorded timing divided by speed (0: as fast as possible). A message
+    # gets the reply recorded for the same bot and message if any is left,
+    # else the next reply of the trace, looping over it.
+    def __init__(self, token, path=None, speed=1.0) -> None:
+        if path is None:
+            raise ValueError("No trace to replay, use replay:FILE")
+        self.token = token
+        self.speed = speed
+        self.replies = read_trace(path)
+        if not self.replies:
+            raise ValueError(f"No reply in {path}")
+        self.bot_names: Dict[str, str] = {}
+        self.__matching: Dict[str, deque] = {}
+        for index, reply in enumerate(self.replies):
+            self.bot_names.setdefault(reply.bot, reply.bot)
+            self.__matching.setdefault(reply.digest, deque()).append(index)
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    def get_bots(self, download_next_data=True):
+        return {bot: {"defaultBotObject": {"nickname": bot, "displayName": name}}
+                for bot, name in self.bot_names.items()}
+
+    def next_reply(self, chatbot, message) -> TracedReply:
+        with self.__lock:
+            matching = self.__matching.get(digest(chatbot, message))
+            if matching:
+                return self.replies[matching.popleft()]
+            reply = self.replies[self.__next % len(self.replies)]
+            self.__next += 1
+            return reply
+
+    def send_message(self, chatbot, message, with_chat_break=False, timeout=20):
+        reply = self.next_reply(chatbot, message)
+        start = time.monotonic()
+        text = ""
+        for seconds, text_new in reply.chunks:
+            if self.speed:
+                delay = start + seconds / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            text += text_new
+            yield {
+                "messageId": 1,
+                "state": "incomplete",
+                "text": text,
+                "text_new": text_new,
+                "author": chatbot,
+            }
+        if reply.error is not None:
+            raise RuntimeError(reply.error)
+
+    def get_bot(self, display_name):
+        return {"messagesConnection": {"edges": []}}
+
+    def get_message_history(self, chatbot, count=25, cursor=None):
+        return []
+
+    def send_chat_break(self, chatbot):
+        pass
+
+
+def add_trace_arguments(parser) -> None:
+    parser.add_argument(
+        "--record", metavar="FILE",
+        help="Write the timing and text of every chunk received to a trace, "
+             "to play back with --backend replay:FILE")
+
+
+def trace_from_args(args) -> Optional[TraceWriter]:
+    return TraceWriter(args.record) if getattr(args, "record", None) else None
+
+
+def run_test():
+    import os
+    import tempfile
+
+    from poe_client import Poe, backend_from_spec, fake_backend
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trace.jsonl")
+        client = Poe("fake", client_factory=fake_backend(first_delay=0.05, delay=0.01))
+        client.trace = TraceWriter(path)
+        assert "".join(client.send_message_generator("one two three")) == "one two three"
+        chunks = client.send_message_generator("four five")
+        next(chunks)
+        chunks.close()
+        client.trace.close()
+
+        replies = read_trace(path)
+        assert [reply.text for reply in replies] == ["one two three", "four"]
+        assert replies[0].bot == "capybara" and replies[0].length == 13
+        assert replies[0].chunks[0][0] >= 0.05 and replies[0].chunks[2][0] >= 0.07
+
+        client = Poe("fake", client_factory=backend_from_spec(f"replay:{path}"))
+        start = time.monotonic()
+        # recorded for another message: the next reply of the trace
+        assert "".join(client.send_message_generator("hello")) == "one two three"
+        assert time.monotonic() - start >= 0.07
+        assert "".join(client.send_message_generator("one two three")) == "one two three"
+        assert "".join(client.send_message_generator("hello")) == "four"
+
+        client = Poe("fake", client_factory=backend_from_spec(f"replay:{path},speed=0"))
+        start = time.monotonic()
+        assert "".join(client.send_message_generator("hello")) == "one two three"
+        assert time.monotonic() - start < 0.02
+    print("All tests passed, well done!")
+
+
+if __name__ == "__main__":
+    try:
+        run_test()
+    except Exception as e:
+        print(e)
@@ -0,0 +1,167 @@
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from logger import Logger
+from poe_client import PoeError
+
+MAP_PROMPT = (
+    "The request below is too long to be sent at once, it is split in {count} "
+    "parts. Take notes of everything in part {index} that helps to answer the "
+    "request, the notes on every part will be combined afterwards.\n\n"
+    "Request: {request}\n\nPart {index}/{count}:\n{part}"
+)
+REDUCE_PROMPT = (
+    "The request below was too long to be sent at once, here are the notes "
+    "taken on each of its {count} parts. Answer the request from these notes."
+    "\n\nRequest: {request}\n\n{notes}"
+)
+__fence = re.compile(r"^\s*(```|~~~)")
+
+
+def _units(text) -> List[str]:
+    # paragraphs and whole fenced code blocks, separators included so that
+    # joining the units gives the text back
+    units = []
+    current = []
+    fence = None
+    for line in text.splitlines(keepends=True):
+        current.append(line)
+        match = __fence.match(line)
+        if match and fence is None:
+            fence = match.group(1)
+        elif match and match.group(1) == fence:
+            fence = None
+            units.append("".join(current))
+            current = []
+        elif fence is None and not line.strip():
+            units.append("".join(current))
+            current = []
+    if current:
+        units.append("".join(current))
+    return units
+
+
+def _pack(pieces, size) -> List[str]:
+    parts = []
+    current = ""
+    for piece in pieces:
+        if len(current) + len(piece) > size and current:
+            parts.append(current)
+            current = ""
+        if len(piece) > size:
+            parts.extend(piece[i:i + size] for i in range(0, len(piece), size))
+        else:
+            current += piece
+    if current:
+        parts.append(current)
+    return parts
+
+
+def split_prompt(text, size) -> List[str]:
+    # code blocks and paragraphs are kept whole when they fit, else they are
+    # split between lines, and a line longer than size is cut
+    pieces = []
+    for unit in _units(text):
+        if len(unit) > size:
+            pieces.extend(unit.splitlines(keepends=True))
+        else:
+            pieces.append(unit)
+    return _pack(pieces, size)
+
+
+class MapReduce:
+    # A prompt longer than the bot's limit is split, every part is sent in a
+    # fresh conversation (map), and the notes are combined into one prompt
+    # that fits (reduce), itself split again when the notes are too long.
+    def __init__(self, send: Callable[[str], str], limit, concurrency=1,
+                 progress: Optional[Callable[[int, int], None]] = None,
+                 max_depth=3) -> None:
+        self.send = send
+        self.limit = limit
+        self.concurrency = max(1, concurrency)
+        self.progress = progress
+        self.max_depth = max_depth
+
+    def __map(self, request, parts) -> List[str]:
+        count = len(parts)
+        done = 0
+        lock = threading.Lock()
+
+        def send(index):
+            nonlocal done
+            answer = self.send(MAP_PROMPT.format(
+                request=request, index=index + 1, count=count, part=parts[index]))
+            with lock:
+                done += 1
+                if self.progress is not None:
+                    self.progress(done, count)
+            return answer
+
+        if self.progress is not None:
+            self.progress(0, count)
+        if self.concurrency == 1 or count == 1:
+            return [send(index) for index in range(count)]
+        with ThreadPoolExecutor(min(self.concurrency, count), "map") as executor:
+            return list(executor.map(send, range(count)))
+
+    def run(self, text, request) -> str:
+        # the raw prompt (before {{ }} expansion) is the request, shortened
+        # so that most of each message is left for the part itself
+        request = request[:self.limit // 4]
+        overhead = len(MAP_PROMPT.format(
+            request=request, index=999999, count=999999, part=""))
+        size = self.limit - overhead
+        if size < self.limit // 4:
+            raise PoeError(f"Prompt limit {self.limit} is too low to split the prompt")
+        for depth in range(self.max_depth):
+            parts = split_prompt(text, size)
+            Logger("Map-reduce depth %d: %d chars in %d parts", depth, len(text), len(parts))
+            answers = self.__map(request, parts)
+            notes = "\n\n".join(
+                f"Notes on part {index}:\n{answer}"
+                for index, answer in enumerate(answers, 1))
+            prompt = REDUCE_PROMPT.format(
+                request=request, count=len(parts), notes=notes)
+            if len(prompt) <= self.limit:
+                return prompt
+            text = notes
+        raise PoeError(f"Prompt still longer than {self.limit} characters "
+                       f"after {self.max_depth} map-reduce rounds")
+
+
+def run_test():
+    import random
+
+    words = ["alpha", "beta", "gamma", "delta\n", "\n\n", "```python\nx = 1\n```\n"]
+    for seed in range(200):
+        rng = random.Random(seed)
+        text = "".join(rng.choice(words) + " " for _ in range(rng.randint(0, 400)))
+        size = rng.randint(8, 300)
+        parts = split_prompt(text, size)
+        assert "".join(parts) == text, seed
+        assert all(0 < len(part) <= size for part in parts), seed
+
+    code = "intro\n\n```python\nprint(1)\n\nprint(2)\n```\n\noutro\n"
+    assert split_prompt(code, 34) == ["intro\n\n", "```python\nprint(1)\n\nprint(2)\n```\n\n", "outro\n"]
+
+    sent = []
+
+    def send(message):
+        sent.append(message)
+        return f"note {len(sent)}"
+
+    text = "\n\n".join("paragraph %d " % i * 20 for i in range(50))
+    prompt = MapReduce(send, limit=2000, concurrency=4).run(text, "Summarize {{file x}}")
+    assert len(prompt) <= 2000 and len(sent) > 1, (len(prompt), len(sent))
+    assert all(len(message) <= 2000 for message in sent)
+    assert "Summarize {{file x}}" in prompt
+    print("All tests passed, well done!")
+
+
+if __name__ == "__main__":
+    try:
+        run_test()
+    except Exception as e:
+        print(e)
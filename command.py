@@ -1,8 +1,12 @@
+import contextvars
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
+
 from logger import Logger
 from poe_client import PoeError
 
-from typing import List
-
 
 class CommandError(Exception):
     def __init__(self, message):
@@ -13,10 +17,13 @@ class CommandError(Exception):
 
 
 class Command:
-    def __init__(self, command, help_doc, args=None) -> None:
+    def __init__(self, command, help_doc, args=None, raw=False) -> None:
         self.__doc__ = help_doc
         self.__args__ = args
         self.command = command
+        # called with the rest of the prompt as typed (newlines and
+        # indentation kept) rather than with its words
+        self.raw = raw
 
     @property
     def doc(self):
@@ -42,15 +49,84 @@ class Command:
             raise CommandError(f"<!> {e}")
 
 
+class Template:
+    # A prompt split once into literal text and {{ ... }} placeholders, the
+    # literal text is kept untouched (whitespace and newlines included).
+    __executor = None
+
+    def __init__(self, source, separator_begin, separator_end) -> None:
+        self.literals: List[str] = []
+        self.placeholders: List[str] = []
+        position = 0
+        while True:
+            begin = source.find(separator_begin, position)
+            end = source.find(separator_end, begin + len(separator_begin))
+            if begin == -1 or end == -1:
+                break
+            self.literals.append(source[position:begin])
+            self.placeholders.append(source[begin + len(separator_begin):end].strip())
+            position = end + len(separator_end)
+        self.literals.append(source[position:])
+
+    def evaluate(self, match_token):
+        if len(self.placeholders) < 2:
+            return [match_token(placeholder) for placeholder in self.placeholders]
+        # placeholders are independent (mostly file reads), run them together
+        if Template.__executor is None:
+            Template.__executor = ThreadPoolExecutor(8, "template")
+        # in a copy of the caller's context each, for its context variables
+        contexts = [contextvars.copy_context() for _ in self.placeholders]
+        return list(Template.__executor.map(
+            lambda context, placeholder: context.run(match_token, placeholder),
+            contexts, self.placeholders))
+
+    def render(self, match_token) -> str:
+        if not self.placeholders:
+            return self.literals[0]
+        for placeholder in self.placeholders:
+            if not placeholder:
+                raise CommandError("Empty token")
+        parts: List[str] = [self.literals[0]]
+        for value, literal in zip(self.evaluate(match_token), self.literals[1:]):
+            if type(value) is list:
+                parts.extend(value)
+            else:
+                parts.append(value)
+            parts.append(literal)
+        return "".join(parts)
+
+
+@lru_cache(maxsize=32)
+def compile_template(source, separator_begin, separator_end) -> Template:
+    return Template(source, separator_begin, separator_end)
+
+
 class CommandHandler:
     def __init__(self, commands={}, separators=None, help=None) -> None:
         self.commands = commands
         self.__separators = separators
         self.__help = help
+        self.__index = None
+        self.__listeners: List = []
         if help is not None:
             self.commands.update(
                 {help: Command(None, "Show this message", "command")})
 
+    @property
+    def index(self) -> "CommandIndex":
+        if self.__index is None:
+            self.__index = CommandIndex(self)
+        return self.__index
+
+    def subscribe(self, callback) -> None:
+        self.__listeners.append(callback)
+
+    def set_commands(self, commands) -> None:
+        # replace the commands in place, indexes only rebuild this subtree
+        self.commands = commands
+        for callback in self.__listeners:
+            callback(self)
+
     def __iter__(self):
         return iter(self.commands)
 
@@ -71,46 +147,24 @@ class CommandHandler:
                 raise CommandError("Invalid command")
 
     def __help__(self, commands):
-        current_context = self
-        try:
-            """
-            if commands is empty, it will raise an IndexError,
-            and doesn"t trigger the for loop
-            """
-            if not commands[0].startswith(
-                "!"
-            ):  # if command doesn"t start with !, add it
-                commands[0] = "!" + commands[0]
-            for command in commands:
-                temp = current_context[command].__args__
-                if not (temp is None or type(temp) is str):
-                    current_context = temp
-                else:
-                    break
-        except IndexError:
-            pass
-        buffer = []
-        for command in current_context:
-            if current_context[command].__args__ is None:
-                buffer.append(f'{" ".join(commands)} {command} \
-                - {current_context[command].__doc__}')
-            else:
-                buffer.append(f'{" ".join(commands)} {command}\
-                {current_context[command].args}\
-                - {current_context[command].__doc__}')
-        return "\n".join(buffer)
+        if commands and not commands[0].startswith("!"):
+            commands[0] = "!" + commands[0]
+        return self.index.help(tuple(commands))
 
     def __getitem__(self, command):
         return self.match_command(command)
 
     def match_prompt(self, prompt):
-        commands = prompt.split()
+        words = list(re.finditer(r"\S+", prompt))
+        commands = [word.group() for word in words]
         if self.__help is not None and commands[0] == self.__help:
             return self.__help__(commands[1:])
         else:
             current_context = self
             for i, command in enumerate(commands):
                 if current_context[commands[i]].command is not None:
+                    if current_context[commands[i]].raw:
+                        return current_context[commands[i]](prompt[words[i].end():])
                     return current_context[commands[i]](commands[i + 1:])
                 current_context = current_context[command].__args__
 
@@ -119,12 +173,14 @@ class CommandHandler:
             f"\t{command} - {self.commands[command]}" for command in self.commands
         )
 
-    def match_token(self, prompt) -> str:
+    def match_token(self, prompt) -> Union[str, List[str]]:
         result = self.match_prompt(prompt)
         if result is None:
             raise CommandError(f'No result returned with command "{prompt}"')
         if type(result) is tuple:
             return result[-1]
+        if type(result) is list:  # parts joined once with the whole prompt
+            return result
         else:
             try:
                 return str(result)
@@ -134,49 +190,132 @@ class CommandHandler:
     def parse_token(self, prompt) -> str:
         if self.__separators is None:
             return self.match_token(prompt)
-        else:
-            sub_prompt: List[str] = []
-            new_prompt: List[str] = []
-            is_in_token = False
-            token_count = 0
-            separator_begin = self.__separators[0]
-            separator_end = self.__separators[1]
-            for token in prompt.split():
-                if token.startswith(separator_begin) and token.endswith(separator_end):
-                    new_prompt.append(self.match_token(
-                        token[len(separator_begin): -len(separator_end)]))
-                elif token.startswith(separator_begin):
-                    trailing = token[len(separator_begin):]
-                    if trailing:
-                        sub_prompt.append(trailing)
-                    token_count += 1
-                    is_in_token = True
-                elif token.endswith(separator_end):
-                    leading = token[: -len(separator_end)]
-                    if leading:
-                        sub_prompt.append(leading)
-                    token_count -= 1
-                    if token_count == 0:
-                        is_in_token = False
-                        try:
-                            new_prompt.append(
-                                self.match_token(" ".join(sub_prompt))
-                            )
-                        except CommandError as e:
-                            raise CommandError(e.message)
-                        finally:
-                            sub_prompt = []
-                elif is_in_token:
-                    sub_prompt.append(token)
-                else:
-                    new_prompt.append(token)
-
-        return " ".join(new_prompt)
+        template = compile_template(prompt, *self.__separators)
+        return template.render(self.match_token)
 
     def __call__(self, prompt) -> str:
         return self.parse_token(prompt)
 
 
+class _Node:
+    __slots__ = ("handler", "entries", "trie")
+
+    def __init__(self, handler) -> None:
+        self.handler = handler
+        self.entries: List[Tuple[str, str]] = [
+            (name, handler.commands[name].doc) for name in handler]
+        # character trie, the None key of every node lists the entries
+        # below it so a prefix lookup never scans the whole context
+        self.trie: Dict = {None: self.entries}
+        for entry in self.entries:
+            node = self.trie
+            for char in entry[0]:
+                node = node.setdefault(char, {None: []})
+                node[None].append(entry)
+
+
+def _fuzzy_score(query, name) -> Optional[int]:
+    # characters of query found in order in name, lower score is better
+    score = 0
+    position = -1
+    for char in query:
+        found = name.find(char, position + 1)
+        if found == -1:
+            return None
+        score += found - position - 1
+        position = found
+    return score
+
+
+class CommandIndex:
+    # Completion lists and help texts of a CommandHandler tree, compiled once
+    # and rebuilt per subtree when a handler calls set_commands.
+    def __init__(self, handler) -> None:
+        self.__root = handler
+        self.__nodes: Dict[Tuple[str, ...], _Node] = {}
+        # a handler can be reached by several paths (bot_commands is under
+        # !set bot, !ask and !probe), all of them rebuilt together
+        self.__paths: Dict[int, List[Tuple[str, ...]]] = {}
+        self.__subscribed = set()
+        self.__help: Dict[Tuple[str, ...], str] = {}
+        self.__compile(handler, ())
+
+    def __compile(self, handler, path) -> None:
+        self.__nodes[path] = _Node(handler)
+        paths = self.__paths.setdefault(id(handler), [])
+        if path not in paths:
+            paths.append(path)
+        if id(handler) not in self.__subscribed:
+            self.__subscribed.add(id(handler))
+            handler.subscribe(self.rebuild)
+        for name in handler:
+            args = handler.commands[name].__args__
+            if isinstance(args, CommandHandler):
+                self.__compile(args, path + (name,))
+
+    def rebuild(self, handler) -> None:
+        paths = self.__paths.get(id(handler))
+        if not paths:
+            return
+        for path in list(paths):
+            for other in [p for p in self.__nodes if p[:len(path)] == path]:
+                del self.__nodes[other]
+            # the subtree may have changed, its handlers are found again
+            for below in self.__paths.values():
+                below[:] = [p for p in below
+                            if p[:len(path)] != path or len(p) == len(path)]
+            self.__compile(handler, path)
+        self.__help.clear()
+        Logger("Command index rebuilt for %r", paths)
+
+    def completions(self, path, prefix, fuzzy=True) -> List[Tuple[str, str]]:
+        node = self.__nodes.get(tuple(path))
+        if node is None:
+            return []
+        trie = node.trie
+        for char in prefix:
+            trie = trie.get(char)
+            if trie is None:
+                break
+        matches = trie[None] if trie is not None else []
+        if not fuzzy or not prefix:
+            return matches
+        query = prefix.lower()
+        scored = []
+        for entry in node.entries:
+            if entry[0].startswith(prefix):
+                continue
+            score = _fuzzy_score(query, entry[0].lower())
+            if score is not None:
+                scored.append((score, len(entry[0]), entry))
+        scored.sort(key=lambda item: item[:2])
+        return matches + [entry for _, _, entry in scored]
+
+    def help(self, commands) -> str:
+        if commands not in self.__help:
+            self.__help[commands] = self.__build_help(commands)
+        return self.__help[commands]
+
+    def __build_help(self, commands) -> str:
+        path: Tuple[str, ...] = ()
+        for command in commands:
+            self.__nodes[path].handler[command]  # raise on invalid commands
+            if path + (command,) not in self.__nodes:
+                break
+            path += (command,)
+        current_context = self.__nodes[path].handler
+        buffer = []
+        for command in current_context:
+            if current_context[command].__args__ is None:
+                buffer.append(f'{" ".join(commands)} {command} \
+                - {current_context[command].__doc__}')
+            else:
+                buffer.append(f'{" ".join(commands)} {command}\
+                {current_context[command].args}\
+                - {current_context[command].__doc__}')
+        return "\n".join(buffer)
+
+
 def run_test():
     import os
 
@@ -197,7 +336,10 @@ def run_test():
         "New {{test }}",
         "New {{ test}}",
         "New {{test}}",
-        "New {{file this_is_a_test_generated_file.txt}}"
+        "New {{file this_is_a_test_generated_file.txt}}",
+        "Keep\n    indented {{test}}\n\tcode",
+        "{{test}}{{ file this_is_a_test_generated_file.txt }}",
+        "Unclosed {{ test",
     ]
     reference_texts = [
         "This is a test without placeholders",
@@ -206,6 +348,9 @@ def run_test():
         "New test_placeholder",
         "New test_placeholder",
         "New " + file_test_content,
+        "Keep\n    indented test_placeholder\n\tcode",
+        "test_placeholder" + file_test_content,
+        "Unclosed {{ test",
     ]
     is_passed = True
     for item in zip(input_texts, reference_texts):
@@ -222,6 +367,20 @@ def run_test():
             is_passed = False
     if os.path.exists("this_is_a_test_generated_file.txt"):
         os.remove("this_is_a_test_generated_file.txt")
+
+    # a handler under two paths, both completions follow set_commands
+    bots = CommandHandler({"capybara": Command(None, "Sage")})
+    root = CommandHandler({
+        "!set": Command(None, "Set", CommandHandler({"bot": Command(None, "Bot", bots)})),
+        "!ask": Command(None, "Ask", bots),
+    })
+    index = root.index
+    bots.set_commands({"a2": Command(None, "Claude-instant")})
+    for path in [("!set", "bot"), ("!ask",)]:
+        names = [name for name, _ in index.completions(path, "")]
+        if names != ["a2"]:
+            print(f"\tStale completions at {path}: {names}")
+            is_passed = False
     if is_passed:
         print("All tests passed, well done!")
 
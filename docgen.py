@@ -0,0 +1,394 @@
+import argparse
+import ast
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from logger import Logger
+from response_cache import digest
+
+DOC_PROMPT = (
+    "Write the docstring of the python {kind} `{name}` below. Answer with the "
+    "text of the docstring only, without quotes, code fences nor signature."
+    "{context}\n\n```python\n{source}\n```"
+)
+CONTEXT = "\n\nIt uses:\n{callees}"
+__fence = re.compile(r"^\s*(```|~~~)\w*\s*$")
+
+
+def default_docstrings_path() -> str:
+    directory = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(directory, "poe_terminal", "docstrings.json")
+
+
+class Definition:
+    # A function or a class, with the names it calls
+    def __init__(self, path, qualname, node, lines) -> None:
+        self.path = path
+        self.qualname = qualname
+        self.name = node.name
+        self.kind = "class" if isinstance(node, ast.ClassDef) else "function"
+        self.line = node.lineno
+        start = min([d.lineno for d in node.decorator_list] + [node.lineno])
+        self.source = "".join(lines[start - 1:node.end_lineno])
+        self.docstring = ast.get_docstring(node)
+        self.documented = self.docstring is not None
+        self.cached = False
+        self.error: Optional[str] = None
+        self.calls = set()
+        for child in ast.walk(node):
+            if isinstance(child, ast.Call):
+                if isinstance(child.func, ast.Name):
+                    self.calls.add(child.func.id)
+                elif isinstance(child.func, ast.Attribute):
+                    self.calls.add(child.func.attr)
+        self.calls.discard(self.name)
+        # where the docstring goes: before the first statement, or its
+        # decorators, when it is on its own line
+        first = node.body[0]
+        self.body_line = min(
+            [d.lineno for d in getattr(first, "decorator_list", [])] + [first.lineno])
+        prefix = lines[self.body_line - 1][:first.col_offset]
+        self.indent = prefix if not prefix.strip() else None
+
+    def as_dict(self) -> Dict:
+        return {
+            "path": self.path, "line": self.line, "name": self.qualname,
+            "kind": self.kind, "docstring": self.docstring,
+            "cached": self.cached, "error": self.error,
+        }
+
+
+def python_files(path) -> List[str]:
+    if not os.path.isdir(path):
+        return [path]
+    files = []
+    for root, directories, names in os.walk(path):
+        directories[:] = sorted(
+            d for d in directories if not d.startswith(".") and d != "__pycache__")
+        files.extend(os.path.join(root, name) for name in sorted(names)
+                     if name.endswith(".py") and not name.startswith("."))
+    return files
+
+
+def parse(path) -> List[Definition]:
+    with open(path, encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    try:
+        tree = ast.parse(text, path)
+    except SyntaxError as e:
+        Logger("Unable to parse %s: %r", path, e)
+        return []
+    lines = text.splitlines(keepends=True)
+    definitions = []
+
+    def visit(node, scope):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                qualname = ".".join(scope + [child.name])
+                definitions.append(Definition(path, qualname, child, lines))
+                visit(child, scope + [child.name])
+            else:
+                visit(child, scope)
+
+    visit(tree, [])
+    return definitions
+
+
+def order(definitions) -> List[List[Definition]]:
+    # levels of definitions whose callees are all in the previous levels, so
+    # that their docstrings can be given as context; the definitions of a
+    # cycle come last
+    by_name: Dict[str, List[Definition]] = {}
+    for definition in definitions:
+        if not definition.name.startswith("__"):
+            by_name.setdefault(definition.name, []).append(definition)
+    pending = {}
+    dependents: Dict[int, List[Definition]] = {id(d): [] for d in definitions}
+    for definition in definitions:
+        callees = {id(callee): callee for name in definition.calls
+                   for callee in by_name.get(name, []) if callee is not definition}
+        pending[id(definition)] = len(callees)
+        for callee in callees.values():
+            dependents[id(callee)].append(definition)
+    levels = []
+    level = [d for d in definitions if not pending[id(d)]]
+    while level:
+        levels.append(level)
+        following = []
+        for definition in level:
+            for dependent in dependents[id(definition)]:
+                pending[id(dependent)] -= 1
+                if not pending[id(dependent)]:
+                    following.append(dependent)
+        level = following
+    cycles = [d for d in definitions if pending[id(d)] > 0]
+    if cycles:
+        levels.append(cycles)
+    return levels
+
+
+def clean(reply) -> str:
+    lines = [line for line in reply.strip().splitlines() if not __fence.match(line)]
+    text = "\n".join(lines).strip()
+    for quote in ('"""', "'''"):
+        if text.startswith(quote) and text.endswith(quote) and len(text) >= 6:
+            text = text[3:-3].strip()
+    return text
+
+
+class DocCache:
+    # Generated docstrings keyed on a digest of the bot and the source, in a
+    # json file
+    def __init__(self, path=None) -> None:
+        self.path = path
+        self.__docstrings: Dict[str, str] = {}
+        self.__lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.__docstrings = json.load(f)
+            except Exception as e:
+                Logger("Unable to read the docstrings %s: %r", path, e)
+
+    def get(self, key) -> Optional[str]:
+        return self.__docstrings.get(key)
+
+    def set(self, key, docstring) -> None:
+        with self.__lock:
+            self.__docstrings[key] = docstring
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        with self.__lock:
+            docstrings = dict(self.__docstrings)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temporary = f"{self.path}.{os.getpid()}"
+            with open(temporary, "w") as f:
+                json.dump(docstrings, f)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            Logger("Unable to write the docstrings %s: %r", self.path, e)
+
+
+class DocGen:
+    # Docstrings for the undocumented functions and classes of python files,
+    # callees first so that their docstrings are the context of their
+    # callers, the definitions of a level sent concurrently. Only the
+    # definitions whose source changed since the last run are sent.
+    def __init__(self, send: Callable[[str], str], bot, cache=None, concurrency=4,
+                 limit=None, max_callees=10,
+                 progress: Optional[Callable[[int, int], None]] = None) -> None:
+        self.send = send
+        self.bot = bot
+        self.cache = cache or DocCache()
+        self.concurrency = concurrency
+        self.limit = limit
+        self.max_callees = max_callees
+        self.progress = progress
+        self.sent = 0
+        self.__docstrings: Dict[str, str] = {}
+
+    def prompt(self, definition) -> str:
+        callees = []
+        for name in sorted(definition.calls):
+            docstring = self.__docstrings.get(name)
+            if docstring:
+                callees.append(f"- {name}: {docstring.strip().splitlines()[0]}")
+        context = ""
+        if callees:
+            context = CONTEXT.format(callees="\n".join(callees[:self.max_callees]))
+        return DOC_PROMPT.format(kind=definition.kind, name=definition.qualname,
+                                 context=context, source=definition.source)
+
+    def __document(self, definition) -> None:
+        message = self.prompt(definition)
+        if self.limit is not None and len(message) > self.limit:
+            definition.error = f"prompt too long ({len(message)} > {self.limit})"
+            return
+        try:
+            definition.docstring = clean(self.send(message))
+        except Exception as e:
+            definition.error = str(e)
+            Logger("Unable to document %s: %r", definition.qualname, e)
+            return
+        self.sent += 1
+        self.cache.set(digest(self.bot, definition.source), definition.docstring)
+
+    def run(self, path) -> List[Definition]:
+        definitions = [d for file in python_files(path) for d in parse(file)]
+        for definition in definitions:
+            if definition.documented:
+                self.__docstrings[definition.name] = definition.docstring
+        todo = [d for d in definitions if not d.documented]
+        done = 0
+        if self.progress is not None:
+            self.progress(0, len(todo))
+        with ThreadPoolExecutor(max(1, self.concurrency)) as executor:
+            for level in order(todo):
+                misses = []
+                for definition in level:
+                    docstring = self.cache.get(digest(self.bot, definition.source))
+                    if docstring is None:
+                        misses.append(definition)
+                    else:
+                        definition.docstring = docstring
+                        definition.cached = True
+                done += len(level) - len(misses)
+                for _ in executor.map(self.__document, misses):
+                    done += 1
+                    if self.progress is not None:
+                        self.progress(done, len(todo))
+                for definition in level:
+                    if definition.docstring:
+                        self.__docstrings[definition.name] = definition.docstring
+                if misses:
+                    self.cache.save()
+        return todo
+
+
+def format_docstring(docstring, indent) -> str:
+    text = docstring.replace("\\", "\\\\").replace('"""', '\\"\\"\\"')
+    lines = text.splitlines() or [""]
+    if len(lines) == 1:
+        return f'{indent}"""{lines[0]}"""\n'
+    body = "".join(f"{indent}{line}\n" if line.strip() else "\n" for line in lines[1:])
+    return f'{indent}"""{lines[0]}\n{body}{indent}"""\n'
+
+
+def write_docstrings(definitions) -> int:
+    # inserted bottom up, so that the line numbers of the others still hold
+    by_path: Dict[str, List[Definition]] = {}
+    for definition in definitions:
+        if definition.docstring and definition.indent is not None:
+            by_path.setdefault(definition.path, []).append(definition)
+    written = 0
+    for path, found in by_path.items():
+        with open(path, encoding="utf-8") as f:
+            lines = f.readlines()
+        for definition in sorted(found, key=lambda d: d.body_line, reverse=True):
+            lines.insert(definition.body_line - 1,
+                         format_docstring(definition.docstring, definition.indent))
+        # the file is left as it is rather than broken
+        try:
+            ast.parse("".join(lines), path)
+        except SyntaxError as e:
+            Logger("Docstrings not written to %s: %r", path, e)
+            print(f"<!> Docstrings not written to {path}: {e}", file=sys.stderr)
+            continue
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        written += len(found)
+    return written
+
+
+def pooled_send(client, bot) -> Callable[[str], str]:
+    # a poe.Client serves a single message at a time: each prompt over one of
+    # the spare connections of the client, kept for the next runs, in a
+    # fresh conversation
+    def send(message) -> str:
+        with client.spare() as connection:
+            connection.bot = bot
+            return connection.send_message(message, with_chat_break=True)
+
+    return send
+
+
+def arg_parser():
+    from poe_client import add_backend_arguments
+
+    parser = argparse.ArgumentParser(
+        description="Generate the missing docstrings of python files with a bot")
+    parser.add_argument("path", nargs="+", help="Python files or directories")
+    parser.add_argument(
+        "-t", "--token", help="POE Token fetch from poe.com cookies", required=True)
+    parser.add_argument("-b", "--bot", help="Bot name", default="capybara")
+    parser.add_argument(
+        "-k", "--concurrency", type=int, default=4,
+        help="Prompts sent at once, over up to 4 connections")
+    parser.add_argument(
+        "--write", action="store_true", help="Insert the docstrings in the files")
+    parser.add_argument(
+        "--cache", default=default_docstrings_path(),
+        help="Generated docstrings, by source digest (empty to disable)")
+    parser.add_argument("-l", "--log", type=str, help="Log file")
+    add_backend_arguments(parser)
+    return parser.parse_args()
+
+
+def run_test():
+    import tempfile
+
+    source = (
+        "def leaf(x):\n    return x * 2\n\n\n"
+        "def middle(x):\n    \"\"\"Double twice.\"\"\"\n    return leaf(leaf(x))\n\n\n"
+        "class Top:\n    def run(self, x):\n        return middle(x) + leaf(x)\n\n"
+        "    def one(self): return 1\n\n\n"
+        "class Value:\n    @property\n    @staticmethod\n    def x(): return 1\n"
+    )
+    sent = []
+
+    def send(message):
+        sent.append(message)
+        name = re.search(r"`(.*?)`", message).group(1)
+        return f'```\n"""Docstring of {name}."""\n```'
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "module.py")
+        with open(path, "w") as f:
+            f.write(source)
+        cache = DocCache(os.path.join(directory, "docstrings.json"))
+        todo = DocGen(send, "capybara", cache, concurrency=2).run(directory)
+        assert [d.qualname for d in todo] == [
+            "leaf", "Top", "Top.run", "Top.one", "Value", "Value.x"]
+        assert todo[0].docstring == "Docstring of leaf.", todo[0].docstring
+        # callees first, with their docstring as context
+        run = next(message for message in sent if "`Top.run`" in message)
+        assert sent.index(run) > 0 and "- leaf: Docstring of leaf." in run, run
+        assert "- middle: Double twice." in run, run
+        assert len(sent) == 6 and write_docstrings(todo) == 4
+        ast.parse(open(path).read())
+        assert '    """Docstring of leaf."""\n    return x * 2' in open(path).read()
+        # before the decorators of the first statement
+        assert '    """Docstring of Value."""\n    @property' in open(path).read()
+        # a docstring that would break the file is not written
+        text = open(path).read()
+        broken = parse(path)[0]
+        broken.docstring, broken.indent = "Misplaced.", "  "
+        assert write_docstrings([broken]) == 0 and open(path).read() == text
+
+        with open(path, "w") as f:
+            f.write(source.replace("x * 2", "x * 3"))
+        sent.clear()
+        todo = DocGen(send, "capybara", DocCache(cache.path)).run(path)
+        assert len(sent) == 1 and "`leaf`" in sent[0], sent
+        assert sum(d.cached for d in todo) == 5
+    assert format_docstring('a\n\nb """c"""', "  ") == '  """a\n\n  b \\"\\"\\"c\\"\\"\\"\n  """\n'
+    print("All tests passed, well done!")
+
+
+if __name__ == "__main__":
+    from poe_client import Poe, backend_from_spec
+
+    args = arg_parser()
+    if args.log:
+        Logger.is_active = True
+        Logger.set_file(args.log)
+    client = Poe(args.token, connect=False, client_factory=backend_from_spec(args.backend))
+    generator = DocGen(pooled_send(client, args.bot), args.bot,
+                       DocCache(args.cache or None), args.concurrency)
+    start = time.perf_counter()
+    definitions = [d for path in args.path for d in generator.run(path)]
+    for definition in definitions:
+        print(json.dumps(definition.as_dict()))
+    written = write_docstrings(definitions) if args.write else 0
+    print(f"{len(definitions)} undocumented definitions, {generator.sent} sent, "
+          f"{written} docstrings written in {time.perf_counter() - start:.1f}s",
+          file=sys.stderr)
@@ -0,0 +1,170 @@
+import random
+import time
+from collections import deque
+from typing import Dict, List
+
+SAMPLE_REPLY = """## Answer
+
+Here is a short explanation, with a **bold** word and some `inline code`.
+
+- first point of the list
+- second point, a bit longer than the first one
+  1. nested item
+  2. another nested item
+
+```python
+def fibonacci(n):
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a
+```
+
+> A quote to finish the section.
+
+"""
+
+# messages on the page of a bot
+HISTORY_PAGE = 20
+
+
+class FakeClient:
+    # Offline stand-in for poe.Client, replies by echoing the message back
+    # word by word. Everything is deterministic for a given seed: the reply
+    # (echo, or reply_size characters of markdown), the chunk size, the delay
+    # before the first chunk and between chunks, the failed messages
+    # (error_rate), the replies stalling slow_delay before their first chunk
+    # (slow_rate), the rate limit (rate_limit messages per rate_window) and
+    # the suggested replies, written suggest_delay after a reply.
+    __instances = 0
+    # the rate limit is per account, as on poe.com
+    __sent: Dict[str, deque] = {}
+
+    def __init__(self, token, bots=None, delay=0.0, max_length=None,
+                 chunk_size=None, first_delay=0.0, reply_size=None,
+                 error_rate=0.0, slow_rate=0.0, slow_delay=1.0,
+                 rate_limit=None, rate_window=60.0, suggest_delay=0.0,
+                 seed=0) -> None:
+        self.token = token
+        self.delay = delay
+        self.max_length = max_length
+        self.chunk_size = chunk_size
+        self.first_delay = first_delay
+        self.reply_size = reply_size
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.suggest_delay = suggest_delay
+        self.bot_names: Dict[str, str] = bots or {
+            "capybara": "Sage",
+            "a2": "Claude-instant",
+            "chinchilla": "ChatGPT",
+        }
+        self.chat_breaks: Dict[str, int] = {}
+        self.history: Dict[str, List[Dict]] = {}
+        self.active = 0
+        self.messages = 0
+        # clients created in the same order fail the same messages
+        FakeClient.__instances += 1
+        self.__random = random.Random(f"{seed}-{FakeClient.__instances}")
+
+    def get_bots(self, download_next_data=True):
+        return {bot: {"defaultBotObject": {"nickname": bot, "displayName": name}}
+                for bot, name in self.bot_names.items()}
+
+    def reply(self, message) -> str:
+        if self.reply_size is None:
+            return message
+        count = self.reply_size // len(SAMPLE_REPLY) + 1
+        return (SAMPLE_REPLY * count)[:self.reply_size]
+
+    def chunks(self, text):
+        if self.chunk_size is None:
+            words = text.split(" ")
+            return [words[0]] + [f" {word}" for word in words[1:]]
+        return [text[i:i + self.chunk_size]
+                for i in range(0, len(text), self.chunk_size)]
+
+    def __check_rate_limit(self, chatbot):
+        if self.rate_limit is None:
+            return
+        now = time.monotonic()
+        sent = FakeClient.__sent.setdefault(self.token, deque())
+        while sent and sent[0] <= now - self.rate_window:
+            sent.popleft()
+        if len(sent) >= self.rate_limit:
+            raise RuntimeError(f"Daily limit reached for {chatbot}.")
+        sent.append(now)
+
+    def send_message(self, chatbot, message, with_chat_break=False, timeout=20):
+        if chatbot not in self.bot_names:
+            raise RuntimeError(f"Unknown bot {chatbot}")
+        if self.max_length is not None and len(message) > self.max_length:
+            raise RuntimeError("Message too long.")
+        self.__check_rate_limit(chatbot)
+        self.messages += 1
+        if self.error_rate and self.__random.random() < self.error_rate:
+            raise RuntimeError("Response timed out.")
+        slow = self.slow_rate and self.__random.random() < self.slow_rate
+        self.active += 1
+        try:
+            if self.first_delay:
+                time.sleep(self.first_delay)
+            if slow:
+                time.sleep(self.slow_delay)
+            text = ""
+            for index, text_new in enumerate(self.chunks(self.reply(message))):
+                if self.delay and index:
+                    time.sleep(self.delay)
+                text += text_new
+                yield {
+                    "messageId": 1,
+                    "state": "incomplete",
+                    "text": text,
+                    "text_new": text_new,
+                    "author": chatbot,
+                }
+            self.history.setdefault(chatbot, []).append({
+                "messageId": self.messages,
+                "text": text,
+                "authorNickname": chatbot,
+                "creationTime": time.time(),
+                "suggestedReplies": self.suggestions(text),
+            })
+        finally:
+            self.active -= 1
+
+    def suggestions(self, text) -> List[str]:
+        words = sorted({word.strip(".,!?*`#") for word in text.split()}, key=len)
+        return [f"Tell me more about {word}" for word in words[-3:][::-1] if word]
+
+    def get_bot(self, display_name):
+        # the chat of the bot's page, its last messages oldest first
+        chatbot = next(bot for bot, name in self.bot_names.items() if name == display_name)
+        page = self.history.get(chatbot, [])[-HISTORY_PAGE:]
+        return {"messagesConnection": {"edges": self.__edges(page)}}
+
+    def get_message_history(self, chatbot, count=25, cursor=None):
+        # as poe-api 0.3.0: the first count messages of the bot's page, the
+        # last ones oldest first, then the messages before them if any left
+        history = self.history.get(chatbot, [])
+        page = history[-HISTORY_PAGE:]
+        older = history[:len(history) - len(page)]
+        messages = page[:count]
+        if count > len(page):
+            messages = older[max(len(older) - (count - len(page)), 0):] + messages
+        return self.__edges(messages)
+
+    def __edges(self, messages):
+        edges = []
+        for message in messages:
+            node = dict(message)
+            if time.time() - node["creationTime"] < self.suggest_delay:
+                node["suggestedReplies"] = []
+            edges.append({"node": node, "cursor": str(node["messageId"])})
+        return edges
+
+    def send_chat_break(self, chatbot):
+        self.chat_breaks[chatbot] = self.chat_breaks.get(chatbot, 0) + 1
@@ -0,0 +1,119 @@
+import textwrap
+import threading
+from typing import Callable, Dict, List, Optional
+
+from poe_client import PoeError
+
+
+class Reply:
+    def __init__(self, bot, request) -> None:
+        self.bot = bot
+        self.request = request
+        self.chunks: List[str] = []
+        self.error: Optional[str] = None
+        self.done = False
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    @property
+    def latency(self) -> str:
+        if self.error is not None:
+            return self.error
+        request = self.request
+        if request.ttfc is None:
+            return "waiting..."
+        if request.duration is None:
+            return f"first chunk {request.ttfc:.2f}s, {request.chars} chars"
+        return (f"first chunk {request.ttfc:.2f}s, {request.duration:.2f}s, "
+                f"{request.chars} chars")
+
+
+class FanOut:
+    # Sends a prompt to several bots at once. A poe.Client serves a single
+    # message at a time, so every bot gets its own connection of the same
+    # account, kept for the next questions.
+    def __init__(self, client) -> None:
+        self.__client = client
+        self.__clients: Dict = {}
+        self.__lock = threading.Lock()
+
+    def client(self, bot):
+        with self.__lock:
+            client = self.__clients.get(bot)
+            if client is None:
+                client = self.__clients[bot] = self.__client.spawn()
+                client.bot = bot
+        if not client.connected:
+            client.connect()
+        return client
+
+    def check(self, bots) -> None:
+        known = self.__client.bots
+        unknown = [bot for bot in bots if known and bot not in known]
+        if unknown:
+            raise PoeError(f"Unknown bot {', '.join(unknown)}")
+        if len(set(bots)) != len(bots):
+            raise PoeError("A bot can only be asked once at a time")
+
+    def ask(self, bots, text, on_chunk: Optional[Callable] = None,
+            record: Optional[Callable] = None, cancelled=None) -> List[Reply]:
+        # on_chunk(reply) after every chunk, record(bot, chunks) wraps the
+        # chunks (history), cancelled: a threading.Event
+        self.check(bots)
+        replies = [Reply(bot, self.__client.metrics.request(bot)) for bot in bots]
+
+        def run(reply):
+            chunks = None
+            try:
+                client = self.client(reply.bot)
+                chunks = client.send_message_generator(text, reply.request)
+                stream = record(reply.bot, chunks) if record else chunks
+                for chunk in stream:
+                    if cancelled is not None and cancelled.is_set():
+                        reply.error = "cancelled"
+                        if stream is not chunks:
+                            stream.close()
+                        break
+                    reply.chunks.append(chunk)
+                    if on_chunk is not None:
+                        on_chunk(reply)
+            except Exception as e:
+                reply.error = str(e)
+            finally:
+                if chunks is not None:
+                    for _ in chunks:  # the connection serves nothing else before
+                        pass
+                reply.done = True
+                if on_chunk is not None:
+                    on_chunk(reply)
+
+        threads = [threading.Thread(target=run, args=(reply,), daemon=True)
+                   for reply in replies]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return replies
+
+
+def side_by_side(bots, replies, width, height=8) -> str:
+    # the last lines of the replies (bot -> Reply, once started) in columns,
+    # for a terminal whose screen belongs to the prompt
+    if not bots:
+        return ""
+    column = max((width - 3 * (len(bots) - 1)) // len(bots), 8)
+    columns = []
+    for bot in bots:
+        reply = replies.get(bot)
+        text = reply.text if reply is not None else ""
+        lines: List[str] = []
+        # the tail is enough to fill the column
+        for line in text[-column * height * 2:].split("\n"):
+            lines.extend(textwrap.wrap(line, column) or [""])
+        latency = reply.latency if reply is not None else "waiting..."
+        title = f"{bot}: {latency}"[:column]
+        columns.append([title.ljust(column)] + [
+            line.ljust(column) for line in ([""] * height + lines)[-height:]])
+    return "\n".join(" | ".join(row).rstrip() for row in zip(*columns))
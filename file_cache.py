@@ -0,0 +1,345 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, Optional, Tuple
+
+from logger import Logger
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT = struct.Struct("iIII")
+
+
+class Watcher:
+    # inotify through the libc, on the directories rather than the files so
+    # that an editor replacing a file by a rename is seen too.
+    # on_change(path) is called with the directory itself when it is
+    # removed, and with None when events were lost; from a daemon thread,
+    # or from drain() which handles the events already queued: the kernel
+    # queues them before the write returns.
+    def __init__(self, on_change) -> None:
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.__fd = self.__libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.__on_change = on_change
+        self.__directories: Dict[int, str] = {}
+        self.__watches: Dict[str, int] = {}
+        self.__lock = threading.Lock()
+        # events are read and handled by one thread at a time
+        self.__drain_lock = threading.Lock()
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def __len__(self) -> int:
+        return len(self.__watches)
+
+    def watch(self, directory) -> bool:
+        with self.__lock:
+            if directory in self.__watches:
+                return True
+            wd = self.__libc.inotify_add_watch(
+                self.__fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                # ENOSPC once max_user_watches is reached
+                return False
+            self.__directories[wd] = directory
+            self.__watches[directory] = wd
+        return True
+
+    def unwatch(self, directory) -> None:
+        with self.__lock:
+            wd = self.__watches.pop(directory, None)
+            if wd is None:
+                return
+            # its last events and IN_IGNORED are dropped
+            del self.__directories[wd]
+            self.__libc.inotify_rm_watch(self.__fd, wd)
+
+    def __run(self) -> None:
+        while True:
+            select.select([self.__fd], [], [])
+            self.drain()
+
+    def drain(self) -> None:
+        with self.__drain_lock:
+            while True:
+                try:
+                    data = os.read(self.__fd, 64 * 1024)
+                except BlockingIOError:
+                    return
+                self.__handle(data)
+
+    def __handle(self, data) -> None:
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            start = offset + EVENT.size
+            name = data[start:start + length].rstrip(b"\0")
+            offset = start + length
+            if mask & IN_Q_OVERFLOW:
+                self.__on_change(None)
+                continue
+            with self.__lock:
+                directory = self.__directories.get(wd)
+                if mask & IN_IGNORED and directory is not None:
+                    del self.__directories[wd]
+                    del self.__watches[directory]
+            if directory is None:
+                continue
+            if name:
+                self.__on_change(os.path.join(directory, os.fsdecode(name)))
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                self.__on_change(directory)
+
+
+def _stamp(path) -> Tuple[int, int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+class _Entry:
+    __slots__ = ("stamp", "text", "size", "watched")
+
+    def __init__(self, stamp, text, size, watched) -> None:
+        self.stamp = stamp
+        self.text = text
+        self.size = size
+        self.watched = watched
+
+
+class FileCache:
+    # Decoded file contents keyed on (path, selected range), validated by the
+    # file's (mtime, size, inode), least recently used out beyond max_size
+    # bytes read. Where inotify works the entries of watched directories are
+    # trusted until an event drops them, the queued events being handled
+    # first: a hit costs one read of the inotify descriptor instead of a
+    # stat. A directory is watched while entries of it are cached.
+    def __init__(self, max_size=32 * 1024 * 1024, watch=True) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.__entries: OrderedDict = OrderedDict()
+        self.__lock = threading.Lock()
+        # changes seen while a file is being read, the read is then not cached
+        self.__reading: Counter = Counter()
+        self.__changes: Counter = Counter()
+        self.__watch = watch and sys.platform.startswith("linux")
+        self.__watcher: Optional[Watcher] = None
+        # watched directory -> entries and reads in progress in it
+        self.__watched: Counter = Counter()
+
+    def read(self, path, selection, load) -> Tuple[str, int, bool]:
+        # load(path, selection) returns the text and the number of bytes read;
+        # returns the text, that size, and whether it came from the cache
+        if not self.max_size:
+            return (*load(path, selection), False)
+        path = os.path.abspath(path)
+        key = (path, selection)
+        with self.__lock:
+            entry = self.__entries.get(key)
+        if entry is not None and entry.watched:
+            # the writes made until now are seen
+            self.__watcher.drain()
+            with self.__lock:
+                entry = self.__entries.get(key)
+                if entry is not None:
+                    return self.__hit(key, entry)
+        elif self.__watcher is not None:
+            # the events of the writes made before it is read do not drop it
+            self.__watcher.drain()
+        stamp = _stamp(path)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if entry.stamp == stamp:
+                    return self.__hit(key, entry)
+                self.__drop(key)
+                self.invalidations += 1
+            self.misses += 1
+            self.__reading[path] += 1
+            changes = self.__changes[path]
+            directory = os.path.dirname(path)
+            # kept watched while it is read
+            self.__watched[directory] += 1
+        cached = False
+        try:
+            watched = self.__watch_directory(directory)
+            text, size = load(path, selection)
+            try:
+                unchanged = _stamp(path) == stamp
+            except OSError:
+                unchanged = False
+            with self.__lock:
+                if unchanged and self.__changes[path] == changes and size <= self.max_size:
+                    if key in self.__entries:
+                        self.__drop(key)
+                    self.__entries[key] = _Entry(stamp, text, size, watched)
+                    self.size += size
+                    cached = watched
+                    self.__evict()
+        finally:
+            with self.__lock:
+                self.__reading[path] -= 1
+                if not self.__reading[path]:
+                    del self.__reading[path]
+                    self.__changes.pop(path, None)
+                if not cached:
+                    self.__release(directory)
+        return text, size, False
+
+    def __hit(self, key, entry) -> Tuple[str, int, bool]:
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        return entry.text, entry.size, True
+
+    def __drop(self, key) -> None:
+        entry = self.__entries.pop(key)
+        self.size -= entry.size
+        if entry.watched:
+            self.__release(os.path.dirname(key[0]))
+
+    def __release(self, directory) -> None:
+        self.__watched[directory] -= 1
+        if self.__watched[directory] <= 0:
+            del self.__watched[directory]
+            if self.__watcher is not None:
+                self.__watcher.unwatch(directory)
+
+    def __evict(self) -> None:
+        while self.size > self.max_size:
+            self.__drop(next(iter(self.__entries)))
+            self.evictions += 1
+
+    def __watch_directory(self, directory) -> bool:
+        if not self.__watch:
+            return False
+        if self.__watcher is None:
+            with self.__lock:
+                if self.__watcher is None:
+                    try:
+                        self.__watcher = Watcher(self.__changed)
+                    except (OSError, AttributeError) as e:
+                        Logger("inotify unavailable, cached files are checked with stat: %r", e)
+                        self.__watch = False
+                        return False
+        return self.__watcher.watch(directory)
+
+    def __changed(self, path) -> None:
+        with self.__lock:
+            if path is None:
+                self.invalidations += len(self.__entries)
+                for key in list(self.__entries):
+                    self.__drop(key)
+                for reading in self.__reading:
+                    self.__changes[reading] += 1
+                return
+            prefix = path + os.sep
+            for key in [key for key in self.__entries
+                        if key[0] == path or key[0].startswith(prefix)]:
+                self.__drop(key)
+                self.invalidations += 1
+            for reading in self.__reading:
+                if reading == path or reading.startswith(prefix):
+                    self.__changes[reading] += 1
+
+    @property
+    def watching(self) -> bool:
+        return self.__watcher is not None and self.__watch
+
+    def clear(self) -> None:
+        with self.__lock:
+            for key in list(self.__entries):
+                self.__drop(key)
+        self.hits = self.misses = self.invalidations = self.evictions = 0
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups * 100 if lookups else 0
+        if self.watching:
+            validation = f"inotify, {len(self.__watcher)} directories watched"
+        else:
+            validation = "mtime and size"
+        return "\n".join([
+            f"File cache ({validation})",
+            f"{len(self.__entries)} entries, {self.size / 1024:.1f} KiB / "
+            f"{self.max_size / 1024:.1f} KiB",
+            f"{self.hits} hits, {self.misses} misses ({ratio:.1f}% hit rate), "
+            f"{self.invalidations} invalidated, {self.evictions} evicted",
+        ])
+
+
+def run_test():
+    import tempfile
+
+    def load(path, selection):
+        with open(path) as f:
+            text = f.read()
+        return text, len(text)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "a.txt")
+        with open(path, "w") as f:
+            f.write("one")
+        for watch in (False, True):
+            cache = FileCache(max_size=8, watch=watch)
+            assert cache.read(path, None, load) == ("one", 3, False)
+            assert cache.read(path, None, load) == ("one", 3, True)
+            with open(path, "w") as f:
+                f.write("two!")
+            assert cache.read(path, None, load) == ("two!", 4, False), cache.stats()
+            assert cache.read(path, "1:1", load) == ("two!", 4, False)
+            other = os.path.join(directory, "b.txt")
+            with open(other, "w") as f:
+                f.write("three")
+            cache.read(other, None, load)  # 4 + 4 + 5 > 8
+            assert cache.evictions == 2 and cache.size == 5, cache.stats()
+            assert cache.read(other, None, load)[2]
+            assert not cache.read(path, None, load)[2]
+            assert cache.read(other, None, load) == ("three", 5, False)
+            os.remove(other)
+            try:
+                cache.read(other, None, load)
+                assert False, "removed file still cached"
+            except FileNotFoundError:
+                pass
+            # the same size within the same mtime tick, seen by inotify only
+            if cache.watching:
+                with open(path, "w") as f:
+                    f.write("six!")
+                assert cache.read(path, None, load)[0] == "six!"
+                cache.clear()
+                assert "0 directories watched" in cache.stats(), cache.stats()
+            with open(path, "w") as f:
+                f.write("one")
+        assert FileCache(max_size=0).read(path, None, load) == ("one", 3, False)
+    print("All tests passed, well done!")
+
+
+if __name__ == "__main__":
+    try:
+        run_test()
+    except Exception as e:
+        print(e)
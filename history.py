@@ -0,0 +1,499 @@
+import bisect
+import contextlib
+import fcntl
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional
+
+from logger import Logger
+
+# kind, payload length, exchange id
+HEADER = struct.Struct(">cIQ")
+PROMPT = b"P"  # json: time, bot, prompt, metadata
+CHUNK = b"C"  # raw utf-8 text of a reply chunk, written while streaming
+REPLY = b"R"  # json: time, reply, error, replaces the chunks once compacted
+
+__words = re.compile(r"\w{2,40}")
+
+
+def default_history_path() -> str:
+    directory = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+    return os.path.join(directory, "poe_terminal", "history.log")
+
+
+def terms(text) -> set:
+    return set(__words.findall(text.lower()))
+
+
+def _alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _contains(postings, id) -> bool:
+    index = bisect.bisect_left(postings, id)
+    return index < len(postings) and postings[index] == id
+
+
+class History:
+    # An append-only log of the exchanges, read back through mmap. Reply
+    # chunks are appended as they are received, so a crash loses nothing;
+    # they are garbage once the full reply is written and a background
+    # compaction drops them. The inverted index (term -> exchange ids, in
+    # increasing order) is rebuilt in a background thread when opening.
+    # The log is shared by the terminals and the server: records are
+    # appended under flock, after reading those the other processes
+    # appended, and a log compacted by another process is read again.
+    def __init__(self, path, compact_ratio=0.5, compact_min_size=1024 * 1024) -> None:
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self.__lock = threading.RLock()
+        self.__scanned = threading.Event()
+        self.__loaded = threading.Event()
+        self.__pending: List = []
+        self.__index: Dict[str, array] = {}
+        self.__offsets: Dict[int, List[Optional[int]]] = {}
+        self.__active: set = set()
+        self.__next_id = 1
+        self.__garbage = 0
+        self.__compacting = None
+        self.__compaction = threading.Lock()
+        self.__map = None
+        # the offsets before the log was compacted by another process
+        self.__previous: Optional[Dict] = None
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.__file = open(path, "ab")
+        self.__size = self.__file.tell()
+        threading.Thread(target=self.__load, daemon=True).start()
+
+    def __len__(self) -> int:
+        self.__loaded.wait()
+        return len(self.__offsets)
+
+    def __records(self, start=0, end=None):
+        # (kind, id, offset, payload) of the records in [start, end)
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                end = len(data) if end is None else end
+                offset = start
+                while offset + HEADER.size <= end:
+                    kind, length, id = HEADER.unpack_from(data, offset)
+                    payload_end = offset + HEADER.size + length
+                    if payload_end > end:
+                        break
+                    yield kind, id, offset, data[offset + HEADER.size:payload_end]
+                    offset = payload_end
+
+    def __headers(self, end):
+        # (kind, id, offset, payload length), without reading the payloads
+        # (a record truncated by a crash ends the scan)
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = 0
+                while offset + HEADER.size <= end:
+                    kind, length, id = HEADER.unpack_from(data, offset)
+                    if offset + HEADER.size + length > end:
+                        break
+                    yield kind, id, offset, length
+                    offset += HEADER.size + length
+
+    def __index_text(self, id, text) -> None:
+        for term in terms(text):
+            postings = self.__index.get(term)
+            if postings is None:
+                postings = self.__index[term] = array("Q")
+            if not postings or postings[-1] != id:
+                postings.append(id)
+
+    def __load(self):
+        # the headers first, appending only waits for this pass
+        start = time.perf_counter()
+        valid = 0
+        try:
+            for kind, id, offset, length in self.__headers(self.__size):
+                valid = offset + HEADER.size + length
+                if kind == PROMPT:
+                    self.__offsets[id] = [offset, None]
+                    self.__next_id = max(self.__next_id, id + 1)
+                elif kind == REPLY and id in self.__offsets:
+                    self.__offsets[id][1] = offset
+                elif kind == CHUNK:
+                    self.__garbage += HEADER.size + length
+            # a truncated record is cut by the next append, see __sync
+            self.__size = valid
+        except Exception as e:
+            Logger("Unable to read the history %s: %r", self.path, e)
+        finally:
+            self.__scanned.set()
+        # then the index, the exchanges added meanwhile are indexed after
+        try:
+            for kind, id, _, payload in self.__records(end=valid):
+                if kind == PROMPT:
+                    self.__index_text(id, json.loads(payload)["prompt"])
+                elif kind == REPLY:
+                    self.__index_text(id, json.loads(payload)["reply"])
+        except Exception as e:
+            Logger("Unable to index the history %s: %r", self.path, e)
+        finally:
+            with self.__lock:
+                for id, text in self.__pending:
+                    self.__index_text(id, text)
+                self.__pending = []
+                self.__loaded.set()
+        Logger("History: %d exchanges, %d terms loaded in %.1fms", len(self.__offsets),
+               len(self.__index), (time.perf_counter() - start) * 1000)
+
+    def __add_to_index(self, id, text) -> None:
+        with self.__lock:
+            if self.__loaded.is_set():
+                self.__index_text(id, text)
+            else:
+                self.__pending.append((id, text))
+
+    @contextlib.contextmanager
+    def __locked(self, exclusive=True):
+        # the log as the other processes left it, which do not write to it
+        # until the end of the block
+        with self.__lock:
+            while True:
+                fcntl.flock(self.__file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    replaced = os.stat(self.path).st_ino != os.fstat(self.__file.fileno()).st_ino
+                except FileNotFoundError:
+                    replaced = True
+                if not replaced:
+                    break
+                fcntl.flock(self.__file, fcntl.LOCK_UN)
+                self.__reopen()
+            try:
+                self.__sync(exclusive)
+                yield
+            finally:
+                fcntl.flock(self.__file, fcntl.LOCK_UN)
+
+    def __reopen(self) -> None:
+        # compacted by another process: the ids are the same, the offsets
+        # are read again
+        Logger("History %s compacted by another process, reloading", self.path)
+        self.__file.close()
+        self.__file = open(self.path, "ab")
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+        if self.__previous is None:
+            self.__previous = self.__offsets
+        self.__offsets = {}
+        self.__garbage = 0
+        self.__size = 0
+
+    def __sync(self, exclusive) -> None:
+        size = os.fstat(self.__file.fileno()).st_size
+        if size <= self.__size:
+            return
+        known = self.__previous if self.__previous is not None else self.__offsets
+        valid = self.__size
+        for kind, id, offset, payload in self.__records(self.__size, size):
+            valid = offset + HEADER.size + len(payload)
+            if kind == PROMPT:
+                if id not in known:
+                    self.__add_to_index(id, json.loads(payload)["prompt"])
+                self.__offsets[id] = [offset, None]
+                self.__next_id = max(self.__next_id, id + 1)
+            elif kind == REPLY and id in self.__offsets:
+                if known.get(id, [None, None])[1] is None:
+                    self.__add_to_index(id, json.loads(payload)["reply"])
+                self.__offsets[id][1] = offset
+            else:
+                self.__garbage += HEADER.size + len(payload)
+        self.__previous = None
+        self.__size = valid
+        if valid < size and exclusive:
+            # the records are written under the lock, this one was cut short
+            # by a crash
+            Logger("History: dropping %d truncated bytes", size - valid)
+            self.__file.truncate(valid)
+
+    def __append(self, kind, id, payload) -> int:
+        # under __locked
+        offset = self.__size
+        self.__file.write(HEADER.pack(kind, len(payload), id) + payload)
+        self.__file.flush()
+        self.__size += HEADER.size + len(payload)
+        return offset
+
+    def begin(self, bot, prompt, metadata=None) -> int:
+        self.__scanned.wait()
+        with self.__locked():
+            # after the ids the other processes took
+            id = self.__next_id
+            self.__next_id += 1
+            self.__active.add(id)
+            offset = self.__append(PROMPT, id, json.dumps({
+                "time": time.time(), "bot": bot, "prompt": prompt,
+                "metadata": metadata or {}, "pid": os.getpid(),
+            }).encode())
+            self.__offsets[id] = [offset, None]
+            self.__add_to_index(id, prompt)
+        return id
+
+    def chunk(self, id, text) -> None:
+        payload = text.encode()
+        with self.__locked():
+            self.__append(CHUNK, id, payload)
+            self.__garbage += HEADER.size + len(payload)
+
+    def end(self, id, reply, error=None) -> None:
+        with self.__locked():
+            offset = self.__append(REPLY, id, json.dumps({
+                "time": time.time(), "reply": reply, "error": error}).encode())
+            self.__offsets[id][1] = offset
+            self.__active.discard(id)
+            self.__add_to_index(id, reply)
+            should_compact = (
+                self.__garbage > self.compact_min_size
+                and self.__garbage > self.__size * self.compact_ratio
+                and self.__compacting is None)
+            if should_compact:
+                self.__compacting = threading.Thread(target=self.compact, daemon=True)
+                self.__compacting.start()
+
+    def __read(self, offset):
+        with self.__lock:
+            if self.__map is None or offset + HEADER.size > len(self.__map):
+                if self.__map is not None:
+                    self.__map.close()
+                with open(self.path, "rb") as f:
+                    self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _, length, _ = HEADER.unpack_from(self.__map, offset)
+            start = offset + HEADER.size
+            if start + length > len(self.__map):
+                self.__map.close()
+                self.__map = None
+                return self.__read(offset)
+            return json.loads(self.__map[start:start + length])
+
+    def get(self, id) -> Optional[Dict]:
+        self.__scanned.wait()
+        with self.__locked(exclusive=False):
+            return self.__get(id)
+
+    def __get(self, id) -> Optional[Dict]:
+        offsets = self.__offsets.get(id)
+        if offsets is None:
+            return None
+        entry = {"id": id, "reply": None, "error": None}
+        entry.update(self.__read(offsets[0]))
+        if offsets[1] is not None:
+            reply = self.__read(offsets[1])
+            entry.update(reply=reply["reply"], error=reply["error"], end=reply["time"])
+        return entry
+
+    def last(self, count=10) -> List[Dict]:
+        self.__scanned.wait()
+        with self.__locked(exclusive=False):
+            ids = sorted(self.__offsets)[-count:]
+            return [self.__get(id) for id in reversed(ids)]
+
+    def search(self, query, limit=20) -> List[Dict]:
+        # exchanges containing every term, most recent first
+        self.__loaded.wait()
+        with self.__locked(exclusive=False):
+            postings = sorted(
+                (self.__index.get(term, array("Q")) for term in terms(query)), key=len)
+            if not postings:
+                return []
+            ids = []
+            for id in reversed(postings[0]):
+                if all(_contains(other, id) for other in postings[1:]):
+                    ids.append(id)
+                    if len(ids) >= limit:
+                        break
+            return [self.__get(id) for id in ids]
+
+    def compact(self) -> None:
+        self.__loaded.wait()
+        with self.__compaction, open(f"{self.path}.lock", "wb") as lock:
+            # a single process compacts the log at a time
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.__compacting = None
+                return
+            self.__compact()
+
+    def __compact(self) -> None:
+        start = time.perf_counter()
+        with self.__locked(exclusive=False):
+            end = self.__size
+            active = set(self.__active)
+        temporary = f"{self.path}.compact"
+        offsets: Dict[int, List[Optional[int]]] = {}
+        chunks: Dict[int, List[bytes]] = {}
+        # prompts of the replies not written yet, for the process streaming them
+        prompts: Dict[int, bytes] = {}
+        with open(temporary, "wb") as out:
+            def write(kind, id, payload):
+                offset = out.tell()
+                out.write(HEADER.pack(kind, len(payload), id) + payload)
+                return offset
+
+            for kind, id, _, payload in self.__records(end=end):
+                if kind == PROMPT:
+                    offsets[id] = [write(kind, id, payload), None]
+                    prompts[id] = payload
+                elif kind == REPLY:
+                    chunks.pop(id, None)
+                    prompts.pop(id, None)
+                    if id in offsets:
+                        offsets[id][1] = write(kind, id, payload)
+                elif id in active:
+                    write(kind, id, payload)
+                else:
+                    chunks.setdefault(id, []).append(payload)
+            # replies interrupted by a crash are kept as they were received,
+            # those another process is still streaming are left as chunks
+            for id, parts in chunks.items():
+                if id not in offsets:
+                    continue
+                pid = json.loads(prompts[id]).get("pid")
+                if pid not in (None, os.getpid()) and _alive(pid):
+                    for part in parts:
+                        write(CHUNK, id, part)
+                else:
+                    offsets[id][1] = write(REPLY, id, json.dumps({
+                        "time": time.time(),
+                        "reply": b"".join(parts).decode(errors="replace"),
+                        "error": "interrupted",
+                    }).encode())
+            with self.__locked():
+                # records appended meanwhile, by any process, are copied as
+                # they are
+                shift = out.tell() - end
+                garbage = 0
+                for kind, id, offset, payload in self.__records(end, self.__size):
+                    out.write(HEADER.pack(kind, len(payload), id) + payload)
+                    if kind == PROMPT:
+                        offsets[id] = [offset + shift, None]
+                    elif kind == REPLY and id in offsets:
+                        offsets[id][1] = offset + shift
+                    else:
+                        garbage += HEADER.size + len(payload)
+                out.flush()
+                size = out.tell()
+                before = self.__size
+                os.replace(temporary, self.path)
+                self.__file.close()
+                self.__file = open(self.path, "ab")
+                if self.__map is not None:
+                    self.__map.close()
+                    self.__map = None
+                self.__offsets = offsets
+                self.__size = size
+                self.__garbage = garbage
+                self.__compacting = None
+        Logger("History compacted from %d to %d bytes in %.1fms",
+               before, size, (time.perf_counter() - start) * 1000)
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__file.close()
+            if self.__map is not None:
+                self.__map.close()
+                self.__map = None
+
+    def show(self, entries) -> str:
+        if not entries:
+            return "No message found"
+        lines = []
+        for entry in entries:
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["time"]))
+            reply = (entry["reply"] or entry["error"] or "").strip().replace("\n", " ")
+            lines.append(f"#{entry['id']} {when} {entry['bot']}: {entry['prompt'].strip()}")
+            lines.append(f"    {reply[:200]}{'...' if len(reply) > 200 else ''}")
+        return "\n".join(lines)
+
+
+def add_history_arguments(parser) -> None:
+    parser.add_argument(
+        "--history", nargs="?", const=default_history_path(), metavar="PATH",
+        help="Record the prompts and replies in a log file "
+             "(default: ~/.local/share/poe_terminal/history.log)")
+
+
+def history_from_args(args) -> Optional[History]:
+    if not args.history:
+        return None
+    return History(args.history)
+
+
+def run_test():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "history.log")
+        history = History(path, compact_min_size=0)
+        for index in range(50):
+            id = history.begin("capybara", f"question {index} about python")
+            for word in f"answer number {index} with some words".split(" "):
+                history.chunk(id, word + " ")
+            if index % 10 == 9:
+                history.end(id, f"answer number {index} with some words")
+        crashed = history.begin("a2", "interrupted question")
+        history.chunk(crashed, "partial ")
+        assert [e["id"] for e in history.search("python question 17")] == [18]
+        assert history.search("answer 19")[0]["reply"].startswith("answer number 19")
+        assert history.search("unknown") == []
+        history.close()
+
+        # reopened: the last exchange crashed, the others are garbage chunks
+        history = History(path, compact_min_size=0)
+        assert len(history) == 51, len(history)
+        size = os.path.getsize(path)
+        history.compact()
+        assert os.path.getsize(path) < size
+        assert history.get(crashed)["reply"] == "partial "
+        assert history.get(crashed)["error"] == "interrupted"
+        assert history.get(10)["reply"] == "answer number 9 with some words"
+        id = history.begin("capybara", "after compaction")
+        history.end(id, "still searchable")
+        assert history.search("searchable")[0]["id"] == id == 52
+        assert history.last(2)[1]["id"] == crashed
+
+        # another process on the same log: ids are not reused, compactions
+        # are seen
+        other = History(path, compact_min_size=0)
+        first = other.begin("a2", "from the other one")
+        second = history.begin("capybara", "from the first one")
+        assert (first, second) == (53, 54)
+        other.end(first, "other reply")
+        history.end(second, "first reply")
+        other.compact()
+        assert history.get(first)["reply"] == "other reply"
+        assert history.search("first reply")[0]["id"] == second
+        assert other.begin("a2", "after") == history.begin("a2", "again") - 1
+        other.close()
+        history.close()
+    print("All tests passed, well done!")
+
+
+if __name__ == "__main__":
+    try:
+        run_test()
+    except Exception as e:
+        print(e)
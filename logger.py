@@ -1,69 +1,155 @@
-import inspect
-import os
-from datetime import date
-
-from singleton import Singleton
-
-
-def strftime(format):
-    return date.today().strftime(format)
-
-
-@Singleton
-class Logger:
-    __file = None
-    __is_active = False
-
-    def __init__(self) -> None:
-        # if not os.path.isdir("logs"):
-        #    os.mkdir("logs")
-        # date = strftime("%Y-%m-%d")
-        # self.__file = open(f"logs/poe_client-{date}.log", "a")
-        # self.__file = open("client_poe.log", "a")
-        self.__file = open("client_poe.log", "w")
-
-    def __del__(self):
-        if self.__file is not None:
-            self.__file.close()
-
-    def set_file(self, file):
-        if self.__file is not None:
-            self.__file.close()
-        self.__file = open(file, "w")
-
-    def set_active(self, is_active):
-        self.__is_active = is_active
-
-    def get_active(self):
-        return self.__is_active
-
-    @property
-    def is_active(self):
-        return self.get_active()
-
-    @is_active.setter
-    def is_active(self, is_active):
-        self.set_active(is_active)
-
-    def __call__(self, message):
-        if not self.__is_active:
-            return
-        try:
-            python_inspect = inspect.stack()[1]
-            python_filename = python_inspect.filename.split("/")[-1]
-            python_line = python_inspect.lineno
-            python_function = python_inspect.function
-            if type(message) == list:
-                message = "\n".join(message)
-            self.__file.write(
-                f"[{strftime('%Y-%m-%d %H:%M:%S')}] \
-            <{python_filename}|{python_function}|{python_line}>\n{message}\n"
-            )
-            self.__file.flush()
-        except Exception as e:
-            if hasattr(message, "__repr__"):
-                self.__call__(message.__repr__())
-            elif hasattr(message, "__str__"):
-                self.__call__(message.__str__())
-            else:
-                self.__call__(f"<!>(no __repr__ or __str__ method found) {e}")
+import atexit
+import os
+import queue
+import sys
+import threading
+import time
+
+from singleton import Singleton
+
+
+@Singleton
+class Logger:
+    __file = None
+    __file_name = "client_poe.log"
+    __is_active = False
+    __overflow = "drop"
+    __batch_size = 256
+    __queue_size = 8192
+
+    def __init__(self) -> None:
+        self.__sites = {}
+        self.__queue = queue.Queue(self.__queue_size)
+        self.__file_lock = threading.Lock()
+        self.__thread = None
+        # the log is truncated when first opened, appended to when reopened
+        # after close
+        self.__reopen = False
+        self.dropped = 0
+        atexit.register(self.close)
+
+    def __del__(self):
+        if self.__file is not None:
+            self.__file.close()
+
+    def set_file(self, file):
+        self.flush()
+        with self.__file_lock:
+            if self.__file is not None:
+                self.__file.close()
+            self.__file_name = file
+            self.__file = open(file, "w")
+            self.__reopen = True
+
+    def set_active(self, is_active):
+        self.__is_active = is_active
+
+    def get_active(self):
+        return self.__is_active
+
+    @property
+    def is_active(self):
+        return self.get_active()
+
+    @is_active.setter
+    def is_active(self, is_active):
+        self.set_active(is_active)
+
+    def set_overflow(self, overflow):
+        # "drop" never slows the caller down, "block" never loses a message
+        if overflow not in ("drop", "block"):
+            raise ValueError(f"Invalid overflow policy '{overflow}'")
+        self.__overflow = overflow
+
+    def __call__(self, message, *args):
+        if not self.__is_active:
+            return
+        frame = sys._getframe(1)
+        code = frame.f_code
+        site = self.__sites.get(code)
+        if site is None:
+            site = self.__sites[code] = (
+                os.path.basename(code.co_filename),
+                code.co_name,
+            )
+        record = (time.time(), site, frame.f_lineno, message, args)
+        if self.__thread is None:
+            self.__start()
+        if self.__overflow == "block":
+            self.__queue.put(record)
+        else:
+            try:
+                self.__queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+    def flush(self):
+        if self.__thread is not None:
+            self.__queue.join()
+
+    def close(self):
+        if self.__thread is not None:
+            self.__queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+        with self.__file_lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+    def __start(self):
+        with self.__file_lock:
+            if self.__thread is not None:
+                return
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+
+    def __run(self):
+        while True:
+            records = [self.__queue.get()]
+            while len(records) < self.__batch_size:
+                try:
+                    records.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in records
+            try:
+                self.__write(records)
+            except Exception as e:
+                # the records are lost, flush() and the callers must not wait
+                print(f"<!> Unable to write to {self.__file_name}: {e}", file=sys.stderr)
+            finally:
+                for _ in records:
+                    self.__queue.task_done()
+            if stop:
+                return
+
+    def __write(self, records):
+        with self.__file_lock:
+            if self.__file is None:
+                self.__file = open(self.__file_name, "a" if self.__reopen else "w")
+                self.__reopen = True
+            self.__file.write("".join(
+                self.__format(record) for record in records
+                if record is not None
+            ))
+            if self.dropped:
+                self.__file.write(f"<!> {self.dropped} messages dropped\n")
+                self.dropped = 0
+            self.__file.flush()
+
+    def __format(self, record):
+        timestamp, (filename, function), line, message, args = record
+        try:
+            if callable(message):
+                message = message()
+            if type(message) == list:
+                message = "\n".join(message)
+            if args:
+                message = message % args
+            else:
+                message = str(message)
+        except Exception as e:
+            message = f"<!>(unable to format {message!r} with {args!r}) {e}"
+        now = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+        return f"[{now}] <{filename}|{function}|{line}>\n{message}\n"
@@ -0,0 +1,207 @@
+import re
+
+from rich.console import Group  # type: ignore
+from rich.markdown import (  # type: ignore
+    BlockQuote,
+    CodeBlock,
+    ListElement,
+    ListItem,
+    Markdown,
+    UnknownElement,
+)
+from rich.syntax import Syntax  # type: ignore
+from rich.text import Text  # type: ignore
+
+# the opening line of a fenced code block at the top level
+FENCE = re.compile(r"(`{3,}|~{3,})\s*([^`\s]*)[^`]*$")
+
+
+class MarkdownStream:
+    __containers = (BlockQuote, ListElement, ListItem)
+
+    def __init__(self, live) -> None:
+        self.__live = live
+        self.__tail = ""
+        # (marker, lexer, theme) of the open code block whose lines are
+        # printed as they complete, the tail being its partial last line
+        self.__fence = None
+        self.__blank_lines = 0
+        self.__code_lines = 0
+        # a code block was printed, the blank line after it is not yet
+        self.__after_code = False
+
+    @property
+    def text(self) -> str:
+        return self.__tail
+
+    def feed(self, text_chunk) -> None:
+        self.__tail += text_chunk
+        if self.__fence is not None and not self.__feed_code():
+            return
+        md = Markdown(self.__tail)
+        cut = self.__find_cut(md)
+        if cut is not None:
+            line, new_line = cut
+            lines = self.__tail.split("\n")
+            self.__print_new_line(md)
+            self.__live.console.print(Markdown("\n".join(lines[:line])))
+            if new_line:
+                self.__live.console.print()
+            self.__tail = "\n".join(lines[line:])
+            md = Markdown(self.__tail)
+        if self.__open_code(md):
+            self.__feed_code()
+            return
+        if self.__after_code and self.__new_line(md):
+            self.__live.update(Group(Text(), md))
+        else:
+            self.__live.update(md)
+
+    def __open_code(self, md) -> bool:
+        # a code block left open as the only block of the tail, with a line
+        # complete after its opening one
+        blocks = [token for token in md.parsed if token.level == 0 and token.nesting >= 0]
+        if len(blocks) != 1 or blocks[0].type != "fence":
+            return False
+        lines = self.__tail.split("\n")
+        match = FENCE.match(lines[0])
+        if match is None or len(lines) < 3:
+            return False
+        marker = match.group(1)
+        if any(self.__closes(line, marker) for line in lines[1:-1]):
+            return False
+        self.__print_new_line(md)
+        self.__fence = (marker, match.group(2) or "default", md.code_theme)
+        self.__code_lines = 0
+        self.__tail = "\n".join(lines[1:])
+        # the padding line above the code
+        self.__live.console.print(self.__syntax(""))
+        return True
+
+    def __feed_code(self) -> bool:
+        # prints the complete lines of the code block, returns whether it
+        # was closed, the rest of the tail being markdown again
+        marker = self.__fence[0]
+        *lines, self.__tail = self.__tail.split("\n")
+        for index, line in enumerate(lines):
+            if self.__closes(line, marker):
+                # the trailing blank lines are dropped, as by rich, which
+                # still shows a line for an empty block
+                if not self.__code_lines:
+                    self.__live.console.print(self.__syntax(""))
+                self.__live.console.print(self.__syntax(""))
+                self.__fence = None
+                self.__blank_lines = 0
+                self.__after_code = True
+                self.__tail = "\n".join(lines[index + 1:] + [self.__tail])
+                return True
+            if not line.strip():
+                self.__blank_lines += 1
+                continue
+            for _ in range(self.__blank_lines):
+                self.__live.console.print(self.__syntax(""))
+            self.__blank_lines = 0
+            self.__live.console.print(self.__syntax(line))
+            self.__code_lines += 1
+        # with the padding line below, if the reply ends there
+        if self.__tail.strip() or not self.__code_lines:
+            self.__live.update(Group(self.__syntax(self.__tail), self.__syntax("")))
+        else:
+            self.__live.update(self.__syntax(""))
+        return False
+
+    def __syntax(self, line) -> Syntax:
+        _, lexer, theme = self.__fence
+        return Syntax(line, lexer, theme=theme, word_wrap=True, padding=(0, 1))
+
+    @staticmethod
+    def __closes(line, marker) -> bool:
+        # indented by 4 spaces or more it is code
+        stripped = line.strip()
+        return (len(line) - len(line.lstrip(" ")) < 4 and stripped.startswith(marker)
+                and not stripped.strip(marker[0]))
+
+    def __new_line(self, md) -> bool:
+        # whether rich writes a blank line between the code block and the
+        # blocks of the tail
+        blocks = [index for index, token in enumerate(md.parsed)
+                  if token.level == 0 and token.nesting >= 0]
+        if not blocks:
+            return False
+        end = blocks[1] if len(blocks) > 1 else len(md.parsed)
+        return CodeBlock.new_line and self.__inherits_new_line(md.parsed[blocks[0]:end])
+
+    def __print_new_line(self, md) -> None:
+        if self.__after_code:
+            if self.__new_line(md):
+                self.__live.console.print()
+            self.__after_code = False
+
+    def __find_cut(self, md):
+        blocks = [
+            index for index, token in enumerate(md.parsed)
+            if token.level == 0 and token.nesting >= 0 and token.map
+        ]
+        blocks.append(len(md.parsed))
+        line_count = self.__tail.count("\n") + 1
+        # A block is only frozen once the first line of the following block
+        # is complete, so "1. a\n\n2" can not be split before "2. b" arrives.
+        for i in range(len(blocks) - 2, 0, -1):
+            line = md.parsed[blocks[i]].map[0]
+            if line_count > line + 1:
+                previous = md.parsed[blocks[i - 1]]
+                element = Markdown.elements.get(previous.type, UnknownElement)
+                new_line = element.new_line and self.__inherits_new_line(
+                    md.parsed[blocks[i]:blocks[i + 1]])
+                return line, new_line
+        return None
+
+    def __inherits_new_line(self, tokens) -> bool:
+        # rich writes the blank line between blocks from the state left by the
+        # last closed element, so the previous block only matters if the first
+        # element closed in this one is rendered before a container (list,
+        # quote) swallows it and overwrites that state.
+        stack = []
+        for token in self.__flatten(tokens):
+            if token.type in ("text", "hardbreak", "softbreak", "link_open", "link_close"):
+                continue
+            if token.tag in Markdown.inlines and token.type not in ("fence", "code_block"):
+                continue
+            if token.nesting == 1:
+                stack.append(Markdown.elements.get(token.type, UnknownElement))
+                continue
+            if token.nesting == -1:
+                stack.pop()
+            return not stack or not issubclass(stack[-1], self.__containers)
+        return True
+
+    def __flatten(self, tokens):
+        for token in tokens:
+            if token.children and not (token.type == "fence" or token.tag == "img"):
+                yield from self.__flatten(token.children)
+            else:
+                yield token
+
+
+class BlockLive:
+    # Stands for rich's Live when the screen belongs to a prompt: only the
+    # finished blocks are printed, the tail is printed when the reply ends.
+    def __init__(self, console, on_update=None) -> None:
+        self.console = console
+        self.renderable = None
+        self.__on_update = on_update
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        if self.renderable is not None:
+            self.console.print(self.renderable)
+
+    def update(self, renderable) -> None:
+        self.renderable = renderable
+        if self.__on_update is not None:
+            self.__on_update()
+
+    def refresh(self) -> None:
+        pass
@@ -0,0 +1,184 @@
+import json
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def percentile(values, quantile) -> float:
+    # nearest rank, values sorted
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(quantile * len(values)))]
+
+
+class Request:
+    # Timings of one prompt, filled in as it goes: the client records the
+    # network side, the terminal the expansion and rendering.
+    def __init__(self, metrics, bot) -> None:
+        self.__metrics = metrics
+        self.time = time.time()
+        self.bot = bot
+        self.cached = False
+        self.error: Optional[str] = None
+        self.ttfc: Optional[float] = None
+        self.duration: Optional[float] = None
+        self.max_gap = 0.0
+        self.chunks = 0
+        self.chars = 0
+        self.bytes = 0
+        self.expansion_time = 0.0
+        self.render_time = 0.0
+        self.__start = 0.0
+        self.__last = 0.0
+
+    def start(self) -> None:
+        self.__start = self.__last = time.perf_counter()
+
+    def chunk(self, text) -> None:
+        now = time.perf_counter()
+        if self.ttfc is None:
+            self.ttfc = now - self.__start
+        else:
+            gap = now - self.__last
+            self.max_gap = max(self.max_gap, gap)
+            self.__metrics.gaps.append(gap)
+        self.__last = now
+        self.chunks += 1
+        self.chars += len(text)
+        self.bytes += len(text.encode())
+
+    def finish(self, error=None) -> None:
+        self.duration = time.perf_counter() - self.__start
+        if error is not None:
+            self.error = str(error)
+
+    @property
+    def chars_per_second(self) -> float:
+        return self.chars / self.duration if self.duration else 0.0
+
+    def as_dict(self) -> Dict:
+        return {
+            "time": self.time, "bot": self.bot, "cached": self.cached,
+            "error": self.error, "ttfc": self.ttfc, "duration": self.duration,
+            "max_gap": self.max_gap, "chunks": self.chunks, "chars": self.chars,
+            "bytes": self.bytes, "chars_per_second": self.chars_per_second,
+            "expansion_time": self.expansion_time, "render_time": self.render_time,
+        }
+
+
+class Metrics:
+    # The last size requests and inter-chunk gaps, shared by the forks of a
+    # client, so memory stays bounded in a long running server.
+    series = {
+        "ttfc": ("poe_ttfc_seconds", "Time to first chunk"),
+        "gap": ("poe_chunk_gap_seconds", "Time between two chunks"),
+        "duration": ("poe_request_duration_seconds", "Time to the last chunk"),
+        "chars_per_second": ("poe_chars_per_second", "Reply characters per second"),
+        "render_time": ("poe_render_seconds", "Time spent rendering a reply"),
+        "expansion_time": ("poe_expansion_seconds", "Time spent expanding tokens"),
+    }
+
+    def __init__(self, size=1024) -> None:
+        self.requests: deque = deque(maxlen=size)
+        self.gaps: deque = deque(maxlen=size * 16)
+        self.__lock = threading.Lock()
+
+    def request(self, bot) -> Request:
+        request = Request(self, bot)
+        with self.__lock:
+            self.requests.append(request)
+        return request
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.requests.clear()
+            self.gaps.clear()
+
+    def finished(self) -> List[Request]:
+        with self.__lock:
+            return [r for r in self.requests if r.duration is not None]
+
+    def values(self, requests) -> Dict[str, List[float]]:
+        sent = [r for r in requests if r.error is None and not r.cached]
+        values = {
+            "ttfc": [r.ttfc for r in sent if r.ttfc is not None],
+            "gap": list(self.gaps),
+            "duration": [r.duration for r in sent],
+            "chars_per_second": [r.chars_per_second for r in sent if r.chars],
+            "render_time": [r.render_time for r in requests if r.render_time],
+            "expansion_time": [r.expansion_time for r in requests if r.expansion_time],
+        }
+        return {name: sorted(series) for name, series in values.items()}
+
+    def show(self) -> str:
+        requests = self.finished()
+        errors = sum(r.error is not None for r in requests)
+        cached = sum(r.cached for r in requests)
+        lines = [
+            f"{len(requests)} requests, {errors} errors, {cached} cached",
+            f"{'':<18}{'count':>7}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}",
+        ]
+        for name, values in self.values(requests).items():
+            if not values:
+                continue
+            scale = 1 if name == "chars_per_second" else 1000
+            cells = [percentile(values, q) for q in QUANTILES] + [values[-1]]
+            lines.append(f"{name:<18}{len(values):>7}" + "".join(
+                f"{value * scale:>10.1f}" for value in cells))
+        lines.append("times in ms, chars_per_second in characters per second")
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        requests = self.finished()
+        lines = []
+        for name, values in self.values(requests).items():
+            metric, description = self.series[name]
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} summary"]
+            lines += [f'{metric}{{quantile="{q}"}} {percentile(values, q)}'
+                      for q in QUANTILES]
+            lines += [f"{metric}_sum {sum(values)}", f"{metric}_count {len(values)}"]
+        counters = {
+            "poe_requests_total": ("Requests", len(requests)),
+            "poe_request_errors_total": (
+                "Failed requests", sum(r.error is not None for r in requests)),
+            "poe_cached_requests_total": (
+                "Requests answered from the cache", sum(r.cached for r in requests)),
+            "poe_reply_chars_total": (
+                "Reply characters", sum(r.chars for r in requests)),
+        }
+        for metric, (description, value) in counters.items():
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} counter",
+                      f"{metric} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def jsonl(self) -> str:
+        return "".join(json.dumps(r.as_dict()) + "\n" for r in self.finished())
+
+
+def run_test():
+    metrics = Metrics(size=4)
+    for index in range(6):
+        request = metrics.request("capybara")
+        request.start()
+        for chunk in ["a", "bc", "def"]:
+            request.chunk(chunk)
+        request.finish("timeout" if index == 5 else None)
+    metrics.request("a2")  # still running, not reported
+    assert len(metrics.finished()) == 3, len(metrics.finished())
+    assert metrics.finished()[0].chars == 6
+    assert "3 requests, 1 errors" in metrics.show(), metrics.show()
+    assert 'poe_ttfc_seconds{quantile="0.5"}' in metrics.prometheus()
+    assert "poe_request_errors_total 1" in metrics.prometheus()
+    assert len(metrics.jsonl().splitlines()) == 3
+    assert percentile([1, 2, 3, 4], 0.5) == 3 and percentile([], 0.9) == 0.0
+    print("All tests passed, well done!")
+
+
+if __name__ == "__main__":
+    try:
+        run_test()
+    except Exception as e:
+        print(e)
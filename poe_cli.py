@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+import socket
+import sys
+
+from protocol import (CHUNK, END, ERROR, OUTPUT, REQUEST, ProtocolError,
+                      default_socket_path, recv_frame, send_frame)
+
+
+def ask(sock, prompt, bot=None, mode=None):
+    send_frame(sock, REQUEST, {
+        "prompt": prompt, "bot": bot, "mode": mode, "cwd": os.getcwd(),
+    })
+    failed = False
+    text = ""
+    while True:
+        kind, payload = recv_frame(sock)
+        if kind == CHUNK:
+            text = payload.decode()
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        elif kind == OUTPUT:
+            print(payload.decode())
+        elif kind == ERROR:
+            print(payload.decode(), file=sys.stderr)
+            failed = True
+        elif kind == END:
+            if text and not text.endswith("\n"):
+                print()
+            return failed, json.loads(payload)
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Poe.com terminal client")
+    parser.add_argument("prompt", nargs="*", help="Prompt, read from stdin if empty")
+    parser.add_argument("-b", "--bot", help="Bot name")
+    parser.add_argument(
+        "-m", "--mode", help="Mode", choices=["interactive", "batch"])
+    parser.add_argument(
+        "-s", "--socket", help="Unix socket path", default=default_socket_path())
+    return parser.parse_args()
+
+
+def main():
+    args = arg_parser()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(args.socket)
+    except OSError as e:
+        print(f"Unable to reach the server on {args.socket}: {e}", file=sys.stderr)
+        return 2
+    try:
+        if args.prompt or not sys.stdin.isatty():
+            prompt = " ".join(args.prompt) if args.prompt else sys.stdin.read()
+            failed, _ = ask(sock, prompt, args.bot, args.mode)
+            return int(failed)
+        bot, mode = args.bot, args.mode
+        while True:
+            try:
+                prompt = input("> ")
+            except EOFError:
+                return 0
+            if not prompt.strip():
+                continue
+            _, state = ask(sock, prompt, bot, mode)
+            bot, mode = state["bot"], state["mode"]
+            if not state["running"]:
+                return 0
+    except (ProtocolError, KeyboardInterrupt):
+        return 1
+    finally:
+        sock.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
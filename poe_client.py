@@ -1,8 +1,23 @@
-from typing import Dict, Generator
-
-import poe  # type: ignore
+import contextlib
+import copy
+import json
+import threading
+import time
+from typing import Dict, Generator, Iterator, List, Set
 
+from bot_catalogue import BotCatalogue
 from logger import Logger
+from metrics import Metrics
+from prompt_limit import Probe, PromptLimits
+from response_cache import digest
+
+
+MAX_SPARES = 4
+# what poe.com answers to a message longer than the bot accepts, in lower
+# case; poe-api's generic "An unknown error occured" is not one of them
+LENGTH_ERRORS = ("too long", "too_long")
+# poe.com writes the suggested replies a moment after the reply itself
+SUGGESTION_DELAYS = (0.5, 1.0, 2.0, 4.0)
 
 
 class PoeError(Exception):
@@ -13,24 +28,194 @@ class PoeError(Exception):
         return self.message
 
 
+def poe_backend(token):
+    import poe  # type: ignore  # slow to import, only needed from here
+    return poe.Client(token)
+
+
+def fake_backend(**options):
+    def factory(token):
+        from fake_poe import FakeClient
+        return FakeClient(token, **options)
+
+    return factory
+
+
+def replay_backend(**options):
+    def factory(token):
+        from chunk_trace import ReplayClient
+        return ReplayClient(token, **options)
+
+    return factory
+
+
+def backend_from_spec(spec):
+    # "poe", or "fake:delay=0.01,chunk_size=8" for the offline fake server
+    # or "replay:trace.jsonl,speed=2" to play a recorded trace back
+    name, _, options = spec.partition(":")
+    if name == "poe":
+        return poe_backend
+    values = {}
+    for option in filter(None, options.split(",")):
+        key, equal, value = option.partition("=")
+        if not equal:
+            # the trace of replay:FILE
+            values["path"] = key
+            continue
+        try:
+            values[key.strip()] = json.loads(value)
+        except json.JSONDecodeError:
+            values[key.strip()] = value
+    if name == "fake":
+        return fake_backend(**values)
+    if name == "replay":
+        return replay_backend(**values)
+    raise PoeError(f"Unknown backend {name!r}")
+
+
+def add_backend_arguments(parser) -> None:
+    parser.add_argument(
+        "--backend", default="poe",
+        help="poe, fake[:option=value,...] for an offline fake server, or "
+             "replay:FILE[,speed=N] to play a trace of --record back "
+             "(speed=0: as fast as possible)")
+
+
 class Poe:
     __current_bot = None
-    __bots: Dict[str, Dict[str, str]] = {}
     __client = None
 
-    def __init__(self, token):
-        self.__client = poe.Client(token)
-        self.__bots = self.__client.bot_names
-        self.__current_bot = list(self.__bots.keys())[0]
+    def __init__(self, token, connect=True, catalogue=None, client_factory=None):
+        self.__token = token
+        # anything with the interface of poe.Client, see fake_poe
+        self.__client_factory = client_factory or poe_backend
+        # shared by forks, the bots are usable before the connection when
+        # the catalogue was loaded from its cache file
+        self.catalogue = catalogue or BotCatalogue()
+        # a poe.Client handles a single message at a time, shared by forks
+        self.__lock = threading.RLock()
+        # digest of the exchanges since the last chat break, per bot
+        self.__epochs: Dict[str, str] = {}
+        # bots whose conversation since the last chat break was replayed from
+        # the cache, poe.com did not see it; shared by forks
+        self.__replayed: Set[str] = set()
+        self.cache = None
+        self.limits = PromptLimits()
+        self.metrics = Metrics()
+        # see chunk_trace.TraceWriter, shared by forks
+        self.trace = None
+        # see resilience.Resilience, shared by forks
+        self.resilience = None
+        # other connections for hedged messages, probes and the like, shared
+        # by forks and spawned connections
+        self.__spares: List["Poe"] = []
+        self.__spare_lock = threading.Lock()
+        self.__spare_idle = threading.Condition(self.__spare_lock)
+        self.__reserved = False
+        # suggested replies of the last message per bot, with the epoch of
+        # the conversation they belong to; shared by forks
+        self.suggest = False
+        self.on_suggestions = None
+        self.__suggestions: Dict[str, tuple] = {}
+        self.__connected = threading.Event()
+        self.__error = None
+        if connect:
+            self.connect()
+
+    def connect(self) -> None:
+        try:
+            client = self.__client_factory(self.__token)
+            bots = client.bot_names
+            if self.__current_bot not in bots:
+                if self.__current_bot is not None:
+                    Logger("Unknown bot %s, using the first one", self.__current_bot)
+                self.__current_bot = list(bots.keys())[0]
+            self.__client = client
+        except Exception as e:
+            self.__error = PoeError(f"Unable to connect to poe.com: {e}")
+            raise self.__error
+        finally:
+            self.__connected.set()
+        self.catalogue.update(bots)
+
+    def connect_in_background(self, callback=None) -> threading.Thread:
+        def run():
+            try:
+                self.connect()
+            except PoeError as e:
+                Logger("%s", e)
+            if callback is not None:
+                callback()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def refresh_bots(self) -> None:
+        self.wait()
+        with self.__lock:
+            self.__client.get_bots()
+            bots = self.__client.bot_names
+        Logger("Refreshed the list of bots: %d bots", len(bots))
+        self.catalogue.update(bots)
+
+    def refresh_in_background(self) -> threading.Thread:
+        # refresh the catalogue every ttl, for long running sessions
+        def run():
+            while True:
+                time.sleep(max(self.catalogue.ttl - self.catalogue.age, 60))
+                try:
+                    self.refresh_bots()
+                except Exception as e:
+                    Logger("Unable to refresh the list of bots: %r", e)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def connected(self) -> bool:
+        return self.__client is not None
+
+    @property
+    def error(self):
+        return self.__error
+
+    def wait(self, timeout=None) -> None:
+        self.__connected.wait(timeout)
+        if self.__error is not None:
+            raise self.__error
+        if self.__client is None:
+            raise PoeError("Client is not initialized")
+
+    def fork(self) -> "Poe":
+        # same connection and lock, independent current bot
+        return copy.copy(self)
+
+    def spawn(self) -> "Poe":
+        # another connection of the same account, to send messages at the
+        # same time; not connected yet
+        client = Poe(self.__token, connect=False, catalogue=self.catalogue,
+                     client_factory=self.__client_factory)
+        client.cache = self.cache
+        client.limits = self.limits
+        client.metrics = self.metrics
+        client.trace = self.trace
+        client.resilience = self.resilience
+        client.__spares = self.__spares
+        client.__spare_lock = self.__spare_lock
+        client.__spare_idle = self.__spare_idle
+        return client
 
     @property
     def bots(self):
-        return self.__bots
+        return self.catalogue.bots
 
     def show_bots(self) -> str:
+        bots = self.catalogue.bots
         buffer = ""
-        for bot in self.__bots:
-            buffer += f"{self.__bots[bot]} ({bot})\n"
+        for bot in bots:
+            buffer += f"{bots[bot]} ({bot})\n"
         return buffer
 
     @property
@@ -39,7 +224,8 @@ class Poe:
 
     @bot.setter
     def bot(self, bot) -> None:
-        if bot in self.__bots:
+        # before the connection, the bot is checked once the list is known
+        if bot in self.catalogue.bots or not self.connected:
             self.__current_bot = bot
         else:
             raise PoeError("Invalid bot name or index")
@@ -48,62 +234,290 @@ class Poe:
         self.bot = bot
 
     def send_chat_break(self) -> None:
-        if self.__client is None:
-            raise PoeError("Client is not initialized")
-        self.__client.send_chat_break(self.__current_bot)
+        self.wait()
+        with self.__lock:
+            self.__client.send_chat_break(self.__current_bot)
+        self.__epochs.pop(self.__current_bot, None)
+        self.__replayed.discard(self.__current_bot)
+        self.__suggestions.pop(self.__current_bot, None)
         return None
 
-    def send_message_generator(self, message) -> Generator[str, None, None]:
-        if self.__client is None:
-            raise PoeError("Client is not initialized")
-        Logger(f"Sent message: {message}")
-        for chunk in self.__client.send_message(self.__current_bot, message):
-            text = chunk["text_new"]
-            Logger(f"Received chunks: {chunk}")
-            yield text
+    def reset(self) -> None:
+        # a fresh conversation with every bot talked to, for the next user
+        # of this connection
+        self.wait()
+        for bot in list(self.__epochs):
+            with self.__lock:
+                self.__client.send_chat_break(bot)
+            self.__epochs.pop(bot, None)
+        self.__replayed.clear()
+        self.__suggestions.clear()
 
-    def send_message(self, message) -> str:
-        if self.__client is None:
-            raise PoeError("Client is not initialized")
-        chunk = {"text": ""}
-        for chunk in self.__client.send_message(self.__current_bot, message):
-            pass
-        Logger(f"Sent message: {message}\nReceived chunk: {chunk}")
-        text = chunk["text"]
-        return text
+    def accepts(self, length, bot=None) -> bool:
+        # a probe message in a fresh conversation, so that the context does
+        # not count in its length
+        self.wait()
+        bot = bot or self.__current_bot
+        try:
+            with self.__lock:
+                for _ in self.__client.send_message(
+                        bot, "a" * length, with_chat_break=True):
+                    pass
+        except RuntimeError as e:
+            # a timeout or a rate limit says nothing about the length
+            if not any(error in str(e).lower() for error in LENGTH_ERRORS):
+                raise PoeError(f"Probe of {length} characters failed: {e}")
+            return False
+        finally:
+            self.__epochs.pop(bot, None)
+        return True
 
+    def probe_limit(self, bot=None, **options) -> int:
+        # over a spare connection, this one is left free for the user; the
+        # conversation with the bot is on poe.com's side though, cleared by
+        # the chat breaks of the probes
+        bot = bot or self.__current_bot
+        with self.spare() as prober:
+            try:
+                probe = Probe(lambda length: prober.accepts(length, bot), **options)
+                limit = probe.run()
+            finally:
+                self.__epochs.pop(bot, None)
+        Logger("Max prompt length for %s: %d (%d probes)", bot, limit, probe.probes)
+        self.limits.set(bot, limit)
+        return limit
 
-def max_prompt_len(client) -> int:
-    prompt = "a"
-    try:
-        while True:
-            client.send_message(prompt)
-            prompt += "a"
-    finally:
-        return len(prompt)
+    def __cached(self, bot, message):
+        # the key of the reply, the reply if cached, and whether the message
+        # goes in a fresh conversation: a reply is only replayed where
+        # poe.com's conversation is the same, at its start or after replies
+        # replayed too; the message after those is sent with a chat break,
+        # the bot not knowing them
+        epoch = self.__epochs.get(bot, "")
+        replayed = bot in self.__replayed
+        if self.cache is None:
+            return None, None, replayed
+        key = self.cache.key(bot, message, epoch)
+        if not epoch or replayed:
+            chunks = self.cache.get(key)
+            if chunks is not None:
+                self.__replayed.add(bot)
+                return key, chunks, False
+        if replayed:
+            key = self.cache.key(bot, message, "")
+        return key, None, replayed
 
+    def __fresh(self, bot) -> None:
+        # after a message sent with a chat break
+        self.__epochs.pop(bot, None)
+        self.__replayed.discard(bot)
 
-def check_prompt_len(prompt_len) -> bool:
-    client = Poe(token)
-    try:
-        prompt = "a" * prompt_len
-        client.send_message(prompt)
-        return True
-    except:
-        return False
+    def __store(self, bot, message, key, chunks) -> None:
+        self.__epochs[bot] = digest(
+            self.__epochs.get(bot, ""), message, "".join(chunks))
+        if key is not None and self.cache is not None:
+            self.cache.put(key, bot, chunks)
+
+    def __chunks(self, bot, message, cancelled=None, chat_break=False) -> Iterator[str]:
+        with self.__lock:
+            # a hedged message that lost while waiting for the connection
+            if cancelled is not None and cancelled.is_set():
+                return
+            Logger("Sent message: %s", message)
+            for chunk in self.__client.send_message(
+                    bot, message, with_chat_break=chat_break):
+                Logger("Received chunks: %s", chunk)
+                yield chunk["text_new"]
+
+    def __reserve(self, cancelled=None):
+        # an idle spare connection, created and connected when needed, the
+        # others may be draining stalled replies; waits for one once
+        # MAX_SPARES are busy, None once cancelled
+        with self.__spare_idle:
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    return None
+                idle = [spare for spare in self.__spares if not spare.__reserved]
+                if idle:
+                    spare = idle[0]
+                    break
+                if len(self.__spares) < MAX_SPARES:
+                    spare = self.spawn()
+                    self.__spares.append(spare)
+                    break
+                self.__spare_idle.wait(0.1)
+            spare.__reserved = True
+        try:
+            if not spare.connected:
+                spare.connect()
+        except Exception:
+            with self.__spare_idle:
+                self.__spares.remove(spare)
+                self.__spare_idle.notify()
+            raise
+        return spare
 
+    def __release(self, spare) -> None:
+        with self.__spare_idle:
+            spare.__reserved = False
+            self.__spare_idle.notify()
 
-def max_prompt_len_dicotomy(prompt_len_min, prompt_len_max) -> int:
-    if not check_prompt_len(prompt_len_min):
-        return prompt_len_min
-    if not check_prompt_len(prompt_len_max):
-        return max_prompt_len_dicotomy(prompt_len_min, (prompt_len_max + prompt_len_min) // 2)
-    if check_prompt_len(prompt_len_max):
-        raise Exception("Max prompt length is too low")
-    return prompt_len_max
+    @contextlib.contextmanager
+    def spare(self) -> Iterator["Poe"]:
+        # one of the spare connections for the caller alone, on the current
+        # bot; they are kept for the next ones
+        spare = self.__reserve()
+        try:
+            spare.__current_bot = self.__current_bot
+            yield spare
+        finally:
+            self.__release(spare)
+
+    def __spare_chunks(self, bot, message, cancelled, chat_break=False) -> Iterator[str]:
+        # for hedges and retries
+        spare = self.__reserve(cancelled)
+        if spare is None:
+            return
+        try:
+            yield from spare.__chunks(bot, message, cancelled, chat_break)
+        finally:
+            self.__release(spare)
+
+    def send_message_generator(self, message, request=None) -> Generator[str, None, None]:
+        # request: a metrics.Request the caller also records its own timings in
+        self.wait()
+        bot = self.__current_bot
+        request = request or self.metrics.request(bot)
+        request.start()
+        key, chunks, chat_break = self.__cached(bot, message)
+        trace = None
+        if self.trace is not None:
+            trace = self.trace.reply(bot, message, chunks is not None)
+        if chunks is not None:
+            Logger("Cache hit for message: %s", message)
+            request.cached = True
+            self.__store(bot, message, None, chunks)
+            for text in chunks:
+                request.chunk(text)
+                if trace is not None:
+                    trace.chunk(text)
+                yield text
+            request.finish()
+            if trace is not None:
+                trace.finish()
+            return
+        chunks = []
+        if chat_break:
+            Logger("Replies to %s replayed from the cache, sending a chat break", bot)
+        # the bot the reply came from, another one when resilience hedged to it
+        targets = [bot]
+        if self.resilience is None:
+            stream = self.__chunks(bot, message, chat_break=chat_break)
+        else:
+            stream = self.resilience.stream(
+                bot,
+                lambda target, cancelled: self.__chunks(target, message, cancelled, chat_break),
+                lambda target, cancelled: self.__spare_chunks(
+                    target, message, cancelled, chat_break),
+                targets.append)
+        try:
+            for text in stream:
+                request.chunk(text)
+                if trace is not None:
+                    trace.chunk(text)
+                chunks.append(text)
+                yield text
+        except GeneratorExit:
+            request.finish("cancelled")
+            if trace is not None:
+                trace.finish("cancelled")
+            raise
+        except Exception as e:
+            request.finish(e)
+            if trace is not None:
+                trace.finish(e)
+            raise
+        request.finish()
+        if trace is not None:
+            trace.finish()
+        if targets[-1] != bot:
+            # in the conversation of the other bot, not cached as a reply of bot
+            self.__store(targets[-1], message, None, chunks)
+            return
+        if chat_break:
+            self.__fresh(bot)
+        self.__store(bot, message, key, chunks)
+        if self.suggest:
+            self.__fetch_suggestions(bot)
 
+    def suggestions(self, bot=None) -> List[str]:
+        bot = bot or self.__current_bot
+        epoch, replies = self.__suggestions.get(bot, (None, []))
+        return replies if epoch == self.__epochs.get(bot) else []
 
-if __name__ == "__main__":
-    from secret import TOKEN as token
-    max_len = max_prompt_len_dicotomy(500, 100000)
-    print(f"Max prompt length: {max_len}")
+    def __fetch_suggestions(self, bot) -> threading.Thread:
+        # polls the last message in the background, until its suggestions
+        # show up or the conversation moved on
+        epoch = self.__epochs.get(bot)
+
+        def run():
+            for delay in SUGGESTION_DELAYS:
+                time.sleep(delay)
+                if self.__epochs.get(bot) != epoch:
+                    return
+                try:
+                    # the bot's page ends with the last message, whereas
+                    # get_message_history gives the first ones of the page
+                    with self.__lock:
+                        page = self.__client.get_bot(self.__client.bot_names[bot])
+                    edges = page["messagesConnection"]["edges"]
+                except Exception as e:
+                    Logger("Unable to get the suggested replies: %r", e)
+                    return
+                node = edges[-1]["node"] if edges else {}
+                replies = node.get("suggestedReplies")
+                if node.get("authorNickname") == bot and replies:
+                    if self.__epochs.get(bot) != epoch:
+                        return
+                    self.__suggestions[bot] = (epoch, list(replies))
+                    Logger("Suggested replies for %s: %s", bot, replies)
+                    if self.on_suggestions is not None:
+                        self.on_suggestions(bot)
+                    return
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def send_message(self, message, with_chat_break=False, request=None) -> str:
+        self.wait()
+        bot = self.__current_bot
+        request = request or self.metrics.request(bot)
+        request.start()
+        if with_chat_break:
+            self.__fresh(bot)
+        key, chunks, chat_break = self.__cached(bot, message)
+        chat_break = chat_break or with_chat_break
+        if chunks is not None:
+            Logger("Cache hit for message: %s", message)
+            request.cached = True
+            request.chunk("".join(chunks))
+            request.finish()
+            self.__store(bot, message, None, chunks)
+            return "".join(chunks)
+        chunk = {"text": ""}
+        try:
+            with self.__lock:
+                for chunk in self.__client.send_message(
+                        bot, message, with_chat_break=chat_break):
+                    request.chunk(chunk["text_new"])
+        except Exception as e:
+            request.finish(e)
+            raise
+        request.finish()
+        Logger("Sent message: %s\nReceived chunk: %s", message, chunk)
+        text = chunk["text"]
+        if chat_break:
+            self.__fresh(bot)
+        self.__store(bot, message, key, [text])
+        return text
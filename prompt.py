@@ -1,31 +1,63 @@
 import argparse
-import os
+import asyncio
+import contextlib
 import sys
-from typing import List
+import threading
+import time
 
 from prompt_toolkit import PromptSession, prompt  # type: ignore
+from prompt_toolkit.application.current import get_app  # type: ignore
 from prompt_toolkit.completion import Completer, Completion  # type: ignore
+from prompt_toolkit.filters import Condition  # type: ignore
 from prompt_toolkit.key_binding import KeyBindings  # type: ignore
 from rich.console import Console  # type: ignore
-from rich.live import Live  # type: ignore
-from rich.markdown import Markdown  # type: ignore
 
-from command import Command, CommandError, CommandHandler  # type: ignore
+from bot_catalogue import add_catalogue_arguments
+from chunk_trace import add_trace_arguments
+from command import CommandError  # type: ignore
+from fanout import side_by_side
+from history import add_history_arguments, history_from_args
 from logger import Logger
-from poe_client import Poe, PoeError
+from poe_client import PoeError, add_backend_arguments
+from refresh_scheduler import RefreshScheduler
+from resilience import add_resilience_arguments
+from response_cache import add_cache_arguments
+from session import Session, client_from_args
+
+
+SUGGESTED = "suggested reply"
+
+
+def positive_float(value) -> float:
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number: {value!r}")
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"must be positive: {value!r}")
+    return number
 
 
 class AutoCompletion(Completer):
-    def __init__(self, commandHandler) -> None:
+    def __init__(self, commandHandler, suggestions=None) -> None:
         self.__options = commandHandler
+        # suggested replies to the last message, offered for a plain prompt
+        self.__suggestions = suggestions or (lambda: [])
 
     def get_completions(self, document, complete_event):
         if not document.text.startswith("!"):
+            text = document.text.lower()
+            for suggestion in self.__suggestions():
+                if suggestion.lower().startswith(text):
+                    yield Completion(
+                        suggestion,
+                        start_position=-len(document.text),
+                        display_meta=SUGGESTED,
+                    )
             return
 
         words = document.text.split()
 
-        last_context = self.__options
         previous_word = words if document.text.endswith(" ") else words[:-1]
         try:
             if (
@@ -37,146 +69,41 @@ class AutoCompletion(Completer):
         except IndexError:
             pass
         last_word = "" if document.text.endswith(" ") else words[-1]
-        try:
-            for word in previous_word:
-                last_context = last_context[word].__args__
-        except CommandError:
-            return
-        except KeyError:
-            return  # No completion
-
-        if last_context is None:  # No more arguments
-            return
-        if type(last_context) is str:  # Last argument is a string
-            return
-        # check if last_context is iterable
-        for command in last_context:
-            if command.startswith(last_word):
-                yield Completion(
-                    command,
-                    start_position=-len(last_word),
-                    display_meta=last_context[command].doc,
-                )
-
-
-class Terminal:
-    __modes = {"interactive": "Interactive mode", "batch": "Batch mode"}
-    __mode = "interactive"
-    __multiline = False
-    __running = True
-    __token = None
+        for command, doc in self.__options.index.completions(previous_word, last_word):
+            yield Completion(
+                command,
+                start_position=-len(last_word),
+                display_meta=doc,
+            )
 
-    def set_running(self, value: bool):
-        self.__running = value
 
+class Cancelled(PoeError):
     def __init__(self):
-        args = self.arg_parser()
-        self.__client = Poe(args.token)
-        self.__commands = CommandHandler(
-            {
-                "!clear": Command(
-                    lambda _: (self.__client.send_chat_break(),
-                               "Conversation cleared"),
-                    "Clear the chat",
-                ),
-                "!set": Command(
-                    None,
-                    "Set value of prompt settings",
-                    CommandHandler(
-                        {
-                            "bot": Command(
-                                lambda args: (
-                                    self.__client.set_bot(args[0]),
-                                    f"Bot set to {args[0]}",
-                                ),
-                                "Switch to another bot",
-                                CommandHandler(
-                                    {
-                                        str(bot): Command(None, self.__client.bots[bot])
-                                        for bot in self.__client.bots
-                                    }
-                                ),
-                            ),
-                            "mode": Command(
-                                lambda args: (
-                                    self.set_mode(args[0]),
-                                    f"Mode set to {args[0]}",
-                                ),
-                                "Switch to another mode",
-                                CommandHandler(
-                                    {
-                                        mode: Command(None, self.__modes[mode])
-                                        for mode in self.__modes
-                                    }
-                                ),
-                            ),
-                        }
-                    ),
-                ),
-                "!list": Command(
-                    None,
-                    "List values of prompt settings",
-                    CommandHandler(
-                        {
-                            "bot": Command(
-                                lambda _: self.__client.show_bots(),
-                                "Show the list of bots",
-                            ),
-                            "mode": Command(
-                                lambda _: "\n".join(
-                                    f"{mode} - {self.__modes[mode]}"
-                                    for mode in self.__modes
-                                ),
-                                "Show the available modes",
-                            ),
-                        }
-                    ),
-                ),
-                "!get": Command(
-                    None,
-                    "Get value of prompt settings",
-                    CommandHandler(
-                        {
-                            "bot": Command(
-                                lambda _: f"Current bot\
-                                is {self.__client.bot}",
-                                "Show the current bot",
-                            ),
-                            "mode": Command(
-                                lambda _: f"Current mode is {self.__mode}",
-                                "Show the current mode",
-                            ),
-                        }
-                    ),
-                ),
-                "!exit": Command(
-                    lambda _: (
-                        self.set_running(False),
-                        "[yellow] Exiting the program [/yellow]",
-                    ), "Exit the program"
-                ),
-            },
-            help="!help",
-        )
+        super().__init__("Reply cancelled")
 
-        self.__token = CommandHandler(
-            {
-                "file": Command(
-                    lambda args: self.__open_file(args[0]),
-                    "Replace token by file content",
-                    "file",
-                ),
-                "code": Command(
-                    lambda args: f"\n```{args[0]}\n{self.__open_file(args[1])}\n```\n",
-                    "Replace token by file content in a markdown code block",
-                    "language file",
-                )
-            },
-            separators=("{{", "}}")
-        )
+
+class Terminal(Session):
+    __multiline = False
+    __fps = 30.0
+    __max_latency = 0.1
+    # set while run() reads the next prompts during a reply
+    __pipelined = False
+    __activity = None
+    __panes = None
+    __stream = None
+    __busy = False
+    __queued = 0
+
+    def __init__(self, args=None):
+        args = args or self.arg_parser()
+        # the connection is made while the prompt is already usable
+        super().__init__(client_from_args(args))
+        self.history = history_from_args(args)
+        self.tokens.max_size = int(args.file_budget * 1024 * 1024)
 
         self.__console = Console()
         self.__console.set_window_title("Poe.com terminal")
+        self.__cancelled = threading.Event()
 
         bindings = KeyBindings()
 
@@ -208,6 +135,19 @@ class Terminal:
             )
             event.app.current_buffer.validate_and_handle()
 
+        @Condition
+        def suggestion_selected():
+            state = get_app().current_buffer.complete_state
+            return bool(state and state.current_completion
+                        and state.current_completion.display_meta_text == SUGGESTED)
+
+        @bindings.add("enter", filter=suggestion_selected)
+        def _(event):
+            "Send the selected suggested reply."
+            buffer = event.current_buffer
+            buffer.apply_completion(buffer.complete_state.current_completion)
+            buffer.validate_and_handle()
+
         @bindings.add("f4")
         def _(event):
             "Toggle multiline mode."
@@ -217,15 +157,32 @@ class Terminal:
         def bottom_toolbar():
             "Display the current input mode."
             text = f'Help: F1 | Clear: F2 | Exit: F3 | Multi-line ({self.__multiline}): F4'
+            if self.__busy:
+                text = f'Cancel: Ctrl-C | {text}'
+                if self.__queued:
+                    text = f'{self.__queued} queued | {text}'
+                if self.__panes is not None:
+                    text = f'{self.__panes(get_app().output.get_size().columns)}\n{text}'
+                elif self.__activity is not None:
+                    text = f'{self.__activity} | {text}'
+                elif self.__stream is not None:
+                    tail = self.__stream.text.rstrip().rsplit("\n", 1)[-1]
+                    text = f'{self.client.bot}: {tail[-60:]} | {text}'
+            if self.client.error is not None:
+                text = f'{self.client.error} | {text}'
+            elif not self.client.connected:
+                text = f'Connecting to poe.com... | {text}'
             return [
                 ("class:toolbar", text),
             ]
 
         def rprompt():
-            return f"({self.__client.bot}|{self.__mode})"
+            if not self.client.connected:
+                return f"(connecting|{self.mode})"
+            return f"({self.client.bot}|{self.mode})"
 
         self.__prompt = PromptSession(
-            completer=AutoCompletion(self.__commands),
+            completer=AutoCompletion(self.commands, self.client.suggestions),
             key_bindings=bindings,
             bottom_toolbar=bottom_toolbar,
             rprompt=rprompt,
@@ -235,38 +192,55 @@ class Terminal:
         )
 
         if args.bot:
-            self.__client.bot = args.bot
+            self.client.bot = args.bot
 
         if args.mode:
-            self.__mode = args.mode
+            self.mode = args.mode
 
         if args.multiline:
             self.__prompt.multiline = True
 
+        self.__fps = args.fps
+        self.__max_latency = args.max_latency
+
         if args.log:
             Logger.is_active = True
             Logger.set_file(args.log)
 
-    def __open_file(self, file):
-        striped_file = file.replace("\"", "").replace("\'", "").strip()
-        Logger(f"{os.getcwd()=}")
-        Logger(f"{os.listdir()=}")
-        Logger(f"{striped_file=}")
-        try:
-            with open(striped_file, "r") as f:
-                return f.read()
-        except FileNotFoundError:
-            raise CommandError(f"File {file} not found")
-        except PermissionError:
-            raise CommandError(f"Permission denied to file {file}")
-        except Exception as e:
-            raise CommandError(f"Error while opening file {file}: {e}")
-
-    def set_mode(self, mode):
-        self.__mode = mode
-
-    def arg_parser(self):
+        self.client.suggest = args.suggestions
+        self.client.on_suggestions = self.__on_suggestions
+        self.client.connect_in_background(self.__on_connect)
+
+    def __on_connect(self):
+        if self.client.connected:
+            self.client.refresh_in_background()
+        if self.__prompt.app.is_running:
+            self.__prompt.app.invalidate()
+
+    def __on_suggestions(self, bot):
+        # from the thread that fetched them
+        app = self.__prompt.app
+        if app.is_running and bot == self.client.bot:
+            app.loop.call_soon_threadsafe(self.__offer_suggestions)
+
+    def __offer_suggestions(self):
+        buffer = self.__prompt.app.current_buffer
+        if not buffer.text and not buffer.complete_state and self.client.suggestions():
+            buffer.start_completion(select_first=False)
+
+    @staticmethod
+    def arg_parser():
         parser = argparse.ArgumentParser(description="Poe.com api integration")
+        parser.add_argument(
+            "prompt", nargs="*",
+            help="Prompt to answer before exiting, read from stdin when it is "
+                 "not a terminal and the output is raw")
+        parser.add_argument(
+            "--raw",
+            action="store_true",
+            help="Write the replies unrendered, as received (default when the "
+                 "output is not a terminal)",
+        )
         parser.add_argument("-b", "--bot", help="Bot name", default="capybara")
         parser.add_argument(
             "-m",
@@ -281,6 +255,30 @@ class Terminal:
             action="store_true",
             default=False,
         )
+        parser.add_argument(
+            "--fps",
+            type=positive_float,
+            help="Target refresh rate of streamed replies",
+            default=30.0,
+        )
+        parser.add_argument(
+            "--max-latency",
+            type=positive_float,
+            help="Maximum delay (in seconds) before a received chunk is displayed",
+            default=0.1,
+        )
+        parser.add_argument(
+            "--suggestions",
+            action="store_true",
+            help="Fetch the suggested replies of poe.com after every reply, "
+                 "offered as completions of an empty prompt",
+        )
+        parser.add_argument(
+            "--file-budget",
+            type=float,
+            help="Maximum size (in MiB) of the files injected in a prompt",
+            default=8,
+        )
         parser.add_argument(
             "-l",
             "--log",
@@ -289,52 +287,289 @@ class Terminal:
         )
         parser.add_argument(
             "-t", "--token", help="POE Token fetch from poe.com cookies", required=True)
+        add_cache_arguments(parser)
+        add_catalogue_arguments(parser)
+        add_backend_arguments(parser)
+        add_history_arguments(parser)
+        add_resilience_arguments(parser)
+        add_trace_arguments(parser)
         args = parser.parse_args()
         return args
 
     def __ask_prompt(self) -> str:
-        prompt = self.__prompt.prompt("> ")
-        Logger(f"{prompt=} | {len(prompt)=}")
+        prompt = self.__prompt.prompt("> ", pre_run=self.__offer_suggestions)
+        Logger("prompt=%r | len(prompt)=%d", prompt, len(prompt))
         return prompt
 
     def ask_prompt(self):
-        prompt = self.__ask_prompt()
+        self.answer(self.__ask_prompt())
+
+    def answer(self, prompt):
         self.__console.rule("", style="blue")
         try:
             if prompt.startswith("!"):
-                self.__console.print(self.__commands(prompt))
+                self.__console.print(self.commands(prompt))
             else:
-                text = f" {prompt} --> {self.__token(prompt)}"
-                if self.__mode == "interactive":
-                    text_buffer = ""
-                    with Live(
-                        console=self.__console,
-                        auto_refresh=False,
-                        vertical_overflow="visible",
-                    ) as live:
-                        for text_chunk in self.__client.send_message_generator(text):
-                            text_buffer += text_chunk
-                            md = Markdown(text_buffer)
-                            live.update(md)
-                            if "\n" in text_chunk:
-                                live.refresh()
-                elif self.__mode == "batch":
-                    md = Markdown(self.__client.send_message(text))
+                request = self.client.metrics.request(self.client.bot)
+                start = time.perf_counter()
+                text = self.expand(prompt)
+                request.expansion_time = time.perf_counter() - start
+                if not self.client.connected:
+                    with self.__status("Connecting to poe.com..."):
+                        self.client.wait()
+                request.bot = self.client.bot
+                text = self.__fit(prompt, text)
+                if self.mode == "interactive":
+                    from rich.live import Live  # type: ignore
+
+                    from markdown_stream import BlockLive, MarkdownStream
+
+                    if self.__pipelined:
+                        live = BlockLive(self.__console, self.__invalidate)
+                    else:
+                        live = Live(
+                            console=self.__console,
+                            auto_refresh=False,
+                            vertical_overflow="visible",
+                        )
+                    with live:
+                        stream = self.__stream = MarkdownStream(live)
+
+                        def render(text_chunk):
+                            stream.feed(text_chunk)
+                            live.refresh()
+
+                        try:
+                            with RefreshScheduler(
+                                render, self.__fps, self.__max_latency
+                            ) as scheduler:
+                                for text_chunk in self.__reply(prompt, text, request):
+                                    scheduler.push(text_chunk)
+                        finally:
+                            self.__stream = None
+                        request.render_time = scheduler.render_time
+                elif self.mode == "batch":
+                    from rich.markdown import Markdown  # type: ignore
+
+                    md = Markdown("".join(self.__reply(prompt, text, request)))
+                    start = time.perf_counter()
                     self.__console.print(md)
-                elif self.__mode == "debug":
+                    request.render_time = time.perf_counter() - start
+                elif self.mode == "debug":
                     self.__console.print(text)
                 else:
-                    raise CommandError(f"Invalid mode '{self.__mode}'")
-        except CommandError as e:
+                    raise CommandError(f"Invalid mode '{self.mode}'")
+        except (CommandError, PoeError) as e:
             self.__console.print(f"[red]{e}[/red]")
         finally:
             self.__console.rule("", style="blue")
 
+    def compare(self, bots, prompt) -> str:
+        # one panel per bot, side by side, refreshed by a single scheduler
+        from rich.live import Live  # type: ignore
+        from rich.markdown import Markdown  # type: ignore
+        from rich.panel import Panel  # type: ignore
+        from rich.table import Table  # type: ignore
+
+        from markdown_stream import BlockLive
+
+        replies = {}
+
+        def table():
+            grid = Table.grid(expand=True, padding=(0, 1))
+            panels = []
+            for bot in bots:
+                reply = replies.get(bot)
+                grid.add_column(ratio=1)
+                panels.append(Panel(
+                    Markdown(reply.text if reply else ""),
+                    title=bot,
+                    subtitle=reply.latency if reply else "waiting...",
+                    subtitle_align="right",
+                ))
+            grid.add_row(*panels)
+            return grid
+
+        if self.__pipelined:
+            live = BlockLive(self.__console, self.__invalidate)
+        else:
+            live = Live(console=self.__console, auto_refresh=False,
+                        vertical_overflow="visible")
+
+        def render(_):
+            if self.__pipelined:
+                # streamed in the toolbar, the panels are printed at the end
+                self.__panes = lambda width: side_by_side(bots, replies, width)
+                self.__invalidate()
+                return
+            live.update(table())
+            live.refresh()
+
+        def on_chunk(reply):
+            replies[reply.bot] = reply
+            scheduler.push("")
+
+        try:
+            with live, RefreshScheduler(render, self.__fps, self.__max_latency) as scheduler:
+                render("")
+                done = self.ask(bots, prompt, on_chunk, self.__cancelled)
+                live.update(table())
+        finally:
+            self.__panes = None
+            self.__invalidate()
+        return "\n".join(f"{reply.bot}: {reply.latency}" for reply in done)
+
+    def __reply(self, prompt, text, request):
+        chunks = self.client.send_message_generator(text, request)
+
+        def until_cancelled():
+            for text_chunk in chunks:
+                if self.__cancelled.is_set():
+                    raise Cancelled()
+                yield text_chunk
+
+        try:
+            yield from self.record(prompt, text, until_cancelled())
+        except Cancelled:
+            # poe.com can not stop a reply, and the client only serves the
+            # next message once this one is received
+            with self.__status("Cancelling..."):
+                for _ in chunks:
+                    pass
+            request.error = "cancelled"
+            raise
+
+    def __invalidate(self):
+        if self.__prompt.app.is_running:
+            self.__prompt.app.invalidate()
+
+    @contextlib.contextmanager
+    def __status(self, message):
+        # the prompt owns the screen when pipelined, the toolbar shows it
+        if not self.__pipelined:
+            with self.__console.status(message) as status:
+                yield status
+            return
+        self.__activity = message
+        self.__invalidate()
+        try:
+            yield None
+        finally:
+            self.__activity = None
+            self.__invalidate()
+
+    @contextlib.contextmanager
+    def __progress(self, template):
+        # a progress(done, count) callback, shown as a status line
+        status = None
+
+        def progress(done, count):
+            message = template.format(done=done, count=count)
+            if self.__pipelined:
+                self.__activity = message
+                self.__invalidate()
+                return
+            nonlocal status
+            if status is None:
+                status = self.__console.status(message)
+                status.start()
+            status.update(message)
+
+        try:
+            yield progress
+        finally:
+            self.__activity = None
+            if status is not None:
+                status.stop()
+
+    def __fit(self, prompt, text) -> str:
+        with self.__progress("Prompt too long, {done}/{count} parts sent...") as progress:
+            return self.fit(prompt, text, progress)
+
+    def docgen(self, args, progress=None, concurrency=4) -> str:
+        with self.__progress("Writing docstrings, {done}/{count}...") as progress:
+            return super().docgen(args, progress, concurrency)
+
+    def __in_thread(self, function, *args) -> asyncio.Future:
+        # a daemon thread, so that exiting does not wait for a reply
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def run():
+            try:
+                result = function(*args)
+            except BaseException as e:
+                result, error = None, e
+            else:
+                error = None
+            if loop.is_closed():
+                return
+            if error is None:
+                loop.call_soon_threadsafe(future.set_result, result)
+            else:
+                loop.call_soon_threadsafe(future.set_exception, error)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    async def __consume(self, prompts):
+        while True:
+            prompt = await prompts.get()
+            self.__queued -= 1
+            self.__cancelled.clear()
+            self.__busy = True
+            try:
+                await self.__in_thread(self.answer, prompt)
+            except Exception as e:
+                Logger("Prompt %r failed: %r", prompt, e)
+                self.__console.print(f"[red]<!> {e}[/red]")
+            finally:
+                self.__busy = False
+                self.__invalidate()
+            if not self.running and self.__prompt.app.is_running:
+                self.__prompt.app.exit(exception=EOFError())
+
+    async def run_async(self):
+        # The next prompts are read while a reply streams above the prompt,
+        # they are answered in order. Ctrl-C cancels the current reply.
+        from prompt_toolkit.patch_stdout import patch_stdout  # type: ignore
+
+        prompts: asyncio.Queue = asyncio.Queue()
+        self.__pipelined = True
+        consumer = asyncio.create_task(self.__consume(prompts))
+        try:
+            with patch_stdout(raw=True):
+                while self.running:
+                    try:
+                        prompt = await self.__prompt.prompt_async(
+                            "> ", pre_run=self.__offer_suggestions)
+                    except KeyboardInterrupt:
+                        if self.__busy:
+                            self.__cancelled.set()
+                            continue
+                        break
+                    except EOFError:
+                        break
+                    Logger("prompt=%r | len(prompt)=%d", prompt, len(prompt))
+                    self.__queued += 1
+                    prompts.put_nowait(prompt)
+        finally:
+            self.__cancelled.set()
+            consumer.cancel()
+            self.__pipelined = False
+
     def run(self):
-        while self.__running:
-            self.ask_prompt()
+        asyncio.run(self.run_async())
 
 
 if __name__ == "__main__":
-    client = Terminal()
-    client.run()
+    args = Terminal.arg_parser()
+    if args.raw or not sys.stdout.isatty():
+        from raw import RawTerminal, read_prompts
+
+        sys.exit(RawTerminal(args).run(read_prompts(args.prompt)))
+    client = Terminal(args)
+    if args.prompt:
+        client.answer(" ".join(args.prompt))
+    else:
+        client.run()
@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from logger import Logger
+
+
+def default_limits_path() -> str:
+    directory = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(directory, "poe_terminal", "limits.json")
+
+
+class PromptLimits:
+    # Longest prompt accepted per bot, in characters, kept in a json file
+    def __init__(self, path=None) -> None:
+        self.path = path
+        self.__limits: Dict[str, int] = {}
+        self.__lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.__limits = json.load(f)
+            except Exception as e:
+                Logger("Unable to read the prompt limits %s: %r", path, e)
+
+    def get(self, bot) -> Optional[int]:
+        return self.__limits.get(bot)
+
+    def set(self, bot, limit) -> None:
+        with self.__lock:
+            self.__limits[bot] = limit
+            limits = dict(self.__limits)
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temporary = f"{self.path}.{os.getpid()}"
+            with open(temporary, "w") as f:
+                json.dump(limits, f, indent=1, sort_keys=True)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            Logger("Unable to write the prompt limits %s: %r", self.path, e)
+
+    def show(self) -> str:
+        return "\n".join(
+            f"{bot}: {limit} characters" for bot, limit in sorted(self.__limits.items()))
+
+
+class Probe:
+    # Finds the longest accepted prompt with an exponential search for an
+    # upper bound, then narrows [accepted, rejected) down. With concurrency
+    # k, k lengths are tested per round so the interval shrinks k + 1 times
+    # per round instead of 2.
+    def __init__(self, check, start=1000, maximum=1000000, resolution=0.01,
+                 concurrency=1) -> None:
+        self.check = check
+        self.start = start
+        self.maximum = maximum
+        self.resolution = resolution
+        self.concurrency = max(1, concurrency)
+        self.probes = 0
+        self.rounds = 0
+
+    def __test(self, lengths, executor):
+        self.rounds += 1
+        self.probes += len(lengths)
+        if executor is None:
+            results = [self.check(length) for length in lengths]
+        else:
+            results = list(executor.map(self.check, lengths))
+        Logger(lambda: f"Probe round {self.rounds}: {dict(zip(lengths, results))}")
+        return dict(zip(lengths, results))
+
+    def __narrow(self, low, high, results):
+        rejected = [length for length, ok in results.items() if not ok]
+        if rejected:
+            high = min([high] + rejected) if high is not None else min(rejected)
+        accepted = [length for length, ok in results.items()
+                    if ok and (high is None or length < high)]
+        return max([low] + accepted), high
+
+    def run(self) -> int:
+        executor = None
+        if self.concurrency > 1:
+            executor = ThreadPoolExecutor(self.concurrency, "probe")
+        try:
+            low, high = 0, None
+            length = self.start
+            while high is None:
+                lengths = []
+                while (len(lengths) < self.concurrency and low < self.maximum
+                       and (not lengths or lengths[-1] < self.maximum)):
+                    lengths.append(min(length, self.maximum))
+                    length *= 2
+                if not lengths:
+                    return low
+                low, high = self.__narrow(low, high, self.__test(lengths, executor))
+                length = max(length, low * 2)
+            # stop once the limit is known within resolution (at least 1 char)
+            while high - low > max(1, int(low * self.resolution)):
+                step = (high - low) / (self.concurrency + 1)
+                lengths = sorted({low + max(1, int(step * i))
+                                  for i in range(1, self.concurrency + 1)} - {high})
+                low, high = self.__narrow(low, high, self.__test(lengths, executor))
+            return low
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Find the longest prompt a bot accepts (clears the "
+                    "conversation with the bot)")
+    parser.add_argument("-t", "--token", required=True, help="POE Token")
+    parser.add_argument("-b", "--bot", default="capybara")
+    parser.add_argument(
+        "-k", "--concurrency", type=int, default=1,
+        help="Lengths tested at once, one connection each")
+    parser.add_argument("--start", type=int, default=1000)
+    parser.add_argument("--maximum", type=int, default=1000000)
+    parser.add_argument(
+        "--resolution", type=float, default=0.01, help="Relative precision of the limit")
+    parser.add_argument("-l", "--log", type=str, help="Log file")
+    return parser.parse_args()
+
+
+def run_test():
+    for limit in [1, 999, 1000, 1001, 4242, 65536, 999999]:
+        for concurrency in [1, 3]:
+            checks = []
+
+            def check(length):
+                checks.append(length)
+                return length <= limit
+
+            probe = Probe(check, concurrency=concurrency, resolution=0)
+            found = probe.run()
+            assert found == limit, (limit, concurrency, found)
+            assert probe.probes == len(checks) < 60, (limit, probe.probes)
+    probe = Probe(lambda length: True, maximum=10000)
+    assert probe.run() == 10000, "capped by maximum"
+    print("All tests passed, well done!")
+
+
+if __name__ == "__main__":
+    from poe_client import Poe
+
+    args = arg_parser()
+    if args.log:
+        Logger.is_active = True
+        Logger.set_file(args.log)
+    # one connection per concurrent probe, each reused for every round
+    clients: queue.Queue = queue.Queue()
+    for _ in range(max(1, args.concurrency)):
+        clients.put(Poe(args.token))
+
+    def check(length):
+        client = clients.get()
+        try:
+            return client.accepts(length, args.bot)
+        finally:
+            clients.put(client)
+
+    start = time.perf_counter()
+    probe = Probe(check, args.start, args.maximum, args.resolution, args.concurrency)
+    limit = probe.run()
+    PromptLimits(default_limits_path()).set(args.bot, limit)
+    print(f"Max prompt length for {args.bot}: {limit} "
+          f"({probe.probes} probes in {time.perf_counter() - start:.1f}s)")
@@ -0,0 +1,49 @@
+import json
+import os
+import struct
+
+# Every frame is a one byte kind, a 4 bytes big endian payload length and
+# the payload. Kept to the standard library so poe_cli.py starts instantly.
+REQUEST = b"R"  # client -> server, json {"prompt", "bot", "mode", "cwd"}
+CHUNK = b"C"  # server -> client, utf-8 piece of the reply
+OUTPUT = b"O"  # server -> client, utf-8 output of a ! command
+ERROR = b"E"  # server -> client, utf-8 error message
+END = b"D"  # server -> client, json {"bot", "mode", "running"}
+
+_header = struct.Struct(">cI")
+
+
+class ProtocolError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+def default_socket_path() -> str:
+    directory = os.environ.get("XDG_RUNTIME_DIR") or "/tmp"
+    return os.path.join(directory, f"poe_terminal-{os.getuid()}.sock")
+
+
+def send_frame(sock, kind, payload=b"") -> None:
+    if isinstance(payload, str):
+        payload = payload.encode()
+    elif not isinstance(payload, bytes):
+        payload = json.dumps(payload).encode()
+    sock.sendall(_header.pack(kind, len(payload)) + payload)
+
+
+def _recv_exactly(sock, size) -> bytes:
+    buffer = bytearray()
+    while len(buffer) < size:
+        data = sock.recv(size - len(buffer))
+        if not data:
+            raise ProtocolError("Connection closed")
+        buffer += data
+    return bytes(buffer)
+
+
+def recv_frame(sock):
+    kind, size = _header.unpack(_recv_exactly(sock, _header.size))
+    return kind, _recv_exactly(sock, size)
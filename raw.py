@@ -0,0 +1,89 @@
+import os
+import sys
+
+from command import CommandError  # type: ignore
+from history import history_from_args
+from logger import Logger
+from poe_client import PoeError
+from session import Session, client_from_args
+
+
+def read_prompts(prompt):
+    # the prompt from the command line, else the whole of a piped stdin, else
+    # one prompt per line typed
+    if prompt:
+        yield " ".join(prompt)
+        return
+    if not sys.stdin.isatty():
+        yield sys.stdin.read()
+        return
+    while True:
+        sys.stderr.write("> ")
+        sys.stderr.flush()
+        line = sys.stdin.readline()
+        if not line:
+            return
+        yield line.rstrip("\n")
+
+
+class RawTerminal(Session):
+    # The replies written to a binary stream as they are received, without
+    # prompt_toolkit nor rich, for shell pipelines; errors go to stderr.
+    def __init__(self, args, output=None) -> None:
+        super().__init__(client_from_args(args))
+        self.history = history_from_args(args)
+        self.tokens.max_size = int(args.file_budget * 1024 * 1024)
+        self.output = output or sys.stdout.buffer
+        if args.bot:
+            self.client.bot = args.bot
+        if args.log:
+            Logger.is_active = True
+            Logger.set_file(args.log)
+        self.client.connect_in_background()
+
+    def write(self, text) -> None:
+        self.output.write(text.encode())
+        self.output.flush()
+
+    def answer(self, prompt) -> bool:
+        try:
+            if prompt.startswith("!"):
+                from rich.text import Text  # type: ignore
+
+                output = str(self.commands(prompt))
+                try:
+                    output = Text.from_markup(output).plain
+                except Exception:
+                    pass
+                self.write(output + "\n")
+                return True
+            text = self.fit(prompt, self.expand(prompt))
+            last = ""
+            for last in self.record(
+                    prompt, text, self.client.send_message_generator(text)):
+                self.write(last)
+            if last and not last.endswith("\n"):
+                self.write("\n")
+            return True
+        except (CommandError, PoeError) as e:
+            print(e, file=sys.stderr)
+        except BrokenPipeError:
+            # the reader is gone (| head) and took what it wanted, not a
+            # failure; nothing left to write to
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, self.output.fileno())
+            self.set_running(False)
+            return True
+        except Exception as e:
+            Logger("Prompt %r failed: %r", prompt, e)
+            print(f"<!> {e}", file=sys.stderr)
+        return False
+
+    def run(self, prompts) -> int:
+        failed = 0
+        for prompt in prompts:
+            if prompt.strip():
+                failed += not self.answer(prompt)
+            if not self.running:
+                break
+        return int(failed > 0)
@@ -0,0 +1,100 @@
+import threading
+import time
+from typing import List
+
+from logger import Logger
+
+
+class RefreshScheduler:
+    # Chunks pushed between two frames are merged into a single render call,
+    # a timer thread flushes them when the stream stalls so that no chunk
+    # waits more than max_latency seconds on screen.
+    def __init__(self, render, fps=30.0, max_latency=0.1) -> None:
+        if fps <= 0:
+            raise ValueError("fps must be positive")
+        self.__render = render
+        self.__frame_time = 1 / fps
+        self.__max_latency = max_latency
+        self.__pending: List[str] = []
+        self.__pending_since = None
+        self.__next_frame = 0.0
+        self.__lock = threading.RLock()
+        self.__wakeup = threading.Condition(self.__lock)
+        self.__running = False
+        self.__thread = None
+        self.frames = 0
+        self.dropped_frames = 0
+        self.chunks = 0
+        self.render_time = 0.0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def start(self) -> None:
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        with self.__lock:
+            self.__running = False
+            self.__wakeup.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.flush()
+        Logger(
+            "Refresh: %d frames for %d chunks, %d dropped, %.2fms spent rendering",
+            self.frames, self.chunks, self.dropped_frames, self.render_time * 1000,
+        )
+
+    def push(self, chunk) -> None:
+        with self.__lock:
+            self.chunks += 1
+            self.__pending.append(chunk)
+            if self.__pending_since is None:
+                self.__pending_since = time.perf_counter()
+                self.__wakeup.notify()
+            if time.perf_counter() >= self.__next_frame:
+                self.flush()
+
+    def flush(self) -> None:
+        with self.__lock:
+            if not self.__pending:
+                return
+            text = "".join(self.__pending)
+            self.__pending = []
+            self.__pending_since = None
+            start = time.perf_counter()
+            self.__render(text)
+            elapsed = time.perf_counter() - start
+            # A slow frame pushes the next one back instead of queueing up
+            # frames, the chunks received meanwhile are merged into it.
+            dropped = int(elapsed // self.__frame_time)
+            self.__next_frame = start + (dropped + 1) * self.__frame_time
+            self.frames += 1
+            self.dropped_frames += dropped
+            self.render_time += elapsed
+            Logger(
+                "Frame %d: %d chars rendered in %.2fms (%d dropped)",
+                self.frames, len(text), elapsed * 1000, dropped,
+            )
+
+    def __deadline(self):
+        return min(self.__next_frame, self.__pending_since + self.__max_latency)
+
+    def __run(self) -> None:
+        with self.__lock:
+            while self.__running:
+                if self.__pending_since is None:
+                    self.__wakeup.wait()
+                    continue
+                timeout = self.__deadline() - time.perf_counter()
+                if timeout > 0:
+                    self.__wakeup.wait(timeout)
+                    continue
+                self.flush()
@@ -0,0 +1,332 @@
+import queue
+import random
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from logger import Logger
+from poe_client import PoeError
+
+# poe-api errors worth sending the message again for, the others (a daily
+# limit, an unknown bot, a message too long) would fail the same way
+TRANSIENT_ERRORS = ("timed out", "too many times")
+
+
+def transient(error) -> bool:
+    if isinstance(error, (PoeError, ConnectionError, TimeoutError)):
+        return True
+    return isinstance(error, RuntimeError) and any(
+        message in str(error) for message in TRANSIENT_ERRORS)
+
+
+class CircuitBreaker:
+    # Stops sending to a bot after threshold consecutive failures. Once
+    # cooldown seconds passed a single trial message is let through: a
+    # success closes the circuit, a failure opens it for another cooldown.
+    def __init__(self, threshold=5, cooldown=30.0) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.__failures: Dict[str, int] = {}
+        self.__opened: Dict[str, float] = {}
+        self.__lock = threading.Lock()
+
+    def allow(self, bot) -> bool:
+        with self.__lock:
+            if not self.threshold or self.__failures.get(bot, 0) < self.threshold:
+                return True
+            now = time.monotonic()
+            if now - self.__opened[bot] < self.cooldown:
+                return False
+            self.__opened[bot] = now
+            return True
+
+    def retry_in(self, bot) -> float:
+        with self.__lock:
+            opened = self.__opened.get(bot)
+        if opened is None:
+            return 0.0
+        return max(self.cooldown - (time.monotonic() - opened), 0.0)
+
+    def success(self, bot) -> None:
+        with self.__lock:
+            self.__failures.pop(bot, None)
+            self.__opened.pop(bot, None)
+
+    def failure(self, bot) -> None:
+        with self.__lock:
+            failures = self.__failures[bot] = self.__failures.get(bot, 0) + 1
+            if self.threshold and failures >= self.threshold:
+                self.__opened[bot] = time.monotonic()
+        if failures == self.threshold:
+            Logger("Circuit opened for %s after %d failures", bot, failures)
+
+    def show(self) -> str:
+        with self.__lock:
+            failures = dict(self.__failures)
+        lines = []
+        for bot, count in sorted(failures.items()):
+            if self.threshold and count >= self.threshold:
+                state = f"open, retry in {self.retry_in(bot):.0f}s"
+            else:
+                state = "closed"
+            lines.append(f"{bot}: {count} consecutive failures, {state}")
+        return "\n".join(lines)
+
+
+class Resilience:
+    # Around the network part of Poe.send_message_generator: a deadline on
+    # the first chunk, a hedged duplicate sent over a second connection (to
+    # hedge_bot, or the same bot) when the first chunk is late, the first
+    # stream to produce a chunk winning while the other one is drained and
+    # dropped, retries with exponential backoff and jitter as long as nothing
+    # was received, and a circuit breaker per bot.
+    def __init__(self, ttfc_deadline=None, hedge_after=None, hedge_bot=None,
+                 retries=0, backoff=1.0, breaker=None) -> None:
+        self.ttfc_deadline = ttfc_deadline
+        self.hedge_after = hedge_after
+        self.hedge_bot = hedge_bot
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.hedges = 0
+        self.hedges_won = 0
+        self.timeouts = 0
+        self.retried = 0
+
+    def stream(self, bot, send, hedge, on_target=None) -> Iterator[str]:
+        # send(bot, cancelled) and hedge(bot, cancelled) return the chunks of
+        # a reply, received from this connection and from another one, and
+        # do not send the message once cancelled is set; a retry goes through
+        # another connection too, this one may still be draining a reply.
+        # on_target(bot) is told the bot the reply comes from, before its
+        # first chunk: the hedge bot when the circuit is open or its hedge won
+        for attempt in range(self.retries + 1):
+            target = self.__target(bot)
+            received = False
+            try:
+                for text in self.__race(
+                        target, hedge if attempt else send, hedge, on_target):
+                    received = True
+                    yield text
+                return
+            except Exception as e:
+                if received or attempt == self.retries or not transient(e):
+                    raise
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                Logger("Message to %s failed (%s), retry in %.1fs", target, e, delay)
+                self.retried += 1
+                time.sleep(delay)
+
+    def __target(self, bot) -> str:
+        if self.breaker.allow(bot):
+            return bot
+        if self.hedge_bot not in (None, bot) and self.breaker.allow(self.hedge_bot):
+            Logger("Circuit open for %s, sending to %s", bot, self.hedge_bot)
+            return self.hedge_bot
+        raise PoeError(
+            f"{bot} keeps failing, not sending to it for "
+            f"{self.breaker.retry_in(bot):.0f}s")
+
+    def __race(self, bot, send, hedge, on_target) -> Iterator[str]:
+        if self.ttfc_deadline is None and self.hedge_after is None:
+            if on_target is not None:
+                on_target(bot)
+            try:
+                yield from send(bot, threading.Event())
+            except Exception:
+                self.breaker.failure(bot)
+                raise
+            self.breaker.success(bot)
+            return
+        events: queue.Queue = queue.Queue()
+        streams: List = []
+
+        def run(index, chunks, cancelled):
+            # poe.Client only serves the next message once this one is
+            # received, so a dropped stream is drained anyway
+            try:
+                for text in chunks:
+                    if not cancelled.is_set():
+                        events.put((index, text))
+            except Exception as e:
+                events.put((index, e))
+                return
+            events.put((index, None))
+
+        def launch(factory, target):
+            cancelled = threading.Event()
+            streams.append((target, cancelled))
+            threading.Thread(
+                target=run, args=(len(streams) - 1, factory(target, cancelled), cancelled),
+                daemon=True).start()
+
+        start = time.monotonic()
+        launch(send, bot)
+        winner: Optional[int] = None
+        failed = set()
+        try:
+            while True:
+                timeout = None
+                if winner is None:
+                    timers = [self.ttfc_deadline] if self.ttfc_deadline else []
+                    if self.hedge_after is not None and len(streams) == 1:
+                        timers.append(self.hedge_after)
+                    if timers:
+                        timeout = max(min(timers) - (time.monotonic() - start), 0)
+                try:
+                    index, item = events.get(timeout=timeout)
+                except queue.Empty:
+                    elapsed = time.monotonic() - start
+                    if (self.hedge_after is not None and len(streams) == 1
+                            and elapsed >= self.hedge_after):
+                        self.__hedge(bot, hedge, launch)
+                    elif self.ttfc_deadline and elapsed >= self.ttfc_deadline:
+                        self.timeouts += 1
+                        for target, _ in streams:
+                            self.breaker.failure(target)
+                        raise PoeError(
+                            f"No reply from {bot} within {self.ttfc_deadline:g}s")
+                    continue
+                if winner is not None and index != winner:
+                    continue
+                target = streams[index][0]
+                if isinstance(item, Exception):
+                    self.breaker.failure(target)
+                    failed.add(index)
+                    if winner is not None or len(failed) == len(streams):
+                        raise item
+                    continue
+                if winner is None:
+                    winner = index
+                    self.hedges_won += index > 0
+                    if on_target is not None:
+                        on_target(target)
+                    for other, (_, cancelled) in enumerate(streams):
+                        if other != index:
+                            cancelled.set()
+                if item is None:
+                    self.breaker.success(target)
+                    return
+                yield item
+        finally:
+            for _, cancelled in streams:
+                cancelled.set()
+
+    def __hedge(self, bot, hedge, launch) -> None:
+        target = bot
+        if self.hedge_bot not in (None, bot) and self.breaker.allow(self.hedge_bot):
+            target = self.hedge_bot
+        Logger("No chunk from %s after %.2fs, hedging to %s", bot, self.hedge_after, target)
+        self.hedges += 1
+        launch(hedge, target)
+
+    def show(self) -> str:
+        lines = [f"{self.hedges} hedged ({self.hedges_won} won by the hedge), "
+                 f"{self.timeouts} first chunk timeouts, {self.retried} retries"]
+        breaker = self.breaker.show()
+        if breaker:
+            lines.append(breaker)
+        return "\n".join(lines)
+
+
+def add_resilience_arguments(parser) -> None:
+    parser.add_argument(
+        "--ttfc-deadline", type=float,
+        help="Seconds to wait for the first chunk of a reply before failing")
+    parser.add_argument(
+        "--hedge-after", type=float,
+        help="Seconds without a first chunk before sending the message again "
+             "over a second connection, the first reply wins")
+    parser.add_argument(
+        "--hedge-bot", help="Bot the hedged message is sent to (default: the same)")
+    parser.add_argument(
+        "--retries", type=int, default=0,
+        help="Retries, with exponential backoff, of a message that failed")
+    parser.add_argument(
+        "--breaker-threshold", type=int, default=5,
+        help="Consecutive failures before a bot is not sent messages (0: never), "
+             "along with --ttfc-deadline, --hedge-after or --retries")
+    parser.add_argument(
+        "--breaker-cooldown", type=float, default=30,
+        help="Seconds before a failing bot is tried again")
+
+
+def resilience_from_args(args) -> Optional[Resilience]:
+    # None without a deadline, hedge nor retry: messages are then sent as
+    # usual, waiting for the connection
+    if args.ttfc_deadline is None and args.hedge_after is None and not args.retries:
+        return None
+    return Resilience(
+        ttfc_deadline=args.ttfc_deadline, hedge_after=args.hedge_after,
+        hedge_bot=args.hedge_bot, retries=args.retries,
+        breaker=CircuitBreaker(args.breaker_threshold, args.breaker_cooldown))
+
+
+def run_test():
+    def reply(delay=0.0, error=None, text="one two"):
+        def chunks(bot, cancelled):
+            time.sleep(delay)
+            if error is not None:
+                raise RuntimeError(error)
+            for word in text.split():
+                yield f"{bot}:{word} "
+        return chunks
+
+    resilience = Resilience(hedge_after=0.02, hedge_bot="a2")
+    start = time.monotonic()
+    targets = []
+    assert "".join(resilience.stream(
+        "capybara", reply(0.5), reply(), targets.append)) == "a2:one a2:two "
+    assert time.monotonic() - start < 0.3 and resilience.hedges_won == 1
+    assert targets == ["a2"], targets
+    assert "".join(resilience.stream("capybara", reply(), reply())) == "capybara:one capybara:two "
+
+    resilience = Resilience(ttfc_deadline=0.05, retries=1, backoff=0.01)
+    try:
+        list(resilience.stream("capybara", reply(0.2), reply(0.2)))
+        raise AssertionError("deadline not enforced")
+    except PoeError as e:
+        assert "within 0.05s" in str(e), e
+    assert resilience.timeouts == 2 and resilience.retried == 1
+
+    calls = []
+
+    def flaky(bot, cancelled):
+        calls.append(bot)
+        return reply(error="Response timed out." if len(calls) < 3 else None)(bot, cancelled)
+
+    resilience = Resilience(retries=3, backoff=0.001)
+    assert "".join(resilience.stream("capybara", flaky, flaky)) == "capybara:one capybara:two "
+    assert len(calls) == 3 and resilience.retried == 2
+    # a daily limit is not retried
+    try:
+        list(resilience.stream("capybara", reply(error="Daily limit reached for capybara."),
+                               flaky))
+        raise AssertionError("daily limit retried")
+    except RuntimeError as e:
+        assert "Daily limit" in str(e) and resilience.retried == 2, e
+
+    breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+    resilience = Resilience(breaker=breaker, hedge_bot="a2")
+    for _ in range(2):
+        try:
+            list(resilience.stream("capybara", reply(error="down"), reply()))
+        except RuntimeError:
+            pass
+    assert not breaker.allow("capybara") and "open" in breaker.show()
+    # the fallback bot is used while the circuit is open
+    targets = []
+    assert "".join(resilience.stream(
+        "capybara", reply(), reply(), targets.append)) == "a2:one a2:two "
+    assert targets == ["a2"], targets
+    time.sleep(0.06)
+    assert "".join(resilience.stream("capybara", reply(), reply())) == "capybara:one capybara:two "
+    assert breaker.allow("capybara") and breaker.show() == ""
+    print("All tests passed, well done!")
+
+
+if __name__ == "__main__":
+    try:
+        run_test()
+    except Exception as e:
+        print(e)
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import threading
+import time
+from typing import List, Optional
+
+
+def normalize(message) -> str:
+    lines = message.replace("\r\n", "\n").strip().split("\n")
+    return "\n".join(line.rstrip() for line in lines)
+
+
+def digest(*parts) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class ResponseCache:
+    # Replies are keyed on (bot, normalized message, conversation epoch), the
+    # epoch being a digest of the exchanges since the last chat break, so a
+    # cached reply is only replayed in the same conversation context.
+    def __init__(self, path, ttl=7 * 24 * 3600, max_size=64 * 1024 * 1024) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        import sqlite3  # only paid for when the cache is enabled
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, bot TEXT, chunks TEXT, size INTEGER, "
+            "created REAL, accessed REAL)"
+        )
+        self.__db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.__db.commit()
+
+    @staticmethod
+    def key(bot, message, epoch) -> str:
+        return digest(bot, normalize(message), epoch)
+
+    def get(self, key) -> Optional[List[str]]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT chunks, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl and row[1] < now - self.ttl):
+                self.misses += 1
+                return None
+            self.__db.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.__db.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, bot, chunks) -> None:
+        if not self.enabled:
+            return
+        data = json.dumps(chunks)
+        now = time.time()
+        with self.__lock:
+            self.__db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, bot, data, len(data), now, now),
+            )
+            self.__evict(now)
+            self.__db.commit()
+
+    def __evict(self, now):
+        if self.ttl:
+            self.__db.execute(
+                "DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        size = self.__db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if size <= self.max_size:
+            return
+        # least recently used first, until the cache fits in max_size again
+        evicted = []
+        for key, entry_size in self.__db.execute(
+                "SELECT key, size FROM responses ORDER BY accessed"):
+            if size <= self.max_size:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        self.__db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__db.execute("DELETE FROM responses")
+            self.__db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> str:
+        with self.__lock:
+            entries, size = self.__db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups * 100 if lookups else 0
+        return "\n".join([
+            f"Cache {self.path} ({'enabled' if self.enabled else 'disabled'})",
+            f"{entries} entries, {size / 1024:.1f} KiB / {self.max_size / 1024:.1f} KiB",
+            f"{self.hits} hits, {self.misses} misses ({ratio:.1f}% hit rate)",
+        ])
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__db.close()
+
+
+def add_cache_arguments(parser) -> None:
+    parser.add_argument(
+        "--cache", type=str, help="Cache replies in this sqlite file")
+    parser.add_argument(
+        "--cache-ttl", type=float, default=24 * 7,
+        help="Hours a cached reply is kept (0: forever)")
+    parser.add_argument(
+        "--cache-size", type=float, default=64, help="Cache size limit in MiB")
+
+
+def cache_from_args(args) -> Optional[ResponseCache]:
+    if not args.cache:
+        return None
+    return ResponseCache(
+        args.cache, ttl=args.cache_ttl * 3600, max_size=args.cache_size * 1024 * 1024)
@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+
+from rich.text import Text  # type: ignore
+
+from bot_catalogue import add_catalogue_arguments, catalogue_from_args
+from chunk_trace import add_trace_arguments, trace_from_args
+from command import CommandError  # type: ignore
+from file_cache import FileCache
+from history import add_history_arguments, history_from_args
+from logger import Logger
+from poe_client import Poe, PoeError, add_backend_arguments, backend_from_spec
+from prompt_limit import PromptLimits, default_limits_path
+from protocol import (CHUNK, END, ERROR, OUTPUT, REQUEST, ProtocolError,
+                      default_socket_path, recv_frame, send_frame)
+from resilience import add_resilience_arguments, resilience_from_args
+from response_cache import add_cache_arguments, cache_from_args
+from session import Session
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        session = Session(self.server.connections.acquire(), files=self.server.files)
+        session.history = self.server.history
+        Logger("Client connected (%d sessions)", self.server.sessions + 1)
+        self.server.sessions += 1
+        try:
+            while session.running:
+                try:
+                    kind, payload = recv_frame(self.request)
+                except ProtocolError:
+                    return
+                if kind != REQUEST:
+                    send_frame(self.request, ERROR, f"Unexpected frame {kind!r}")
+                    continue
+                self.handle_request(session, json.loads(payload))
+        finally:
+            self.server.sessions -= 1
+            self.server.connections.release(session.client)
+
+    def handle_request(self, session, request):
+        try:
+            session.cwd = request.get("cwd")
+            if request.get("bot"):
+                session.client.bot = request["bot"]
+            if request.get("mode"):
+                session.set_mode(request["mode"])
+            prompt = request.get("prompt", "")
+            if prompt.startswith("!"):
+                output = str(session.commands(prompt))
+                try:
+                    output = Text.from_markup(output).plain
+                except Exception:
+                    pass
+                send_frame(self.request, OUTPUT, output)
+            elif session.mode == "batch":
+                text = session.fit(prompt, session.expand(prompt))
+                reply = "".join(session.record(
+                    prompt, text, session.client.send_message_generator(text)))
+                send_frame(self.request, CHUNK, reply)
+            else:
+                text = session.fit(prompt, session.expand(prompt))
+                for text_chunk in session.record(
+                        prompt, text, session.client.send_message_generator(text)):
+                    send_frame(self.request, CHUNK, text_chunk)
+        except (CommandError, PoeError) as e:
+            send_frame(self.request, ERROR, str(e))
+        except Exception as e:
+            Logger("Request %r failed: %r", request, e)
+            send_frame(self.request, ERROR, f"<!> {e}")
+        send_frame(self.request, END, {
+            "bot": session.client.bot,
+            "mode": session.mode,
+            "running": session.running,
+        })
+
+
+class Connections:
+    # A connection of its own for every session, so that the conversations
+    # of the sessions and their messages do not mix; warm connections are
+    # kept connected ahead for the next sessions, and those of the sessions
+    # that ended are reused once their conversations are cleared.
+    def __init__(self, client, warm=1) -> None:
+        self.client = client
+        self.warm = warm
+        self.__idle: queue.Queue = queue.Queue()
+        for _ in range(warm):
+            self.__prepare(client.spawn())
+
+    def __prepare(self, connection, reset=False) -> None:
+        def run():
+            try:
+                if reset:
+                    connection.reset()
+                else:
+                    connection.connect()
+            except Exception as e:
+                Logger("Connection not kept for the next sessions: %r", e)
+                return
+            self.__idle.put(connection)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def acquire(self) -> Poe:
+        try:
+            connection = self.__idle.get_nowait()
+        except queue.Empty:
+            connection = self.client.spawn()
+            connection.connect_in_background()
+        if self.__idle.qsize() < self.warm:
+            self.__prepare(self.client.spawn())
+        connection.bot = self.client.bot
+        return connection
+
+    def release(self, connection) -> None:
+        self.__prepare(connection, reset=True)
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, client, history=None, warm=1) -> None:
+        self.client = client
+        self.connections = Connections(client, warm)
+        self.history = history
+        # the sessions share the contents of the files they reference
+        self.files = FileCache()
+        self.sessions = 0
+        if os.path.exists(path):
+            os.remove(path)
+        # only the user can connect, from the moment the socket exists
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Poe.com terminal server")
+    parser.add_argument(
+        "-t", "--token", help="POE Token fetch from poe.com cookies", required=True)
+    parser.add_argument(
+        "-s", "--socket", help="Unix socket path", default=default_socket_path())
+    parser.add_argument("-l", "--log", type=str, help="Log file")
+    parser.add_argument(
+        "--warm", type=int, default=1,
+        help="Connections to poe.com kept ready for the next client sessions")
+    add_cache_arguments(parser)
+    add_catalogue_arguments(parser)
+    add_backend_arguments(parser)
+    add_history_arguments(parser)
+    add_resilience_arguments(parser)
+    add_trace_arguments(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arg_parser()
+    if args.log:
+        Logger.is_active = True
+        Logger.set_file(args.log)
+    client = Poe(args.token, catalogue=catalogue_from_args(args),
+                 client_factory=backend_from_spec(args.backend))
+    client.cache = cache_from_args(args)
+    client.resilience = resilience_from_args(args)
+    client.trace = trace_from_args(args)
+    client.limits = PromptLimits(default_limits_path())
+    client.refresh_in_background()
+    with Server(args.socket, client, history_from_args(args), args.warm) as server:
+        print(f"Listening on {args.socket}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,374 @@
+import os
+import re
+
+from bot_catalogue import catalogue_from_args
+from chunk_trace import trace_from_args
+from chunking import MapReduce
+from command import Command, CommandError, CommandHandler  # type: ignore
+from docgen import DocCache, DocGen, default_docstrings_path, pooled_send, write_docstrings
+from fanout import FanOut
+from poe_client import MAX_SPARES, Poe, backend_from_spec
+from prompt_limit import PromptLimits, default_limits_path
+from resilience import resilience_from_args
+from response_cache import cache_from_args
+from tokens import Tokens
+
+
+def client_from_args(args) -> Poe:
+    # not connected yet, see Poe.connect_in_background
+    client = Poe(args.token, connect=False, catalogue=catalogue_from_args(args),
+                 client_factory=backend_from_spec(args.backend))
+    client.cache = cache_from_args(args)
+    client.resilience = resilience_from_args(args)
+    client.trace = trace_from_args(args)
+    client.limits = PromptLimits(default_limits_path())
+    return client
+
+
+def ask_arguments(rest) -> tuple:
+    # "bot1,bot2 prompt", the prompt as typed after the separator
+    match = re.match(r"\s*(\S+)\s?(.*)", rest, re.DOTALL)
+    if match is None:
+        raise CommandError("Usage: !ask bot1,bot2 prompt")
+    return match.group(1).split(","), match.group(2)
+
+
+class Session:
+    modes = {"interactive": "Interactive mode", "batch": "Batch mode"}
+
+    def __init__(self, client, mode="interactive", cwd=None, files=None) -> None:
+        self.client = client
+        self.mode = mode
+        self.running = True
+        self.history = None
+        self.__fan_out = None
+        self.bot_commands = CommandHandler({})
+        self.update_bots()
+        # the subtree of !set bot follows the refreshes of the catalogue
+        self.client.catalogue.subscribe(self.update_bots)
+        self.commands = CommandHandler(
+            {
+                "!clear": Command(
+                    lambda _: (self.client.send_chat_break(),
+                               "Conversation cleared"),
+                    "Clear the chat",
+                ),
+                "!set": Command(
+                    None,
+                    "Set value of prompt settings",
+                    CommandHandler(
+                        {
+                            "bot": Command(
+                                lambda args: (
+                                    self.client.set_bot(args[0]),
+                                    f"Bot set to {args[0]}",
+                                ),
+                                "Switch to another bot",
+                                self.bot_commands,
+                            ),
+                            "mode": Command(
+                                lambda args: (
+                                    self.set_mode(args[0]),
+                                    f"Mode set to {args[0]}",
+                                ),
+                                "Switch to another mode",
+                                CommandHandler(
+                                    {
+                                        mode: Command(None, self.modes[mode])
+                                        for mode in self.modes
+                                    }
+                                ),
+                            ),
+                        }
+                    ),
+                ),
+                "!list": Command(
+                    None,
+                    "List values of prompt settings",
+                    CommandHandler(
+                        {
+                            "bot": Command(
+                                lambda _: self.client.show_bots(),
+                                "Show the list of bots",
+                            ),
+                            "mode": Command(
+                                lambda _: "\n".join(
+                                    f"{mode} - {self.modes[mode]}"
+                                    for mode in self.modes
+                                ),
+                                "Show the available modes",
+                            ),
+                        }
+                    ),
+                ),
+                "!get": Command(
+                    None,
+                    "Get value of prompt settings",
+                    CommandHandler(
+                        {
+                            "bot": Command(
+                                lambda _: f"Current bot\
+                                is {self.client.bot}",
+                                "Show the current bot",
+                            ),
+                            "mode": Command(
+                                lambda _: f"Current mode is {self.mode}",
+                                "Show the current mode",
+                            ),
+                            "limit": Command(
+                                lambda _: self.client.limits.show()
+                                or "No limit probed yet (use !probe)",
+                                "Show the probed prompt limits",
+                            ),
+                        }
+                    ),
+                ),
+                "!cache": Command(
+                    None,
+                    "Manage the response and file caches",
+                    CommandHandler(
+                        {
+                            "stats": Command(
+                                lambda _: self.cache_stats(),
+                                "Show the cache statistics",
+                            ),
+                            "clear": Command(
+                                lambda _: (self.response_cache().clear(),
+                                           "Cache cleared"),
+                                "Remove every cached reply",
+                            ),
+                            "on": Command(
+                                lambda _: (
+                                    setattr(self.response_cache(), "enabled", True),
+                                    "Cache enabled",
+                                ),
+                                "Replay cached replies",
+                            ),
+                            "off": Command(
+                                lambda _: (
+                                    setattr(self.response_cache(), "enabled", False),
+                                    "Cache disabled",
+                                ),
+                                "Always ask the bot",
+                            ),
+                        }
+                    ),
+                ),
+                "!ask": Command(
+                    lambda rest: self.compare(*ask_arguments(rest)),
+                    "Send a prompt to several bots at once: !ask bot1,bot2 prompt",
+                    self.bot_commands,
+                    raw=True,
+                ),
+                "!docgen": Command(
+                    lambda args: self.docgen(args),
+                    "Write the missing docstrings of python files: !docgen path [write]",
+                ),
+                "!probe": Command(
+                    lambda args: self.probe(args[0] if args else None),
+                    "Find the longest prompt a bot accepts (clears the "
+                    "conversation with the bot)",
+                    self.bot_commands,
+                ),
+                "!stats": Command(
+                    lambda args: self.stats(args),
+                    "Show the latency statistics of the last requests",
+                    CommandHandler(
+                        {
+                            "prometheus": Command(
+                                None, "Export in Prometheus text format (to a file if given)"),
+                            "jsonl": Command(
+                                None, "Export one json object per request (to a file if given)"),
+                            "clear": Command(None, "Forget the recorded requests"),
+                        }
+                    ),
+                ),
+                "!history": Command(
+                    None,
+                    "Search the previous prompts and replies",
+                    CommandHandler(
+                        {
+                            "search": Command(
+                                lambda args: self.saved_history().show(
+                                    self.saved_history().search(" ".join(args))),
+                                "Find the exchanges containing every term",
+                                "terms",
+                            ),
+                            "last": Command(
+                                lambda args: self.saved_history().show(
+                                    self.saved_history().last(int(args[0]) if args else 10)),
+                                "Show the last exchanges",
+                                "count",
+                            ),
+                            "show": Command(
+                                lambda args: self.show_exchange(int(args[0].lstrip("#"))),
+                                "Show a whole exchange",
+                                "id",
+                            ),
+                        }
+                    ),
+                ),
+                "!exit": Command(
+                    lambda _: (
+                        self.set_running(False),
+                        "[yellow] Exiting the program [/yellow]",
+                    ), "Exit the program"
+                ),
+            },
+            help="!help",
+        )
+
+        self.tokens = Tokens(cwd, files=files)
+
+    def update_bots(self) -> None:
+        bots = self.client.bots
+        self.bot_commands.set_commands(
+            {str(bot): Command(None, bots[bot]) for bot in bots}
+        )
+
+    def set_running(self, value: bool):
+        self.running = value
+
+    def set_mode(self, mode):
+        self.mode = mode
+
+    @property
+    def fan_out(self) -> FanOut:
+        if self.__fan_out is None:
+            self.__fan_out = FanOut(self.client)
+        return self.__fan_out
+
+    def ask(self, bots, prompt, on_chunk=None, cancelled=None):
+        if not prompt.strip():
+            raise CommandError("Usage: !ask bot1,bot2 prompt")
+        text = self.expand(prompt)
+        return self.fan_out.ask(
+            bots, text, on_chunk,
+            lambda bot, chunks: self.record(prompt, text, chunks, bot), cancelled)
+
+    def compare(self, bots, prompt) -> str:
+        return "\n\n".join(
+            f"## {reply.bot} ({reply.latency})\n\n{reply.text}"
+            for reply in self.ask(bots, prompt))
+
+    def docgen(self, args, progress=None, concurrency=4) -> str:
+        if not args or args[1:] not in ([], ["write"]):
+            raise CommandError("Usage: !docgen path [write]")
+        path = os.path.join(self.cwd or os.getcwd(), os.path.expanduser(args[0]))
+        if not os.path.exists(path):
+            raise CommandError(f"File {args[0]} not found")
+        bot = self.client.bot
+        generator = DocGen(
+            pooled_send(self.client, bot), bot,
+            DocCache(default_docstrings_path()), concurrency,
+            self.client.limits.get(bot), progress=progress)
+        definitions = generator.run(path)
+        written = write_docstrings(definitions) if args[1:] == ["write"] else 0
+        lines = []
+        for definition in definitions[:50]:
+            text = definition.docstring or f"<!> {definition.error}"
+            lines.append(f"{os.path.relpath(definition.path, self.cwd or '.')}:"
+                         f"{definition.line} {definition.qualname}: "
+                         f"{text.strip().splitlines()[0] if text.strip() else ''}")
+        if len(definitions) > 50:
+            lines.append(f"... and {len(definitions) - 50} more")
+        cached = sum(d.cached for d in definitions)
+        failed = sum(d.error is not None for d in definitions)
+        lines.append(f"{len(definitions)} undocumented definitions: {generator.sent} "
+                     f"generated, {cached} cached, {failed} failed, {written} written")
+        return "\n".join(lines)
+
+    def probe(self, bot=None) -> str:
+        bot = bot or self.client.bot
+        limit = self.client.probe_limit(bot)
+        return f"Max prompt length for {bot} is {limit} characters"
+
+    def stats(self, args) -> str:
+        metrics = self.client.metrics
+        if not args:
+            if self.client.resilience is None:
+                return metrics.show()
+            return metrics.show() + "\n" + self.client.resilience.show()
+        if args[0] == "clear":
+            metrics.clear()
+            return "Statistics cleared"
+        if args[0] not in ("prometheus", "jsonl"):
+            raise CommandError(f"Unknown export format {args[0]}")
+        text = getattr(metrics, args[0])()
+        if len(args) == 1:
+            return text
+        path = os.path.join(self.cwd or os.getcwd(), os.path.expanduser(args[1]))
+        with open(path, "w") as f:
+            f.write(text)
+        return f"Statistics written to {path}"
+
+    def saved_history(self):
+        if self.history is None:
+            raise CommandError("History is disabled (use --history)")
+        return self.history
+
+    def show_exchange(self, id) -> str:
+        entry = self.saved_history().get(id)
+        if entry is None:
+            raise CommandError(f"No exchange #{id}")
+        return f"{entry['bot']}> {entry['prompt']}\n\n{entry['reply'] or entry['error']}"
+
+    def record(self, prompt, text, chunks, bot=None):
+        # chunks are appended to the history as they are received
+        if self.history is None:
+            yield from chunks
+            return
+        id = self.history.begin(bot or self.client.bot, prompt, {
+            "mode": self.mode,
+            "tokens": re.findall(r"{{(.*?)}}", prompt),
+            "expanded": len(text),
+        })
+        reply = []
+        try:
+            for chunk in chunks:
+                self.history.chunk(id, chunk)
+                reply.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            self.history.end(id, "".join(reply), "cancelled")
+            raise
+        except Exception as e:
+            self.history.end(id, "".join(reply), str(e))
+            raise
+        self.history.end(id, "".join(reply))
+
+    def cache_stats(self) -> str:
+        stats = [self.tokens.files.stats()]
+        if self.client.cache is not None:
+            stats.append(self.client.cache.stats())
+        return "\n".join(stats)
+
+    def response_cache(self):
+        if self.client.cache is None:
+            raise CommandError("Response cache is not configured (use --cache)")
+        return self.client.cache
+
+    @property
+    def cwd(self):
+        return self.tokens.cwd
+
+    @cwd.setter
+    def cwd(self, cwd):
+        self.tokens.cwd = cwd
+
+    def expand(self, prompt) -> str:
+        return f" {prompt} --> {self.tokens(prompt)}"
+
+    def fit(self, prompt, text, progress=None) -> str:
+        # a prompt longer than the probed limit of the bot is map-reduced,
+        # the parts sent at once over the spare connections, and the reduced
+        # prompt is for a new conversation
+        bot = self.client.bot
+        limit = self.client.limits.get(bot)
+        if limit is None or len(text) <= limit:
+            return text
+        map_reduce = MapReduce(
+            pooled_send(self.client, bot), limit, MAX_SPARES, progress=progress)
+        text = map_reduce.run(text, prompt)
+        self.client.send_chat_break()
+        return text
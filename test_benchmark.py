@@ -0,0 +1,198 @@
+# The self-tests of the modules, and performance regression tests on the
+# fake backend, the scenarios of benchmark.py with thresholds:
+# python -m pytest test_benchmark.py
+# The latencies are compared to the fake backend's own, measured in the same
+# run, the other limits are about thirty times the timings measured on a
+# laptop, so that they catch regressions (a lost cache, a render per chunk, a
+# blocking call) rather than the noise of a loaded CI machine.
+import asyncio
+import contextlib
+import importlib
+import io
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from async_poe import AsyncPoe
+from benchmark import FakeTTY, raw_terminal
+from fake_poe import FakeClient
+from file_cache import FileCache
+from poe_client import Poe, fake_backend
+from tokens import Tokens
+
+# latency the client may add to the backend's first chunk
+OVERHEAD = 0.01
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    # no catalogue, limits nor response cache from the user's home
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+
+
+@pytest.mark.parametrize("module", [
+    "async_poe", "chunk_trace", "chunking", "command", "docgen", "file_cache",
+    "history", "metrics", "prompt_limit", "resilience",
+])
+def test_module(module):
+    importlib.import_module(module).run_test()
+
+
+def test_read_checkpoint(tmp_path):
+    from batch import read_checkpoint
+
+    path = tmp_path / "results.jsonl"
+    path.write_text('{"id": 1, "reply": "a"}\n{"reply": "b"}\n[]\n{"id": 2, "error": "x"}\n'
+                    '{"id": 3, "rep')
+    assert read_checkpoint(str(path)) == {1}
+
+
+def terminal(monkeypatch, *options):
+    import prompt
+
+    monkeypatch.setattr(sys, "argv", ["prompt.py", "--token", "fake", *options])
+    terminal = prompt.Terminal()
+    terminal.client.wait()
+    return terminal
+
+
+def mean_ttft(send, runs=50) -> float:
+    elapsed = 0.0
+    for _ in range(runs):
+        start = time.perf_counter()
+        chunks = send()
+        next(chunks)
+        elapsed += time.perf_counter() - start
+        chunks.close()
+    return elapsed / runs
+
+
+def backend_ttft(first_delay, runs=50) -> float:
+    backend = FakeClient("fake", first_delay=first_delay)
+    return mean_ttft(lambda: backend.send_message("capybara", "hello world"), runs)
+
+
+@pytest.mark.parametrize("first_delay", [0.0, 0.01])
+def test_ttft_poe(first_delay):
+    client = Poe("fake", client_factory=fake_backend(first_delay=first_delay))
+    ttft = mean_ttft(lambda: client.send_message_generator("hello world"))
+    assert ttft < backend_ttft(first_delay) + OVERHEAD
+
+
+@pytest.mark.parametrize("first_delay", [0.0, 0.01])
+def test_ttft_async_poe(first_delay):
+    async def run():
+        client = AsyncPoe("fake", fake_backend(first_delay=first_delay))
+        elapsed = 0.0
+        for _ in range(50):
+            start = time.perf_counter()
+            async for _ in client.send_message_generator("capybara", "hello world"):
+                elapsed += time.perf_counter() - start
+                break
+        client.close()
+        return elapsed / 50
+
+    assert asyncio.run(run()) < backend_ttft(first_delay) + OVERHEAD
+
+
+def test_ttft_raw_pipe():
+    read, write = os.pipe()
+    terminal = raw_terminal("fake:first_delay=0.01", os.fdopen(write, "wb"))
+    terminal.client.wait()
+    elapsed = 0.0
+    for _ in range(20):
+        start = time.perf_counter()
+        thread = threading.Thread(target=terminal.answer, args=("hello world",))
+        thread.start()
+        os.read(read, 1)
+        elapsed += time.perf_counter() - start
+        thread.join()
+        os.read(read, 65536)
+    terminal.output.close()
+    os.close(read)
+    assert elapsed / 20 < backend_ttft(0.01, 20) + OVERHEAD
+
+
+@pytest.mark.parametrize("mode, fps, limit", [
+    ("interactive", 30, 0.005),
+    ("interactive", 1000, 0.005),
+    ("batch", 30, 0.003),
+])
+def test_render(monkeypatch, mode, fps, limit):
+    # seconds per 8 characters chunk through Terminal.answer
+    reply_size = 16000
+    client = terminal(monkeypatch, "--mode", mode, "--fps", str(fps), "--backend",
+                      f"fake:reply_size={reply_size},chunk_size=8")
+    with contextlib.redirect_stdout(FakeTTY()):
+        client.answer("warm up")
+        start = time.perf_counter()
+        client.answer("hello")
+        elapsed = time.perf_counter() - start
+    assert elapsed / (reply_size // 8) < limit
+
+
+def test_render_raw():
+    reply_size = 16000
+    client = raw_terminal(f"fake:reply_size={reply_size},chunk_size=8", io.BytesIO())
+    client.client.wait()
+    start = time.perf_counter()
+    client.answer("hello")
+    assert (time.perf_counter() - start) / (reply_size // 8) < 0.0002
+    assert len(client.output.getvalue()) == reply_size + 1
+
+
+@pytest.fixture(scope="module")
+def big_file(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("expansion")
+    line = "    def f(x):  return x * 2  # some pasted code\n"
+    with open(directory / "big.py", "w") as f:
+        f.write(line * (1024 * 1024 // len(line)))
+    return str(directory)
+
+
+@pytest.mark.parametrize("prompt", [
+    "Explain {{file big.py}}",
+    "Explain {{file big.py 5000:5100}}",
+    "Explain {{code python big.py}}",
+])
+def test_expansion(big_file, prompt):
+    def mean(tokens, runs=5):
+        tokens(prompt)
+        start = time.perf_counter()
+        for _ in range(runs):
+            tokens(prompt)
+        return (time.perf_counter() - start) / runs
+
+    uncached = mean(Tokens(big_file, files=FileCache(max_size=0)))
+    cached = mean(Tokens(big_file, files=FileCache(watch=False)))
+    assert uncached < 0.2
+    # a hit costs a stat and the join of the prompt, not a read of the file
+    assert cached < 0.03 and cached < uncached
+
+
+@pytest.mark.parametrize("options", [
+    {},
+    {"error_rate": 0.1},
+    {"rate_limit": 5, "rate_window": 0.05},
+])
+def test_faults(options):
+    # every job of a batch succeeds despite the errors and the rate limit
+    from batch import Batch
+
+    jobs = 40
+
+    async def run():
+        client = AsyncPoe("fake", fake_backend(delay=0.001, **options), 4)
+        batch = Batch(client, io.StringIO(), 4, retries=5, backoff=0.01)
+        await batch.run(
+            {"id": i, "bot": "capybara", "prompt": "one two three"} for i in range(jobs))
+        client.close()
+        return batch
+
+    start = time.perf_counter()
+    batch = asyncio.run(run())
+    assert (batch.done, batch.failed) == (jobs, 0)
+    assert time.perf_counter() - start < 5
@@ -0,0 +1,161 @@
+import contextvars
+import glob
+import mmap
+import os
+import threading
+from typing import List, Optional, Tuple
+
+from command import Command, CommandError, CommandHandler  # type: ignore
+from file_cache import FileCache
+from logger import Logger
+
+
+def parse_range(selection) -> Tuple[str, Optional[int], Optional[int]]:
+    # "10:20" selects lines 10 to 20 (1-based, inclusive), "b0:4096" bytes
+    unit = "line"
+    if selection.startswith("b"):
+        unit, selection = "byte", selection[1:]
+    begin, separator, end = selection.partition(":")
+    try:
+        start = int(begin) if begin else None
+        stop = int(end) if end else None
+        if not separator:
+            stop = start
+    except ValueError:
+        raise CommandError(f"Invalid range '{selection}' (use start:end or bstart:end)")
+    return unit, start, stop
+
+
+def _line_offset(data, line) -> int:
+    offset = 0
+    for _ in range(line - 1):
+        offset = data.find(b"\n", offset) + 1
+        if offset == 0:
+            return len(data)
+    return offset
+
+
+class _Budget:
+    # bytes injected by the prompt being expanded, its placeholders are
+    # evaluated concurrently
+    def __init__(self) -> None:
+        self.used = 0
+        self.lock = threading.Lock()
+
+
+# per expansion rather than per Tokens, several prompts can be expanded at
+# the same time (batch.py); copied into the threads of the placeholders
+_budget: contextvars.ContextVar = contextvars.ContextVar("budget")
+
+
+class Tokens(CommandHandler):
+    def __init__(self, cwd=None, max_size=8 * 1024 * 1024, files=None) -> None:
+        self.cwd = cwd
+        # contents of the referenced files, may be shared by sessions
+        self.files = files if files is not None else FileCache()
+        # bytes injected by a single prompt, whatever the number of files
+        self.max_size = max_size
+        super().__init__(
+            {
+                "file": Command(
+                    lambda args: self.file_token(args[0], *args[1:2]),
+                    "Replace token by file content",
+                    "file [start:end | bstart:end]",
+                ),
+                "code": Command(
+                    lambda args: self.file_token(args[1], *args[2:3], language=args[0]),
+                    "Replace token by file content in a markdown code block",
+                    "language file [start:end | bstart:end]",
+                )
+            },
+            separators=("{{", "}}")
+        )
+
+    def __call__(self, prompt) -> str:
+        token = _budget.set(_Budget())
+        try:
+            return super().__call__(prompt)
+        finally:
+            _budget.reset(token)
+
+    def resolve(self, file) -> List[str]:
+        striped_file = file.replace("\"", "").replace("\'", "").strip()
+        if self.cwd is not None:
+            striped_file = os.path.join(self.cwd, striped_file)
+        Logger("striped_file=%r", striped_file)
+        if os.path.isdir(striped_file):
+            files = []
+            for root, directories, names in os.walk(striped_file):
+                directories[:] = sorted(d for d in directories if not d.startswith("."))
+                files.extend(
+                    os.path.join(root, name) for name in sorted(names)
+                    if not name.startswith("."))
+        elif glob.has_magic(striped_file):
+            files = sorted(
+                path for path in glob.glob(striped_file, recursive=True)
+                if os.path.isfile(path))
+        else:
+            return [striped_file]
+        if not files:
+            raise CommandError(f"File {file} not found")
+        return files
+
+    def open_file(self, file, selection=None) -> str:
+        try:
+            text, size, cached = self.files.read(file, selection, self.__load)
+            if cached:
+                self.__charge(file, size)
+            return text
+        except FileNotFoundError:
+            raise CommandError(f"File {file} not found")
+        except PermissionError:
+            raise CommandError(f"Permission denied to file {file}")
+        except CommandError:
+            raise
+        except Exception as e:
+            raise CommandError(f"Error while opening file {file}: {e}")
+
+    def __load(self, file, selection) -> Tuple[str, int]:
+        with open(file, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if selection is None:
+                self.__charge(file, size)
+                return f.read().decode(errors="replace"), size
+            if size == 0:
+                return "", 0
+            # only the selected range is paged in and copied
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                unit, start, stop = parse_range(selection)
+                if unit == "byte":
+                    begin = min(start or 0, size)
+                    end = size if stop is None else min(stop, size)
+                else:
+                    begin = _line_offset(data, start or 1)
+                    end = size if stop is None else _line_offset(data, stop + 1)
+                self.__charge(file, max(end - begin, 0))
+                return data[begin:end].decode(errors="replace"), max(end - begin, 0)
+
+    def file_token(self, file, selection=None, language=None) -> List[str]:
+        files = self.resolve(file)
+        parts: List[str] = []
+        for path in files:
+            if len(files) > 1:
+                parts += ["\n", os.path.relpath(path, self.cwd or "."), ":\n"]
+            if language is None:
+                parts.append(self.open_file(path, selection))
+            else:
+                parts += ["\n```", language, "\n", self.open_file(path, selection), "\n```\n"]
+        return parts
+
+    def __charge(self, file, size) -> None:
+        budget = _budget.get(None)
+        if budget is None:
+            used = size
+        else:
+            with budget.lock:
+                budget.used += size
+                used = budget.used
+        if self.max_size and used > self.max_size:
+            raise CommandError(
+                f"File {file} exceeds the injection budget "
+                f"({used} > {self.max_size} bytes)")